@@ -0,0 +1,246 @@
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+import itertools
+import json
+import threading
+import time
+import uuid
+from elasticsearch import Elasticsearch
+from elastic_transport import ApiResponseMeta, BaseNode, HttpHeaders
+from elastic_transport._node import NodeApiResponse
+
+#An in-memory stand-in for the Elasticsearch server, plugged into the real client as its transport node: requests are serialised and answered
+#as they would be over HTTP, so src/utils.py, the scan and bulk helpers included, runs unchanged. It covers the subset of the API we use:
+#index/create/get documents, search (match_all, bool, term, terms, match, exists, ids) with from/size or scroll, clear scroll, bulk,
+#delete_by_query, count, index creation/existence and get/put mapping. Anything else is answered with 400, so that gaps show up rather than pass silently.
+
+class InMemoryStore:
+    def __init__(self):
+        self.indices = {}
+        self.scrolls = {}
+        self.lock = threading.RLock()
+        self.seq_no = itertools.count()
+
+    def index(self, name, create=True):
+        if name not in self.indices:
+            if not create:
+                return None
+            self.indices[name] = {'documents': OrderedDict(), 'mappings': {}, 'settings': {}}
+        return self.indices[name]
+
+    def load(self, name, documents, ids=None):
+        #fast path for test data: stores documents directly, without going through the client
+        with self.lock:
+            index = self.index(name)
+            for i, document in enumerate(documents):
+                id = ids[i] if ids is not None else uuid.uuid4().hex[:20]
+                index['documents'][id] = {'_source': document, '_seq_no': next(self.seq_no), '_primary_term': 1}
+
+    def drop(self, name):
+        with self.lock:
+            self.indices.pop(name, None)
+
+
+def field_values(source, field):
+    value = source
+    for part in field.removesuffix('.keyword').split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return []
+        value = value[part]
+    return value if isinstance(value, list) else [value]
+
+
+def tokens(text):
+    return set(str(text).lower().split())
+
+
+def matches(query, id, source):
+    if not query or 'match_all' in query:
+        return True
+    if 'bool' in query:
+        clauses = {key: value if isinstance(value, list) else [value] for key, value in query['bool'].items() if key in ('must', 'filter', 'should', 'must_not')}
+        if not all(matches(q, id, source) for q in clauses.get('must', []) + clauses.get('filter', [])):
+            return False
+        if any(matches(q, id, source) for q in clauses.get('must_not', [])):
+            return False
+        if clauses.get('should') and not (clauses.get('must') or clauses.get('filter')):
+            return any(matches(q, id, source) for q in clauses['should'])
+        return True
+    if 'term' in query:
+        (field, value), = query['term'].items()
+        value = value['value'] if isinstance(value, dict) else value
+        return value in ([id] if field == '_id' else field_values(source, field))
+    if 'terms' in query:
+        (field, values), = query['terms'].items()
+        return any(value in values for value in ([id] if field == '_id' else field_values(source, field)))
+    if 'match' in query:
+        (field, text), = query['match'].items()
+        text = text['query'] if isinstance(text, dict) else text
+        return any(tokens(text) & tokens(value) for value in field_values(source, field))
+    if 'exists' in query:
+        return len(field_values(source, query['exists']['field'])) > 0
+    if 'ids' in query:
+        return id in query['ids']['values']
+    raise ValueError(f'Query not supported by the in-memory stand-in: {query}')
+
+
+class InMemoryNode(BaseNode):
+    _CLIENT_META_HTTP_CLIENT = ('im', '1.0')
+    store = None
+
+    def perform_request(self, method, target, body=None, headers=None, request_timeout=None):
+        start = time.perf_counter()
+        split = urlsplit(target)
+        path = [part for part in split.path.split('/') if part]
+        params = {key: values[-1] for key, values in parse_qs(split.query).items()}
+        if body and headers is not None and 'ndjson' in headers.get('content-type', ''):
+            payload = [json.loads(line) for line in body.decode('utf-8').splitlines() if line.strip()]
+        else:
+            payload = json.loads(body) if body else {}
+        with self.store.lock:
+            try:
+                status, response = self.route(method, path, params, payload)
+            except KeyError as e:
+                status, response = 404, {'error': {'type': 'not_found', 'reason': str(e)}, 'status': 404}
+            except ValueError as e:
+                status, response = 400, {'error': {'type': 'illegal_argument_exception', 'reason': str(e)}, 'status': 400}
+        data = b'' if method == 'HEAD' else json.dumps(response).encode('utf-8')
+        meta = ApiResponseMeta(status=status, http_version='1.1', headers=HttpHeaders({'content-type': 'application/json', 'x-elastic-product': 'Elasticsearch'}), duration=time.perf_counter() - start, node=self.config)
+        return NodeApiResponse(meta, data)
+
+    def route(self, method, path, params, payload):
+        if not path:
+            return 200, {'name': 'in-memory', 'version': {'number': '8.12.0'}, 'tagline': 'You Know, for Search'}
+        if path == ['_bulk'] or path[1:] == ['_bulk']:
+            return self.bulk(payload, path[0] if len(path) == 2 else None)
+        if path[:2] == ['_search', 'scroll']:
+            return self.scroll(payload.get('scroll_id') or params.get('scroll_id'), clear=method == 'DELETE')
+        if path in (['_refresh'], [path[0], '_refresh']):
+            return 200, {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+        name, operation = path[0], path[1] if len(path) > 1 else None
+        if operation is None:
+            if method == 'HEAD':
+                return (200 if self.store.index(name, create=False) is not None else 404), {}
+            if method == 'PUT':
+                if self.store.index(name, create=False) is not None:
+                    return 400, {'error': {'type': 'resource_already_exists_exception', 'reason': f'index [{name}] already exists'}, 'status': 400}
+                index = self.store.index(name)
+                index['mappings'], index['settings'] = payload.get('mappings', {}), payload.get('settings', {})
+                return 200, {'acknowledged': True, 'shards_acknowledged': True, 'index': name}
+        if operation == '_mapping':
+            if method == 'GET':
+                index = self.store.index(name, create=False)
+                if index is None:
+                    return 404, {'error': {'type': 'index_not_found_exception', 'reason': f'no such index [{name}]'}, 'status': 404}
+                return 200, {name: {'mappings': index['mappings']}}
+            self.store.index(name)['mappings'].setdefault('properties', {}).update(payload.get('properties', {}))
+            return 200, {'acknowledged': True}
+        if operation in ('_search', '_count', '_delete_by_query'):
+            index = self.store.index(name, create=False)
+            if index is None:
+                return 404, {'error': {'type': 'index_not_found_exception', 'reason': f'no such index [{name}]'}, 'status': 404}
+            hits = [(id, document) for id, document in index['documents'].items() if matches(payload.get('query'), id, document['_source'])]
+            if operation == '_count':
+                return 200, {'count': len(hits)}
+            if operation == '_delete_by_query':
+                for id, _ in hits:
+                    del index['documents'][id]
+                return 200, {'deleted': len(hits), 'failures': []}
+            return self.search(name, hits, params, payload)
+        if operation in ('_doc', '_create'):
+            id = path[2] if len(path) > 2 else None
+            if method == 'GET':
+                document = self.store.index(name)['documents'].get(id)
+                if document is None:
+                    return 404, {'_index': name, '_id': id, 'found': False}
+                return 200, {'_index': name, '_id': id, 'found': True, **document}
+            return self.write(name, id, payload, create=operation == '_create' or params.get('op_type') == 'create', if_seq_no=params.get('if_seq_no'))
+        raise ValueError(f'{method} /{"/".join(path)} is not supported by the in-memory stand-in')
+
+    def write(self, name, id, source, create=False, if_seq_no=None):
+        documents = self.store.index(name)['documents']
+        id = id or uuid.uuid4().hex[:20]
+        existing = documents.get(id)
+        if (create and existing is not None) or (if_seq_no is not None and (existing is None or existing['_seq_no'] != int(if_seq_no))):
+            return 409, {'error': {'type': 'version_conflict_engine_exception', 'reason': f'[{id}]: version conflict'}, 'status': 409}
+        documents[id] = {'_source': source, '_seq_no': next(self.store.seq_no), '_primary_term': 1}
+        result = 'updated' if existing is not None else 'created'
+        return (200 if existing is not None else 201), {'_index': name, '_id': id, 'result': result, '_seq_no': documents[id]['_seq_no'], '_primary_term': 1, '_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    def hit(self, name, id, document, source):
+        #source is False, or the (top-level) fields to include (None for all) and to exclude
+        hit = {'_index': name, '_id': id, '_score': 1.0}
+        if source is not False:
+            includes, excludes = source
+            hit['_source'] = {key: value for key, value in document['_source'].items() if (includes is None or key in includes) and key not in excludes}
+        return hit
+
+    def search(self, name, hits, params, payload):
+        size = int(payload.get('size', params.get('size', 10)))
+        source = payload.get('_source', params.get('_source', True))
+        as_list = lambda value: value.split(',') if isinstance(value, str) else list(value)
+        if source in (False, 'false'):
+            source = False
+        else:
+            includes = source if isinstance(source, (list, str)) and source != 'true' else source.get('includes') if isinstance(source, dict) else params.get('_source_includes')
+            excludes = source.get('excludes', []) if isinstance(source, dict) else params.get('_source_excludes', [])
+            source = (as_list(includes) if includes is not None else None, as_list(excludes))
+        hits = [self.hit(name, id, document, source) for id, document in hits]
+        response = {'took': 0, 'timed_out': False, '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0}, 'hits': {'total': {'value': len(hits), 'relation': 'eq'}, 'max_score': 1.0}}
+        if 'scroll' in params:
+            scroll_id = uuid.uuid4().hex
+            self.store.scrolls[scroll_id] = {'hits': hits, 'position': size, 'size': size}
+            response['_scroll_id'] = scroll_id
+            response['hits']['hits'] = hits[:size]
+        else:
+            start = int(payload.get('from', params.get('from', 0)))
+            response['hits']['hits'] = hits[start:start + size]
+        return 200, response
+
+    def scroll(self, scroll_ids, clear=False):
+        scroll_ids = scroll_ids if isinstance(scroll_ids, list) else [scroll_ids]
+        if clear:
+            for scroll_id in scroll_ids:
+                self.store.scrolls.pop(scroll_id, None)
+            return 200, {'succeeded': True, 'num_freed': len(scroll_ids)}
+        scroll = self.store.scrolls[scroll_ids[0]]
+        page = scroll['hits'][scroll['position']:scroll['position'] + scroll['size']]
+        scroll['position'] += scroll['size']
+        return 200, {'_scroll_id': scroll_ids[0], 'took': 0, 'timed_out': False, '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0}, 'hits': {'total': {'value': len(scroll['hits']), 'relation': 'eq'}, 'hits': page}}
+
+    def bulk(self, lines, default_index):
+        items, errors, i = [], False, 0
+        while i < len(lines):
+            (action, meta), = lines[i].items()
+            name = meta.get('_index', default_index)
+            if action == 'delete':
+                existed = self.store.index(name)['documents'].pop(meta['_id'], None) is not None
+                items.append({'delete': {'_index': name, '_id': meta['_id'], 'status': 200 if existed else 404, 'result': 'deleted' if existed else 'not_found'}})
+                i += 1
+                continue
+            source = lines[i + 1]
+            i += 2
+            if action == 'update':
+                existing = self.store.index(name)['documents'].get(meta['_id'])
+                if existing is None:
+                    status, response = 404, {'error': {'type': 'document_missing_exception', 'reason': f"[{meta['_id']}]: document missing"}}
+                else:
+                    status, response = self.write(name, meta['_id'], {**existing['_source'], **source.get('doc', {})})
+            else:
+                status, response = self.write(name, meta.get('_id'), source, create=action == 'create')
+            errors = errors or status >= 300
+            items.append({action: {**response, 'status': status}})
+        return 200, {'took': 0, 'errors': errors, 'items': items}
+
+
+def in_memory_client(store: InMemoryStore) -> Elasticsearch:
+    """Creates a real Elasticsearch client whose requests are answered by the in-memory store instead of a server.
+
+    Args:
+        store (InMemoryStore): The documents, shared by all clients created on it.
+
+    Returns:
+        Elasticsearch: the client.
+    """
+    node_class = type('BoundInMemoryNode', (InMemoryNode,), {'store': store})
+    return Elasticsearch('http://in-memory:9200', node_class=node_class)
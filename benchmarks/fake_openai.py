@@ -0,0 +1,93 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import random
+import threading
+import time
+
+#A stand-in for the OpenAI chat completions endpoint, run in-process. It answers every tool call with arguments generated from the tool's JSON schema,
+#after an optional latency, and can answer a share of requests with 429 to exercise rate limiting. Point the OpenAI client at it with
+#os.environ['OPENAI_BASE_URL'] = server.base_url.
+
+WORDS = ['issuer', 'bond', 'coupon', 'maturity', 'investors', 'yield', 'spread', 'rating', 'debt', 'placement', 'bank', 'loan', 'equity', 'shares', 'market',
+         'rally', 'default', 'refinancing', 'treasury', 'credit', 'fund', 'dividend', 'merger', 'earnings', 'quarter', 'guidance', 'currency', 'inflation']
+
+def fake_value(schema, rng, i=1):
+    #integers are positions (1, 2, ...) so that selections by number are valid; texts are random, so that repeated calls do not return duplicates
+    if 'enum' in schema:
+        return rng.choice(schema['enum'])
+    if schema.get('type') == 'object':
+        return {key: fake_value(value, rng, i) for key, value in schema.get('properties', {}).items()}
+    if schema.get('type') == 'array':
+        n = schema.get('minItems', 3)
+        return [fake_value(schema['items'], rng, j + 1) for j in range(n)]
+    if schema.get('type') == 'integer':
+        return i
+    if schema.get('type') == 'number':
+        return float(i)
+    if schema.get('type') == 'boolean':
+        return rng.random() < 0.5
+    return ' '.join(rng.choices(WORDS, k=rng.randint(6, 16))).capitalize() + '.'
+
+class FakeOpenAIServer:
+    def __init__(self, latency=0.0, rate_limit_every=0, retry_after=1, port=0, seed=0):
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.counter = itertools.count(1)
+        self.statistics = {'requests': 0, 'rate_limited': 0}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                n = next(server.counter)
+                server.statistics['requests'] += 1
+                if server.rate_limit_every and n % server.rate_limit_every == 0:
+                    server.statistics['rate_limited'] += 1
+                    self.respond(429, {'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}}, {'retry-after': str(server.retry_after)})
+                    return
+                time.sleep(server.latency)
+                function = body['tools'][0]['function']
+                with server.rng_lock:
+                    arguments = fake_value(function['parameters'], server.rng)
+                prompt_tokens = sum(len(m['content'] or '') for m in body['messages']) // 4
+                completion_tokens = len(json.dumps(arguments)) // 4
+                self.respond(200, {
+                    'id': f'chatcmpl-{n}',
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': body['model'],
+                    'choices': [{
+                        'index': 0,
+                        'finish_reason': 'tool_calls',
+                        'message': {'role': 'assistant', 'content': None, 'tool_calls': [{'id': f'call_{n}', 'type': 'function', 'function': {'name': function['name'], 'arguments': json.dumps(arguments)}}]}
+                    }],
+                    'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+                })
+
+            def respond(self, status, payload, headers={}):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.base_url = f'http://127.0.0.1:{self.httpd.server_address[1]}/v1'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import os
+import time
+import unittest
+
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.run import use_stand_in_tokenizer
+
+#Runs bursts of concurrent GPT calls from several sessions, at both priorities, against the fake endpoint, which answers every third request with 429.
+#All calls should succeed: rate limits hold the queue back instead of failing calls. Run as python -m unittest benchmarks.gpt_scheduler_check
+
+
+class GptSchedulerCheck(unittest.TestCase):
+
+    def setUp(self):
+        #the scheduler counts prompt tokens with tiktoken, whose encoding is downloaded on first use; the stand-in of the benchmarks needs no network
+        use_stand_in_tokenizer()
+
+    def test_rate_limited_calls_are_retried(self):
+        with FakeOpenAIServer(latency=0.05, rate_limit_every=3, retry_after=1) as server:
+            os.environ['OPENAI_BASE_URL'] = server.base_url
+            from src.gpt_augmentation import call_gpt, generate_kw_nv_dc_custom_function
+            from src.gpt_scheduler import gpt_context, scheduler
+
+            def call(session, priority):
+                with gpt_context(session=session, priority=priority):
+                    return call_gpt('fake-key', 'system', '', 'Give keywords for Corporate Bonds.', generate_kw_nv_dc_custom_function(), max_n_tries=1)
+
+            start = time.monotonic()
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, call, f'session_{i % 4}', 'batch' if i % 2 else 'interactive') for i in range(24)]
+                results = [future.result() for future in futures]
+            print(f'{len(results)} calls in {time.monotonic() - start:.2f}s, fake endpoint: {server.statistics}, scheduler: {scheduler.metrics()}')
+
+            #with a single try per call, every call only succeeds if the scheduler waited out the 429s instead of failing the call
+            self.assertTrue(all('keywords' in result for result in results))
+            self.assertGreater(server.statistics['rate_limited'], 0)
+            self.assertEqual(server.statistics['requests'] - server.statistics['rate_limited'], len(results))
+            self.assertEqual(sum(scheduler.metrics()['queue_depth'].values()), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
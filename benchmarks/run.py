@@ -0,0 +1,295 @@
+from collections import Counter
+import argparse
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+from benchmarks.fake_elasticsearch import InMemoryStore, in_memory_client
+from benchmarks.fake_openai import FakeOpenAIServer
+from benchmarks.synthetic_corpus import generate_corpus, load_corpus
+from src.instrumentation import trace, export_trace
+
+#Offline benchmarks: Elasticsearch is the in-memory stand-in, OpenAI the fake endpoint, the sentence embedder a hashing stand-in of the
+#same dimension and the tiktoken encoding a word-piece stand-in, so that nothing needs credentials or a network. Every benchmark runs at each requested size, and the timings, with the
+#Elasticsearch round-trips and GPT calls counted by src/instrumentation.py, are written as JSON; --compare prints the ratio to an earlier run.
+#Run as, for instance: python -m benchmarks.run --sizes 1000 10000 100000 --compare benchmarks/results/baseline.json
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'results')
+
+
+class HashingEmbedder:
+    #deterministic stand-in for the sentence transformer: a text is the sum of fixed random vectors of its words, so that texts sharing words are similar
+    def __init__(self, dimension=768):
+        self.dimension = dimension
+        self.word_vectors = {}
+
+    def word_vector(self, word):
+        if word not in self.word_vectors:
+            seed = int.from_bytes(hashlib.md5(word.encode('utf-8')).digest()[:4], 'little')
+            self.word_vectors[word] = np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32)
+        return self.word_vectors[word]
+
+    def encode(self, texts, **kwargs):
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.lower().split():
+                embeddings[i] += self.word_vector(word.strip('.,'))
+        return embeddings
+
+
+def use_stand_in_embedder():
+    import src.cluster_sentences as cluster_sentences
+    embedder = HashingEmbedder()
+    cluster_sentences.load_embedder = lambda: embedder
+    cluster_sentences._embedding_cache.clear()
+
+
+class StandInTokenizer:
+    #deterministic stand-in for the tiktoken encoding, which is downloaded on first use: words, numbers and punctuation marks are tokens, and words are
+    #split into pieces of at most four characters, which is about the average length of a GPT-4 token in English text
+    PATTERN = re.compile(r"\s?[A-Za-z]{1,4}|\s?\d{1,3}|\s?[^\sA-Za-z\d]|\s+")
+
+    def encode(self, text):
+        return self.PATTERN.findall(text)
+
+
+def use_stand_in_tokenizer():
+    #used by every benchmark, so that token counts, and so the packing of GPT batches and the token budgets of the scheduler, are the same on every machine
+    import src.prompt_builder as prompt_builder
+    tokenizer = StandInTokenizer()
+    prompt_builder.load_encoding = lambda: tokenizer
+
+
+_corpora = {}
+
+def corpus(n):
+    #generating a large corpus takes longer than most benchmarks, so it is kept between benchmarks of the same size
+    if n not in _corpora:
+        _corpora.clear()
+        _corpora[n] = generate_corpus(n)
+    return _corpora[n]
+
+
+def es_setup(n):
+    store = InMemoryStore()
+    load_corpus(store, corpus(n))
+    return in_memory_client(store)
+
+
+def bench_join_sl_and_los(n):
+    from src.utils import join_sl_and_los
+    client = es_setup(n)
+    return lambda: join_sl_and_los(client)
+
+
+def bench_train_test_split_stratified(n):
+    from src.utils import join_sl_and_los, train_test_split_stratified
+    client = es_setup(n)
+    joined = join_sl_and_los(client)
+    return lambda: train_test_split_stratified(client, joined, 0.8, False)
+
+
+def bench_push_visualisation_data(n):
+    from src.utils import push_visualisation_data
+    client = es_setup(n)
+    def run():
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            push_visualisation_data(client)
+    return run
+
+
+def bench_co_labelling_grid(n):
+    from src.utils import co_labelling_grid
+    client = es_setup(n)
+    def run():
+        #writes grid.csv to the working directory
+        with tempfile.TemporaryDirectory() as directory:
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                co_labelling_grid(client)
+            finally:
+                os.chdir(cwd)
+    return run
+
+
+def sample_sentences(n):
+    _, sentences = corpus(max(n, 1000))['labelled_sentence']
+    return [{'sentence_text': s['sentence_text'], 'label': 'Yes' if i % 2 else 'No', 'explanation': f'Explanation {i}.'} for i, s in enumerate(sentences[:n])]
+
+
+def bench_cluster_sentences(n):
+    from src.cluster_sentences import yes_no_cluster_representatives
+    use_stand_in_embedder()
+    sentences = sample_sentences(n)
+    return lambda: yes_no_cluster_representatives(sentences)
+
+
+def bench_cluster_sentences_incremental(n):
+    #n sentences clustered once under a key, then the same sentences with five more: only the five are assigned, to the existing clusters
+    from src.cluster_sentences import yes_no_cluster_representatives, _cluster_indices
+    use_stand_in_embedder()
+    sentences = sample_sentences(n + 5)
+    _cluster_indices.clear()
+    yes_no_cluster_representatives(sentences[:n], key='benchmark')
+    return lambda: yes_no_cluster_representatives(sentences, key='benchmark')
+
+
+def bench_cluster_recut(n):
+    #moving the threshold slider of the Sentence Suggestions page: representatives at 20 thresholds from one hierarchy, built in the setup
+    from src.cluster_sentences import yes_no_cluster_hierarchy, hierarchy_representatives
+    use_stand_in_embedder()
+    hierarchy = yes_no_cluster_hierarchy(sample_sentences(n))
+    return lambda: [hierarchy_representatives(group, threshold) for threshold in np.linspace(0.1, 1.9, 20) for group in hierarchy]
+
+
+def bench_input_maximised(n):
+    #n is the number of generated sentences, from five labelled ones; GPT answers come from the fake endpoint
+    import src.user_input_maximisation as user_input_maximisation
+    use_stand_in_embedder()
+    user_input_maximisation.st.secrets = {'GPT_TOPICS_KEY': 'fake-key'}
+    sentences = sample_sentences(5)
+    def run():
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            return user_input_maximisation.input_maximised(3, n, 5, 'Topic 0', 'A synthetic topic.', ['bond', 'coupon'], ['debt security'], ['Government bonds are not corporate bonds.'], sentences)
+    return run
+
+
+def bench_keyword_prefilter(n):
+    #candidate pairs of n sentences for all topics, from one scan with the compiled keyword matcher
+    from src.keyword_prefilter import prefilter
+    client = es_setup(n)
+    _, sentences = corpus(n)['labelled_sentence']
+    sentences = [{'sentence_id': f's{i}', 'sentence_text': s['sentence_text']} for i, s in enumerate(sentences)]
+    topic_ids = [t['id'] for t in corpus(n)['topic_entity'][1]]
+    return lambda: prefilter(client, sentences, topic_ids)
+
+
+def bench_active_learning(n):
+    #trains the classifiers of all topics from scratch (the model file is in a temporary directory) and ranks the unlabelled sentences of every topic
+    from src.active_learning import next_sentences_to_label
+    from src.vector_index import FlatIndex
+    import src.active_learning as active_learning
+    client = es_setup(n)
+    embedder = HashingEmbedder()
+    ids, sentences = corpus(n)['labelled_sentence']
+    index = FlatIndex(embedder.dimension, capacity=max(1, n))
+    index.add(embedder.encode([s['sentence_text'] for s in sentences]), ids)
+    active_learning.load_corpus_index = lambda: index
+    def run():
+        with tempfile.TemporaryDirectory() as directory:
+            return next_sentences_to_label(client, path=os.path.join(directory, 'model.npz'))
+    return run
+
+
+def gpt_labelling_setup(n, batch_size):
+    #labels every sentence not yet labelled for one topic (nearly all n of them); GPT answers come from the fake endpoint
+    from src.gpt_labelling import label_topics
+    client = es_setup(n)
+    def run():
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            return label_topics(client, 'fake-key', ['c0'], batch_size=batch_size)
+    return run
+
+
+def bench_gpt_labelling(n):
+    return gpt_labelling_setup(n, 25)
+
+
+def bench_gpt_labelling_unbatched(n):
+    #one sentence per request, as a baseline for the packing of gpt_labelling
+    return gpt_labelling_setup(n, 1)
+
+
+#name -> (setup, largest size that runs in reasonable time; the clustering distance matrix and the list lookups of push_visualisation_data are quadratic)
+BENCHMARKS = {
+    'join_sl_and_los': (bench_join_sl_and_los, 1000000),
+    'train_test_split_stratified': (bench_train_test_split_stratified, 1000000),
+    'push_visualisation_data': (bench_push_visualisation_data, 10000),
+    'co_labelling_grid': (bench_co_labelling_grid, 1000000),
+    'cluster_sentences': (bench_cluster_sentences, 2000),
+    'cluster_sentences_incremental': (bench_cluster_sentences_incremental, 2000),
+    'cluster_recut': (bench_cluster_recut, 2000),
+    'input_maximised': (bench_input_maximised, 50),
+    'keyword_prefilter': (bench_keyword_prefilter, 1000000),
+    'active_learning': (bench_active_learning, 1000000),
+    'gpt_labelling': (bench_gpt_labelling, 10000),
+    'gpt_labelling_unbatched': (bench_gpt_labelling_unbatched, 1000)
+}
+
+
+def run_benchmark(name, n, repeats):
+    setup, _ = BENCHMARKS[name]
+    seconds, counters = [], Counter()
+    for _ in range(repeats):
+        #setup is not timed, and is repeated so that benchmarks that write (push_visualisation_data) start from the same state
+        function = setup(n)
+        with trace() as run_trace:
+            start = time.perf_counter()
+            function()
+            seconds.append(time.perf_counter() - start)
+        counters = Counter(export_trace(run_trace)['counters'])
+    return {'benchmark': name, 'n': n, 'seconds': seconds, 'min': min(seconds), 'median': statistics.median(seconds), 'counters': dict(counters)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {(r['benchmark'], r['n']): r for r in json.load(f)['results']}
+    for r in results:
+        b = baseline.get((r['benchmark'], r['n']))
+        if b is not None:
+            print(f"{r['benchmark']:>30} n={r['n']:<8} {b['min']:.4f}s -> {r['min']:.4f}s ({r['min'] / b['min']:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the offline benchmarks and store the results as JSON.')
+    parser.add_argument('--benchmarks', nargs='*', default=list(BENCHMARKS.keys()), choices=list(BENCHMARKS.keys()))
+    parser.add_argument('--sizes', nargs='*', type=int, default=[1000, 10000], help='Numbers of sentences (for input_maximised: of generated sentences, capped at 50).')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--no-limits', action='store_true', help='Also run benchmarks at sizes above their limit.')
+    parser.add_argument('--gpt-latency', type=float, default=0.0, help='Seconds the fake OpenAI endpoint takes to answer.')
+    parser.add_argument('--output', default=None, help='Defaults to benchmarks/results/<timestamp>.json.')
+    parser.add_argument('--compare', default=None, help='An earlier results file to compare against.')
+    args = parser.parse_args()
+
+    benchmarks = args.benchmarks
+    use_stand_in_tokenizer()
+
+    results = []
+    with FakeOpenAIServer(latency=args.gpt_latency) as server:
+        os.environ['OPENAI_BASE_URL'] = server.base_url
+        for n in args.sizes:
+            for name in benchmarks:
+                limit = BENCHMARKS[name][1]
+                size = min(n, limit) if name == 'input_maximised' else n
+                if size > limit and not args.no_limits:
+                    print(f'{name:>30} n={size:<8} skipped (above {limit})')
+                    continue
+                if any(r['benchmark'] == name and r['n'] == size for r in results):
+                    continue
+                result = run_benchmark(name, size, args.repeats)
+                results.append(result)
+                print(f"{name:>30} n={size:<8} {result['min']:.4f}s (median {result['median']:.4f}s)")
+
+    output = args.output or os.path.join(RESULTS_DIRECTORY, f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(), 'sizes': args.sizes, 'repeats': args.repeats, 'results': results}, f, indent=4)
+    print(f'Results written to {output}')
+    if args.compare:
+        compare(results, args.compare)
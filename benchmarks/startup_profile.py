@@ -0,0 +1,78 @@
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+#Startup profile of the app: the import time of each module main.py may pull in, each measured in a fresh interpreter, and the time of the first
+#script runs (password page, then each page of the main navigation), rendered with Streamlit's AppTest against the in-memory Elasticsearch stand-in.
+#The first run includes the imports of main.py, so it is the cold start a user sees. Run as python -m benchmarks.startup_profile
+MODULES = ['streamlit', 'numpy', 'pandas', 'elasticsearch', 'openai', 'tiktoken', 'sklearn', 'sentence_transformers',
+           'src.utils', 'src.vector_index', 'src.job_queue', 'src.user_input_maximisation']
+PASSWORD = 'startup-profile'
+
+
+def import_seconds(module):
+    #cumulative import time of the module in a fresh interpreter, as reported by python -X importtime
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    for line in result.stderr.splitlines():
+        parts = [part.strip() for part in line.removeprefix('import time:').split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1e6
+    return None
+
+
+def render_seconds(n_sentences):
+    from streamlit.testing.v1 import AppTest
+    import src.utils
+    from benchmarks.fake_elasticsearch import InMemoryStore, in_memory_client
+    from benchmarks.synthetic_corpus import generate_corpus, load_corpus
+
+    store = InMemoryStore()
+    load_corpus(store, generate_corpus(n_sentences))
+    src.utils.create_es_client = lambda *args: in_memory_client(store)
+    os.environ['APP_WARM_UP'] = '0'
+
+    at = AppTest.from_file('main.py', default_timeout=120)
+    at.secrets['PASSWORD_HASH'] = hashlib.sha256(PASSWORD.encode()).hexdigest()
+    for key in ['ELASTIC_HOST', 'ELASTIC_USER', 'ELASTIC_PASS', 'GPT_TOPICS_KEY']:
+        at.secrets[key] = 'unused'
+
+    timings = {}
+    def timed_run(name, run):
+        start = time.perf_counter()
+        run()
+        timings[name] = time.perf_counter() - start
+        if at.exception:
+            raise RuntimeError(f'{name}: {at.exception[0].value}')
+
+    timed_run('password page (cold start)', at.run)
+    timed_run('login, Existing Sentence Database', lambda: at.text_input(key='password').input(PASSWORD).run())
+    for page in ['Example Topic Entry', 'Topic Insertion', 'Existing Sentence Database']:
+        timed_run(page, lambda: at.sidebar.radio[0].set_value(page).run())
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Profile the startup of the app: module import times and first page renders.')
+    parser.add_argument('--n-sentences', type=int, default=10000, help='Size of the synthetic corpus behind the Existing Sentence Database page.')
+    parser.add_argument('--output', default=None, help='Optionally, a JSON file to write the profile to.')
+    args = parser.parse_args()
+
+    imports = {module: import_seconds(module) for module in MODULES}
+    print('Import time (fresh interpreter, cumulative):')
+    for module, seconds in sorted(imports.items(), key=lambda item: -(item[1] or 0)):
+        print(f'{module:>35} ' + (f'{seconds:.3f}s' if seconds is not None else 'not installed'))
+
+    renders = render_seconds(args.n_sentences)
+    print('Script runs:')
+    for name, seconds in renders.items():
+        print(f'{name:>35} {seconds:.3f}s')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'imports': imports, 'renders': renders, 'n_sentences': args.n_sentences}, f, indent=4)
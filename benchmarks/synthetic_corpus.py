@@ -0,0 +1,71 @@
+import random
+
+#Synthetic labelling data with the shape of the real indices: topics (a third of them subtopics) and their definitions, labellers (one of them GPT, whose labels are not
+#visualised), sentences built from the vocabulary of the topics they are labelled with, one to three labels per sentence, and a topic_count_visualisation
+#that already holds most, but not all, of the human labels, so that push_visualisation_data has something to add.
+
+VOCABULARY = ['bond', 'coupon', 'maturity', 'yield', 'spread', 'rating', 'debt', 'loan', 'equity', 'shares', 'dividend', 'merger', 'acquisition', 'earnings',
+              'revenue', 'guidance', 'currency', 'inflation', 'rate', 'central', 'bank', 'treasury', 'credit', 'default', 'fund', 'index', 'futures', 'options',
+              'oil', 'gas', 'mining', 'retail', 'consumer', 'housing', 'mortgage', 'insurance', 'pension', 'regulation', 'tax', 'tariff', 'trade', 'export',
+              'import', 'labour', 'wages', 'employment', 'startup', 'venture', 'ipo', 'listing', 'buyback', 'restructuring', 'bankruptcy', 'lawsuit', 'fine']
+FILLER = ['the', 'a', 'said', 'on', 'after', 'as', 'in', 'its', 'with', 'for', 'new', 'analysts', 'company', 'week', 'quarter', 'investors', 'market']
+
+
+def generate_corpus(n_sentences, n_topics=50, n_labellers=5, seed=0) -> dict:
+    """Generates documents for every index the benchmarks read.
+
+    Args:
+        n_sentences (int): Number of labelled sentences.
+        n_topics (int, optional): Defaults to 50. Number of topics, of which a third are subtopics.
+        n_labellers (int, optional): Defaults to 5. Number of labellers, of which one is GPT and the others are human.
+        seed (int, optional): Defaults to 0.
+
+    Returns:
+        dict: Index name -> (list of ids, list of documents).
+    """
+    rng = random.Random(seed)
+    topics, topic_words = [], {}
+    n_parents = n_topics - n_topics // 3
+    for i in range(n_topics):
+        parent = 'none0' if i < n_parents else f'c{rng.randrange(n_parents)}'
+        topics.append({'id': f'c{i}', 'name': f'Topic {i}', 'type': 'Topic' if parent == 'none0' else 'Subtopic', 'parent_topic_id': parent, 'labeller_id': 'labeller_1'})
+        topic_words[f'c{i}'] = rng.sample(VOCABULARY, 6)
+    definitions = [{'topic_id': t['id'], 'name': t['name'], 'definition': f"Sentences about {' and '.join(topic_words[t['id']][:2])}.", 'language': 'English', 'status': 'Draft',
+                    'keyword': topic_words[t['id']][:4], 'name_variation': topic_words[t['id']][4:], 'difficult_case': [f"A mention of {topic_words[t['id']][0]} alone is not enough."]} for t in topics]
+    topic_names = {t['id']: t['name'] for t in topics}
+    parents = {t['id']: t['parent_topic_id'] for t in topics}
+
+    labeller_ids = [f'labeller_{k}' for k in range(n_labellers)]
+    labellers = [{'type': 'GPT' if k == 0 else 'Human'} for k in range(n_labellers)]
+
+    sentence_ids, sentences, label_ids, labels, visualisation = [], [], [], [], []
+    for i in range(n_sentences):
+        sentence_topics = rng.sample(topics, rng.choice([1, 1, 2, 3]))
+        words = [w for t in sentence_topics for w in rng.sample(topic_words[t['id']], 3)] + rng.sample(FILLER, 5)
+        rng.shuffle(words)
+        sentence_ids.append(f's{i}')
+        sentences.append({'sentence_text': ' '.join(words).capitalize() + '.', 'translated': False, 'generated': False, 'parent_sentence_id': 'none0'})
+        for t in sentence_topics:
+            labeller_id = rng.choice(labeller_ids)
+            label_ids.append(f'l{len(labels)}')
+            labels.append({'labeller_id': labeller_id, 'sentence_id': f's{i}', 'topic_id': t['id'], 'position_in_text': -1, 'confidence': rng.choice([0, 1]), 'explanation': f"Mentions {', '.join(topic_words[t['id']][:2])}."})
+            if labeller_id != 'labeller_0' and rng.random() < 0.9:
+                visualisation.append({'sentence_id': f's{i}', 'topic_name': t['name']})
+                if parents[t['id']] != 'none0':
+                    visualisation.append({'sentence_id': f's{i}', 'topic_name': topic_names[parents[t['id']]]})
+
+    return {
+        'topic_entity': ([f'te{i}' for i in range(n_topics)], topics),
+        'topic_entity_definition': ([f'ted{i}' for i in range(n_topics)], definitions),
+        'labeller': (labeller_ids, labellers),
+        'labelled_sentence': (sentence_ids, sentences),
+        'sentence_label': (label_ids, labels),
+        'topic_count_visualisation': ([f'v{i}' for i in range(len(visualisation))], visualisation)
+    }
+
+
+def load_corpus(store, corpus) -> None:
+    """Loads a generated corpus into an in-memory store (see fake_elasticsearch.py), replacing any existing documents of the same indices."""
+    for index, (ids, documents) in corpus.items():
+        store.drop(index)
+        store.load(index, [dict(document) for document in documents], ids)
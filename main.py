@@ -1,28 +1,67 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import hashlib
-import pandas as pd
+import importlib
+import logging
+import os
 import random
-import matplotlib.pyplot as plt
+import threading
+import time
 
+#pandas and the embedding model (with torch and scikit-learn) are imported only on the pages that use them, so that the password page renders without waiting for them
 
 #ES
-from src.utils import create_es_client, insert_document, search_document, join_sl_and_los
-
-ELASTIC_HOST = st.secrets["ELASTIC_HOST"]
-ELASTIC_USER = st.secrets["ELASTIC_USER"]
-ELASTIC_PASS = st.secrets["ELASTIC_PASS"]
-client = create_es_client(ELASTIC_HOST, ELASTIC_USER, ELASTIC_PASS)
-
-d_topic_to_id = {t['name']:t['id'] for t in search_document(client, 'topic_entity',{})}
-d_id_to_topic = {i[1]:i[0] for i in d_topic_to_id.items()}
-d_topic_to_id['None'] = 'none0'
-tids = [i[1] for i in d_topic_to_id.items()]
-topics = sorted([i[1] for i in d_id_to_topic.items()])
-tks = [i[0] for i in d_topic_to_id.items()]
-tks.insert(0,tks.pop(tks.index('None')))
+from src.job_queue import submit_job, job_status, resume_job
+from src.result_store import get_result, release_session
+from src.gpt_scheduler import gpt_context
+from src.instrumentation import trace, span, export_trace, summarise
+from src.vector_index import CORPUS_INDEX_PATH, similar_sentences
+from src.utils import create_es_client, allocate_topic_id, insert_document, insert_sentence, search_document, join_sl_and_los, request_scope
+
+
+@st.cache_resource
+def es_client():
+    #one client, and so one connection pool, per server process, shared by all sessions
+    return create_es_client(st.secrets["ELASTIC_HOST"], st.secrets["ELASTIC_USER"], st.secrets["ELASTIC_PASS"])
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def load_topics():
+    #read on the pages that need the topics rather than on every script run; cleared when a topic is saved
+    d_topic_to_id = {t['name']:t['id'] for t in search_document(es_client(), 'topic_entity',{})}
+    d_id_to_topic = {i[1]:i[0] for i in d_topic_to_id.items()}
+    d_topic_to_id['None'] = 'none0'
+    topics = sorted([i[1] for i in d_id_to_topic.items()])
+    tks = [i[0] for i in d_topic_to_id.items()]
+    tks.insert(0,tks.pop(tks.index('None')))
+    return d_topic_to_id, d_id_to_topic, topics, tks
+
+
+@st.cache_resource
+def start_warm_up():
+    #runs once per server process, on its first script run: loads the embedding model and the corpus index in a background thread, so that the first topic processed does not wait for them. Set APP_WARM_UP=0 to skip.
+    def warm_up():
+        try:
+            #imported for its side effect of loading the module and its dependencies, so that the first job does not wait for them
+            importlib.import_module('src.user_input_maximisation')
+            from src.cluster_sentences import load_embedder
+            from src.vector_index import load_corpus_index
+            load_embedder()
+            load_corpus_index(CORPUS_INDEX_PATH)
+        except Exception:
+            logging.getLogger('topic_modelling').exception('Warm-up failed')
+    thread = threading.Thread(target=warm_up, name='warm_up', daemon=True)
+    if os.getenv('APP_WARM_UP', '1') != '0':
+        thread.start()
+    return thread
+
+
+start_warm_up()
+client = es_client()
 
 
 def topic_insertion():
+    d_topic_to_id, d_id_to_topic, topics, tks = load_topics()
     st.session_state.reset = False
 
     data = {}
@@ -153,20 +192,48 @@ def topic_insertion():
     st.button("Add Labelled Sentence", on_click=add_sentence,type='primary')    
     if st.session_state.num_fields_sentences > 0:
         st.button("Delete Sentence", on_click=remove_sentence)
+
+    #Similar existing sentences
+    st.write('#####')
+    with st.expander('Similar Existing Sentences'):
+        st.write('Find the already labelled sentences in the database that are most similar to the labelled sentences entered above.')
+        seed_texts = [sentence['sentence_text'] for sentence in data['labelled_sentences'] if sentence['sentence_text']]
+        if st.button('Find Similar Sentences', disabled=not seed_texts):
+            for seed_text, similar in zip(seed_texts, similar_sentences(client, seed_texts)):
+                st.write(f'**{seed_text}**')
+                for sentence in similar:
+                    st.write(f"{sentence['similarity']:.2f}: {sentence['sentence_text']}")
     
     data['n_new_sentences'] = st.selectbox('Number of sentences to generate', [5,10,20], index=0,key='n_new_sentences')
     data['n_gpt_suggestions'] = st.selectbox('Number of sentences in optimised suggestion', list(range(1,11)),index=4,key='n_gpt_suggestions')
 
     #Save Data
     def save_data():
-        with st.spinner('Your input is being processed. This should only take a few moments.'):
-            from src.user_input_maximisation import input_maximised
-            new = input_maximised(3, data['n_new_sentences'], data['n_gpt_suggestions'], data['topic_name'], data['topic_definition'], data['keywords'], data['name_variations'], data['difficult_cases'], data['labelled_sentences'])
-            for k, v in new.items():
-                data[k] = v
-            st.session_state.data_variable = data
-        st.write('Press "Confirm Save" Again')
-        st.session_state.page = 'customisation'
+        arguments = {'n_kw_nv_dc':3, 'n_new_sentences':data['n_new_sentences'], 'n_gpt_suggestions':data['n_gpt_suggestions'], 'topic_name':data['topic_name'], 'topic_definition':data['topic_definition'], 'keywords':data['keywords'], 'name_variations':data['name_variations'], 'difficult_cases':data['difficult_cases'], 'labelled_sentences':data['labelled_sentences'], 'corpus_index_path':CORPUS_INDEX_PATH}
+        with gpt_context(session=get_script_run_ctx().session_id, priority='interactive'):
+            st.session_state.job_id = submit_job('src.user_input_maximisation:input_maximised', arguments, metadata=data, regenerate=st.session_state.get('regenerate', False))
+        st.query_params['job'] = st.session_state.job_id
+        st.session_state.show_save_confirmation = False
+        st.rerun()
+
+    #Processing of a submitted topic runs in the background; poll it until done, also after a page refresh (the job id is kept in the url)
+    if 'job_id' in st.session_state:
+        job = job_status(st.session_state.job_id)
+        if job is None or job['status'] == 'failed':
+            st.error('Processing of the topic failed. Please try again.')
+            del st.session_state['job_id']
+            st.query_params.clear()
+        elif job['status'] == 'done':
+            #the result itself stays in the process-wide result store; the session only keeps the job id
+            st.session_state.result_id = st.session_state.job_id
+            st.session_state.last_traces = {'Topic processing': job['trace']}
+            st.session_state.page = 'customisation'
+            st.rerun()
+        else:
+            resume_job(st.session_state.job_id)
+            with st.spinner('Your input is being processed. This should only take a few moments.'):
+                time.sleep(2)
+            st.rerun()
 
     if 'show_save_confirmation' not in st.session_state:
         st.session_state.show_save_confirmation = False
@@ -178,6 +245,7 @@ def topic_insertion():
         st.session_state.show_save_confirmation = False
 
     st.write('#####')
+    st.checkbox('Regenerate', key='regenerate', help='By default, an input that was processed before opens its earlier results. Tick to generate new sentences and suggestions instead.')
     st.button('Save', on_click=confirm_save)
 
     if st.session_state.show_save_confirmation:
@@ -192,9 +260,14 @@ def topic_insertion():
                     pass
 
 
-def existing_sentence_database():
+@st.cache_data(ttl=600, show_spinner=False)
+def sentence_database():
+    #shared by all sessions: the join over all labelled sentences is read again at most every ten minutes, or when a topic is saved
+    import pandas as pd
+    d_topic_to_id, d_id_to_topic, topics, tks = load_topics()
+
     #Access sentences with labels
-    l_from_join = join_sl_and_los(client)
+    l_from_join = join_sl_and_los(es_client())
     ls = []
     for dictionary in l_from_join:
         ls.append({'sentence_text':dictionary['sentence_text'],'topics':sorted([d_id_to_topic[tid] for tid in dictionary['topic_id']])})
@@ -216,6 +289,70 @@ def existing_sentence_database():
     columns.extend(topics)
     columns.append('Topics')
     df = pd.DataFrame(data,columns=columns)
+
+    #Labelled Sentences Per Topic, aggregated here once, so that reruns only pass these counts to the chart
+    column_sums = df[topics].sum(axis=0)
+    counts = [{'topic':t, 'count':int(c)} for t, c in zip(topics, column_sums)]
+    return df, topics, counts
+
+
+def sentence_count_chart(counts):
+    #a native Vega-Lite chart, drawn in the browser from the counts: no figure is rendered on the server, and a rerun with unchanged counts sends an identical element, which is not redrawn
+    return {
+        'data': {'values': counts},
+        'title': 'Number of Labelled Sentences Per Topic',
+        'mark': {'type': 'bar', 'color': '#cccccc', 'stroke': 'black', 'width': {'band': 0.5}},
+        'encoding': {
+            'x': {'field': 'topic', 'type': 'nominal', 'sort': None, 'axis': {'title': None, 'labelAngle': -90, 'labelFontSize': 6}},
+            'y': {'field': 'count', 'type': 'quantitative', 'axis': {'title': 'Sentence Count'}}
+        },
+        'config': {'view': {'stroke': None}}
+    }
+
+
+def silhouette_chart(curve, threshold):
+    #the silhouette score of the clustering at each threshold, with the chosen threshold marked
+    return {
+        'layer': [
+            {
+                'data': {'values': curve},
+                'mark': {'type': 'line', 'point': True, 'color': 'black'},
+                'encoding': {
+                    'x': {'field': 'threshold', 'type': 'quantitative', 'scale': {'domain': [0, 2]}, 'axis': {'title': 'Distance Threshold'}},
+                    'y': {'field': 'silhouette', 'type': 'quantitative', 'axis': {'title': 'Silhouette Score'}},
+                    'tooltip': [{'field': 'threshold', 'format': '.2f'}, {'field': 'n_clusters', 'title': 'clusters'}, {'field': 'silhouette', 'format': '.3f'}]
+                }
+            },
+            {
+                'data': {'values': [{'threshold': threshold}]},
+                'mark': {'type': 'rule', 'color': 'red'},
+                'encoding': {'x': {'field': 'threshold', 'type': 'quantitative'}}
+            }
+        ],
+        'height': 200,
+        'config': {'view': {'stroke': None}}
+    }
+
+
+#the session state of the customisation pages, all of which belongs to one processed topic
+CUSTOMISATION_STATE = {
+    'result_id', 'selected_sentences', 'sentence_selection_table', 'cluster_suggestion', 'cluster_hierarchy',
+    'selected_keywords', 'selected_name_variations', 'selected_difficult_cases', 'current_keywords', 'current_name_variations', 'current_difficult_cases',
+    'keywords_multiselect', 'name_variations_multiselect', 'difficult_cases_multiselect', 'prompt_choice', 'current_prompt_choice', 'prompted_choice', 'show_save_confirmation2'
+}
+
+
+def cluster_hierarchy(result_id, sentences):
+    #built once per session and processed topic (the embeddings come from the process-wide cache), so that moving a threshold only cuts the hierarchy again
+    if st.session_state.get('cluster_hierarchy', (None,))[0] != result_id:
+        from src.cluster_sentences import yes_no_cluster_hierarchy
+        with st.spinner('Clustering sentences...'):
+            st.session_state.cluster_hierarchy = (result_id, yes_no_cluster_hierarchy(sentences))
+    return st.session_state.cluster_hierarchy[1]
+
+
+def existing_sentence_database():
+    df, topics, counts = sentence_database()
     st.title('Existing Topics and Sentences')
     selected_topics = st.sidebar.multiselect('Select Topics', topics)
 
@@ -233,18 +370,44 @@ def existing_sentence_database():
     st.dataframe(filtered_data[['Sentence', 'Topics']].reset_index(drop=True))
 
     #Plot Labelled Sentences Per Topic
-    df_plot = df[topics]
-    column_sums = df_plot.sum(axis=0)
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-    ax.bar(topics, column_sums,width=0.5,color='0.8', edgecolor='black')
-    ax.spines['top'].set_visible(False)
-    ax.spines['right'].set_visible(False)
-    ax.set(ylabel='Sentence Count',title='Number of Labelled Sentences Per Topic')
-    plt.xticks(rotation=90,fontsize=6)
-    plt.subplots_adjust(bottom=0.45)
-    plt.tight_layout()
-    st.pyplot(fig)
+    st.vega_lite_chart(sentence_count_chart(counts), use_container_width=True)
+
+
+@st.cache_data(ttl=600, show_spinner='Ranking sentences...')
+def labelling_queue(k, n_indexed):
+    #shared by all sessions: one training and ranking run covers every topic; cleared when a topic is saved. n_indexed, the size of the corpus index, is only
+    #part of the cache key, so that the queue is ranked again once a background update of the index has finished
+    from src.active_learning import next_sentences_to_label
+    return next_sentences_to_label(es_client(), k=k, update_index=False)
+
+
+def refresh_corpus_index():
+    #submits a job bringing the corpus index up to date if it lacks sentences (e.g. on first use, when there is none yet), rather than building it on the page view;
+    #returns the number of sentences in the index and whether it is being updated
+    from src.vector_index import load_corpus_index, sentence_count
+    n_sentences = sentence_count(client)
+    index = load_corpus_index(CORPUS_INDEX_PATH)
+    n_indexed = len(index) if index is not None else 0
+    if n_indexed >= n_sentences:
+        return n_indexed, False
+    submit_job('src.vector_index:refresh_corpus_index', {'corpus_index_path': CORPUS_INDEX_PATH, 'n_sentences': n_sentences})
+    return n_indexed, True
+
+
+def next_sentences_to_label_page():
+    d_topic_to_id, d_id_to_topic, topics, tks = load_topics()
+    st.title('Next Sentences to Label')
+    st.write('For each topic, the unlabelled sentences its classifier is least sure about, picked to be unlike each other and unlike the sentences already labelled for the topic. Labelling these first teaches the classifier the most.')
+    topic = st.selectbox('Topic', topics)
+    k = st.select_slider('Number of sentences', options=[10, 20, 50], value=20)
+    n_indexed, updating = refresh_corpus_index()
+    if updating:
+        st.info('The sentence embeddings are being brought up to date in the background. Sentences added since the last update are not suggested yet.')
+    queue = labelling_queue(k, n_indexed).get(d_topic_to_id.get(topic), [])
+    if not queue:
+        st.info('No sentences to suggest for this topic yet.')
+        return
+    st.dataframe([{'Sentence': row['sentence_text'], 'P(Yes)': round(row['probability'], 2), 'Uncertainty': round(row['uncertainty'], 2)} for row in queue], hide_index=True, use_container_width=True)
 
 
 def example_topic_entry():
@@ -289,6 +452,19 @@ def example_topic_entry():
 """)
 
 
+def debug_panel():
+    #where the time of this session's last topic processing and save went, per stage (see src/instrumentation.py)
+    if not st.session_state.get('last_traces'):
+        return
+    with st.sidebar.expander('Debug: last run'):
+        for name, last_trace in st.session_state.last_traces.items():
+            if last_trace is None:
+                continue
+            st.markdown(f'**{name}**')
+            st.dataframe(summarise(last_trace), hide_index=True)
+            st.json(last_trace['counters'], expanded=False)
+
+
 #Password Verification
 def verify_password(input_password, stored_hashed_password):
     return hashlib.sha256(input_password.encode()).hexdigest() == stored_hashed_password
@@ -309,25 +485,44 @@ else:
     if 'page' not in st.session_state:
         st.session_state.page = 'main_page'
     
+    if 'job' in st.query_params and 'job_id' not in st.session_state and st.session_state.page == 'main_page':
+        st.session_state.job_id = st.query_params['job']
+
     if st.session_state.page == 'main_page':
         selection = 'Existing Sentence Database'
 
         st.sidebar.title('Navigation')
-        options = ['Existing Sentence Database', 'Example Topic Entry', 'Topic Insertion']
-        selection = st.sidebar.radio("Go to", options)
-        if selection == 'Topic Insertion':
-            topic_insertion()
-        elif selection == 'Existing Sentence Database':
-            existing_sentence_database()
-        elif selection == 'Example Topic Entry':
-            example_topic_entry()
+        options = ['Existing Sentence Database', 'Example Topic Entry', 'Topic Insertion', 'Next Sentences to Label']
+        selection = st.sidebar.radio("Go to", options, index=options.index('Topic Insertion') if 'job_id' in st.session_state else 0)
+        #one request scope per render, so that the reads of a page are not repeated against Elasticsearch
+        with request_scope():
+            if selection == 'Topic Insertion':
+                topic_insertion()
+            elif selection == 'Existing Sentence Database':
+                existing_sentence_database()
+            elif selection == 'Example Topic Entry':
+                example_topic_entry()
+            elif selection == 'Next Sentences to Label':
+                next_sentences_to_label_page()
     
     elif st.session_state.page == 'customisation':
         selection = 'Configuration Start'
-        data = st.session_state.data_variable
-
+        data = get_result(st.session_state.result_id, get_script_run_ctx().session_id)
+        if data is None:
+            st.error('The processed topic is no longer available. Please submit it again.')
+            st.session_state.page = 'main_page'
+            st.session_state.pop('job_id', None)
+            #the selections made for the unavailable topic would otherwise carry over to the next one
+            for key in [key for key in st.session_state if key in CUSTOMISATION_STATE or key.startswith('cluster_threshold_')]:
+                del st.session_state[key]
+            st.query_params.clear()
+            st.button('Back')
+            st.stop()
+        all_sentences = data['labelled_sentences'] + data['gpt_sentences']
+
+        #selected sentences, as positions in all_sentences
         if "selected_sentences" not in st.session_state:
-            st.session_state.selected_sentences = []
+            st.session_state.selected_sentences = set()
 
         st.sidebar.title('Navigation')
         options = ['Configuration Start', 'Keywords', 'Name Variations', 'Difficult Cases', 'Browse and Select Sentences', 'Sentence Suggestions', 'Confirmation']
@@ -346,17 +541,12 @@ else:
         if selection != "Difficult Cases" and 'current_difficult_cases' in st.session_state:
             st.session_state.selected_difficult_cases = st.session_state.current_difficult_cases
 
-        prompt_choice_options = ['GPT Suggestion', 'Cluster Suggestion', 'Selected Sentences']
+        prompt_choice_options = ['GPT Suggestion', 'Cluster Suggestion', 'Embedding Suggestion', 'Selected Sentences']
         if 'prompt_choice' not in st.session_state:
             st.session_state.prompt_choice = 'Selected Sentences'
         if selection != 'Sentence Suggestions' and 'current_prompt_choice' in st.session_state:
             st.session_state.prompt_choice = st.session_state.current_prompt_choice
         
-        for i, sentence in enumerate(data['labelled_sentences'] + data['gpt_sentences'],start=1):
-            key = f'sentence_{i}'
-            if key not in st.session_state:
-                st.session_state[key] = False
-
 
         if selection == 'Configuration Start':
             st.title('Topic Optimisation')
@@ -385,29 +575,27 @@ else:
                 st.write(w)
         elif selection == 'Browse and Select Sentences':
             st.title('Browsing and Conditional Sentence Selection')
-            st.write('Below are the input sentences and the GPT-generated sentences. In no particular order. On the next page are two suggestions for groups of sentences for the prompt. Look through the sentences below, familiarise, and then consider these suggestions. If neither one is satisfactory, return here and select the sentences you desire. Note that if sentences are selected here while one of the suggestions is also selected, the suggestion takes precedence.')
-            for i, sentence in enumerate(data['labelled_sentences'] + data['gpt_sentences'],start=1):
-                st.write(f'Sentence {i}')
-                key = f'sentence_{i}'
-                message = f"**Sentence Text:**  \n{sentence['sentence_text']}  \n**Label:** {sentence['label']}  \n**Explanation:**  \n{sentence['explanation']}"
-                if st.session_state[key]:
-                    st.success(message)
-                    if sentence not in st.session_state.selected_sentences:
-                        st.session_state.selected_sentences.append(sentence)                        
-                else:
-                    st.error(message)
-                    if sentence in st.session_state.selected_sentences:
-                        st.session_state.selected_sentences.remove(sentence)
-
-                col1, col2 = st.columns(2)
-                def select_sentence(key):
-                    st.session_state[key] = True
-                def unselect_sentence(key):
-                    st.session_state[key] = False
-                with col1:
-                    st.button('Select',on_click=select_sentence, args=(key,),key=f'succes_{key}')
-                with col2:
-                    st.button('Unselect',on_click=unselect_sentence, args=(key,),key=f'error_{key}')
+            st.write('Below are the input sentences and the GPT-generated sentences. In no particular order. On the next page are three suggestions for groups of sentences for the prompt. Look through the sentences below, familiarise, and then consider these suggestions. If none of them is satisfactory, return here and tick the sentences you desire, then click Apply Selection. Note that if sentences are selected here while one of the suggestions is also selected, the suggestion takes precedence.')
+            #one table widget, however many sentences there are; ticking does not rerun the page, the selection is applied in one go when the form is submitted
+            table = [{'Selected':i in st.session_state.selected_sentences, 'Sentence':i + 1, 'Sentence Text':sentence['sentence_text'], 'Label':sentence['label'], 'Explanation':sentence['explanation']} for i, sentence in enumerate(all_sentences)]
+            with st.form('sentence_selection'):
+                edited_table = st.data_editor(
+                    table,
+                    column_config={
+                        'Selected': st.column_config.CheckboxColumn('Select', default=False),
+                        'Sentence': st.column_config.NumberColumn('Sentence', width='small'),
+                        'Sentence Text': st.column_config.TextColumn('Sentence Text', width='large'),
+                        'Label': st.column_config.TextColumn('Label', width='small'),
+                        'Explanation': st.column_config.TextColumn('Explanation', width='large')
+                    },
+                    disabled=['Sentence', 'Sentence Text', 'Label', 'Explanation'],
+                    hide_index=True,
+                    use_container_width=True,
+                    key='sentence_selection_table'
+                )
+                if st.form_submit_button('Apply Selection'):
+                    st.session_state.selected_sentences = {i for i, row in enumerate(edited_table) if row['Selected']}
+            st.write(f'{len(st.session_state.selected_sentences)} of {len(all_sentences)} sentences selected')
 
         elif selection == 'Sentence Suggestions':
             st.session_state.current_prompt_choice = st.sidebar.selectbox("Choice",prompt_choice_options,index=prompt_choice_options.index(st.session_state.prompt_choice), key='prompted_choice')
@@ -420,7 +608,29 @@ else:
             
             st.header('Clustering Suggestion')
             st.subheader('Derived by clustering all sentences and selecting one sentence from each cluster. Yes and No automatically creates two main clusters, so within each cluster we cluster again by sentence text and explanation.')
-            for i, sentence in enumerate(data['cluster_suggestion'],start=1):
+            from src.cluster_sentences import hierarchy_representatives
+            st.write('The distance threshold sets how fine the clusters are: a lower threshold gives more, smaller clusters, and so more sentences. It starts at the clusters found when the topic was processed, at the threshold with the highest silhouette score.')
+            cluster_suggestion = []
+            for group in cluster_hierarchy(st.session_state.result_id, all_sentences):
+                #the clusters of the processing job until the threshold is moved: they may keep clusters from an earlier run of the same seed (see src/cluster_sentences.py)
+                job_representatives = [sentence for sentence in data['cluster_suggestion'] if (sentence['label'] == 'Yes') == (group['label'] == 'Yes')]
+                if group['linkage'] is None:
+                    cluster_suggestion.extend(job_representatives)
+                    continue
+                threshold = st.slider(f"{group['label']} sentences: distance threshold", 0.0, 2.0, value=group['threshold'], step=0.01, key=f"cluster_threshold_{st.session_state.result_id}_{group['label']}")
+                representatives = hierarchy_representatives(group, threshold) if abs(threshold - group['threshold']) > 1e-6 else job_representatives
+                st.caption(f"{len(representatives)} clusters of {len(group['sentences'])} {group['label']} sentences")
+                st.vega_lite_chart(silhouette_chart(group['curve'], threshold), use_container_width=True)
+                cluster_suggestion.extend(representatives)
+            #kept with the result it belongs to, so that a suggestion of an earlier topic in the session is never confirmed for this one
+            st.session_state.cluster_suggestion = (st.session_state.result_id, cluster_suggestion)
+            for i, sentence in enumerate(cluster_suggestion,start=1):
+                st.write(rf"$\textsf{{\large Sentence {i}}}$")
+                st.write( f"**Sentence Text:**  \n{sentence['sentence_text']}  \n**Label:** {sentence['label']}  \n**Explanation:**  \n{sentence['explanation']}")
+
+            st.header('Embedding Suggestion')
+            st.subheader(f"Derived locally from the sentence embeddings: the {data['n_gpt_suggestions']} sentences that are most spread out from each other, balanced between Yes and No.")
+            for i, sentence in enumerate(data.get('embedding_suggestion', []),start=1):
                 st.write(rf"$\textsf{{\large Sentence {i}}}$")
                 st.write( f"**Sentence Text:**  \n{sentence['sentence_text']}  \n**Label:** {sentence['label']}  \n**Explanation:**  \n{sentence['explanation']}")
         elif selection == 'Confirmation':
@@ -439,16 +649,20 @@ else:
             if st.session_state.prompt_choice == 'GPT Suggestion':
                 sentences = data['gpt_suggestion']
             elif st.session_state.prompt_choice == 'Cluster Suggestion':
-                sentences = data['cluster_suggestion']
+                #the clusters at the thresholds chosen on the Sentence Suggestions page, if it was visited for this topic
+                result_id, cluster_suggestion = st.session_state.get('cluster_suggestion', (None, None))
+                sentences = cluster_suggestion if result_id == st.session_state.result_id else data['cluster_suggestion']
+            elif st.session_state.prompt_choice == 'Embedding Suggestion':
+                sentences = data.get('embedding_suggestion', [])
             else:
-                sentences = st.session_state.selected_sentences
+                sentences = [all_sentences[i] for i in sorted(st.session_state.selected_sentences)]
             for i, sentence in enumerate(sentences,start=1):
                 st.write(f"Sentence {i}\nSentence Text: {sentence['sentence_text']}\nLabel: {sentence['label']}\nExplanation: {sentence['explanation']}")
 
 
             #Save Data
             def reset_state(keep_authenticated=True):
-                keys_to_preserve = {'authenticated'} if keep_authenticated else set()
+                keys_to_preserve = {'authenticated', 'last_traces'} if keep_authenticated else set()
                 
                 for key in list(st.session_state.keys()):
                     if key not in keys_to_preserve:
@@ -458,27 +672,33 @@ else:
 
                 labeller_id = '0kgu5o0Bzhy8p2ulxOM5'
 
-                #create topic id for new topic
-                i = 40
-                while True:
-                    if f'c{i}' not in tids:
-                        id = f'c{i}'
-                        break
-                    i += 1
-
-                t = 'topic' if data['parent_topic_id'] == 'none0' else 'subtopic'
-                
-                insert_document(client, 'topic_entity',{'id':id,'name':data['topic_name'], 'type':t,'parent_topic_id':data['parent_topic'],'labeller_id':labeller_id})
-                insert_document(client, 'topic_entity_definition',{'topic_id':id,'name':data['topic_name'],'definition':data['topic_definition'],'language':data['language'],'status':'Draft','keyword':st.session_state.selected_keywords,'name_variation':st.session_state.selected_name_variations,'difficult_case':st.session_state.selected_difficult_cases})
-                for sentence in sentences:
-                    insert_document(client, 'labelled_sentence',{'sentence_text':sentence['sentence_text'],'translated':False,'generated':False,'parent_sentence_id':'none0'})
-                client.indices.refresh(index='labelled_sentence')
-                label_confidence_dict = {"Yes": 1, "No": 0}
-                for sentence in data['prompt_choice']:
-                    sentence_id = search_document(client, 'labelled_sentence',{'sentence_text':sentence['sentence_text']},all=True)[0]['_id']
-                    insert_document(client, 'sentence_label', {'labeller_id':labeller_id,'sentence_id':sentence_id,'topic_id':id,'position_in_text':-1,'confidence':label_confidence_dict[sentence['label']],'explanation':sentence['explanation']})
+                with trace('confirm save') as save_trace, request_scope():
+                    with span('insert topic'):
+                        #create topic id for new topic
+                        id = allocate_topic_id(client)
+
+                        t = 'Topic' if data['parent_topic_id'] == 'none0' else 'Subtopic'
+                        
+                        insert_document(client, 'topic_entity',{'id':id,'name':data['topic_name'], 'type':t,'parent_topic_id':data['parent_topic_id'],'labeller_id':labeller_id})
+                        insert_document(client, 'topic_entity_definition',{'topic_id':id,'name':data['topic_name'],'definition':data['topic_definition'],'language':data['language'],'status':'Draft','keyword':st.session_state.selected_keywords,'name_variation':st.session_state.selected_name_variations,'difficult_case':st.session_state.selected_difficult_cases})
+                    label_confidence_dict = {"Yes": 1, "No": 0}
+                    sentence_ids = []
+                    with span('insert sentences', n_sentences=len(sentences)):
+                        for sentence in sentences:
+                            sentence_id = insert_sentence(client, {'sentence_text':sentence['sentence_text'],'translated':False,'generated':False,'parent_sentence_id':'none0'})
+                            insert_document(client, 'sentence_label', {'labeller_id':labeller_id,'sentence_id':sentence_id,'topic_id':id,'position_in_text':-1,'confidence':label_confidence_dict[sentence['label']],'explanation':sentence['explanation']})
+                            sentence_ids.append(sentence_id)
+                    #the sentences are embedded (for kNN search and the corpus index) in the background, rather than before the save returns
+                    saved = dict(zip(sentence_ids, [sentence['sentence_text'] for sentence in sentences]))
+                    submit_job('src.vector_index:embed_saved_sentences', {'sentence_ids': list(saved), 'sentence_texts': list(saved.values()), 'corpus_index_path': CORPUS_INDEX_PATH})
                 
+                load_topics.clear()
+                sentence_database.clear()
+                labelling_queue.clear()
+                st.session_state.last_traces = {**st.session_state.get('last_traces', {}), 'Confirm save': export_trace(save_trace)}
                 reset_state()
+                release_session(get_script_run_ctx().session_id)
+                st.query_params.clear()
                 st.session_state.reset = True
                 st.rerun()
 
@@ -505,4 +725,5 @@ else:
                             save_data()
                     with col2:
                         if st.button('Cancel', on_click=cancel_save):
-                            pass
\ No newline at end of file
+                            pass
+    debug_panel()
@@ -0,0 +1,166 @@
+from elasticsearch import Elasticsearch
+import numpy as np
+import os
+import threading
+from dotenv import load_dotenv
+from src.instrumentation import span, count, timed
+from src.utils import create_es_client, search_document, search_documents_by
+from src.vector_index import load_corpus_index, update_corpus_index, sentence_count
+
+#Which sentences to label next, per topic. One logistic regression per topic on the all-mpnet-base-v2 embeddings of the corpus index, all topics trained
+#together: the weights of every topic are the columns of one matrix, so a gradient step (and the scoring of the whole pool) is a single matrix product.
+#The weights are saved after training and used as the starting point of the next, which then needs only a few steps for the labels added since.
+#The unlabelled sentences of a topic are ranked by uncertainty (probability near 0.5), and picked greedily among the most uncertain so that each pick
+#is also far from the topic's labelled sentences and from the earlier picks (k-center), rather than k near-copies of one uncertain sentence.
+MODEL_PATH = os.path.realpath('active_learning_model.npz')
+L2 = 1e-3
+LEARNING_RATE = 4.0
+SCORE_CHUNK_SIZE = 50000
+
+_model_lock = threading.Lock()
+
+def sigmoid(z):
+    return 1 / (1 + np.exp(-np.clip(z, -30, 30)))
+
+def label_matrix(labels, sentence_ids, topic_ids):
+    #the positions of the labelled sentences, their targets (labelled sentences x topics, 1 for 'Yes') and a mask of which pairs are labelled;
+    #a pair labelled more than once takes the mean confidence. Only labelled sentences get a row, as most of the corpus is unlabelled
+    positions = {id: i for i, id in enumerate(sentence_ids)}
+    columns = {id: j for j, id in enumerate(topic_ids)}
+    labels = [(positions[l['sentence_id']], columns[l['topic_id']], l['confidence']) for l in labels if l['sentence_id'] in positions and l['topic_id'] in columns]
+    rows = np.array(sorted({i for i, _, _ in labels}), dtype=np.int64)
+    row_of = {i: r for r, i in enumerate(rows.tolist())}
+    totals = np.zeros((len(rows), len(topic_ids)), dtype=np.float32)
+    counts = np.zeros_like(totals)
+    for i, j, confidence in labels:
+        totals[row_of[i], j] += confidence
+        counts[row_of[i], j] += 1
+    mask = counts > 0
+    targets = np.where(mask, totals / np.maximum(counts, 1), 0) >= 0.5
+    return rows, targets.astype(np.float32), mask
+
+def load_model(path=MODEL_PATH):
+    if not os.path.exists(path):
+        return None
+    data = np.load(path)
+    return {'topic_ids': data['topic_ids'].tolist(), 'weights': data['weights'], 'bias': data['bias']}
+
+def save_model(model, path=MODEL_PATH):
+    #write to a temporary file first, so that a reader never sees a half-written model
+    temporary_path = f'{path}.tmp.npz'
+    np.savez(temporary_path, topic_ids=np.array(model['topic_ids'], dtype=str), weights=model['weights'], bias=model['bias'])
+    os.replace(temporary_path, path)
+
+def warm_start(model, topic_ids, dimension):
+    #weights of an earlier model for the topics it knows, zero for new topics (or for all, if the embedding dimension has changed)
+    weights = np.zeros((dimension, len(topic_ids)), dtype=np.float32)
+    bias = np.zeros(len(topic_ids), dtype=np.float32)
+    if model is not None and model['weights'].shape[0] == dimension:
+        known = {id: j for j, id in enumerate(model['topic_ids'])}
+        for j, id in enumerate(topic_ids):
+            if id in known:
+                weights[:, j] = model['weights'][:, known[id]]
+                bias[j] = model['bias'][known[id]]
+    return weights, bias
+
+@timed('train classifiers')
+def train(x, y, mask, weights, bias, max_iterations=200, tolerance=1e-4, learning_rate=LEARNING_RATE, l2=L2):
+    #full-batch gradient descent on the mean logistic loss of each topic over its own labelled sentences, for all topics at once
+    m = mask.astype(np.float32)
+    n_labels = np.maximum(m.sum(axis=0), 1)
+    for iteration in range(max_iterations):
+        error = m * (sigmoid(x @ weights + bias) - y) / n_labels
+        weight_gradient = x.T @ error + l2 * weights
+        bias_gradient = error.sum(axis=0)
+        weights -= learning_rate * weight_gradient
+        bias -= learning_rate * bias_gradient
+        if np.abs(weight_gradient).max() < tolerance and np.abs(bias_gradient).max() < tolerance:
+            break
+    count('classifier iterations', iteration + 1)
+    return weights, bias
+
+def uncertain_pool(embeddings, rows, mask, weights, bias, pool_size):
+    #per topic, the pool_size most uncertain unlabelled sentences, with their probabilities; the pool is scored a chunk of rows at a time, each chunk in one product for all topics
+    n_topics = weights.shape[1]
+    pool = [np.empty(0, dtype=np.int64)] * n_topics
+    pool_uncertainty = [np.empty(0, dtype=np.float32)] * n_topics
+    pool_probability = [np.empty(0, dtype=np.float32)] * n_topics
+    for start in range(0, len(embeddings), SCORE_CHUNK_SIZE):
+        probability = sigmoid(embeddings[start:start + SCORE_CHUNK_SIZE] @ weights + bias)
+        chunk_mask = np.zeros(probability.shape, dtype=bool)
+        in_chunk = (rows >= start) & (rows < start + len(probability))
+        chunk_mask[rows[in_chunk] - start] = mask[in_chunk]
+        uncertainty = np.where(chunk_mask, -1, 1 - np.abs(2 * probability - 1))
+        for j in range(n_topics):
+            positions = np.concatenate((pool[j], start + np.arange(len(probability))))
+            u = np.concatenate((pool_uncertainty[j], uncertainty[:, j]))
+            p = np.concatenate((pool_probability[j], probability[:, j]))
+            keep = np.argpartition(-u, pool_size)[:pool_size] if len(u) > pool_size else np.arange(len(u))
+            keep = keep[u[keep] >= 0]
+            pool[j], pool_uncertainty[j], pool_probability[j] = positions[keep], u[keep], p[keep]
+    return pool, pool_uncertainty, pool_probability
+
+def diverse_selection(embeddings, candidates, uncertainty, reference, k):
+    #greedy k-center weighted by uncertainty: each pick maximises uncertainty times cosine distance to the nearest reference (labelled) sentence or earlier pick
+    if len(candidates) == 0:
+        return []
+    distance = np.ones(len(candidates), dtype=np.float32)
+    if len(reference):
+        distance = 1 - (embeddings[candidates] @ embeddings[reference].T).max(axis=1)
+    selected = []
+    for _ in range(min(k, len(candidates))):
+        i = int(np.argmax(uncertainty * np.maximum(distance, 0)))
+        if uncertainty[i] * distance[i] <= 0:
+            break
+        selected.append(i)
+        distance = np.minimum(distance, 1 - embeddings[candidates] @ embeddings[candidates[i]])
+        distance[i] = 0
+    return selected
+
+def rank_sentences(embeddings, sentence_ids, rows, mask, weights, bias, k=20, pool_factor=10):
+    #per topic, up to k unlabelled sentences to label next, as dictionaries with 'sentence_id', 'probability' (of 'Yes') and 'uncertainty'
+    pool, pool_uncertainty, pool_probability = uncertain_pool(embeddings, rows, mask, weights, bias, k * pool_factor)
+    queues = []
+    for j in range(weights.shape[1]):
+        reference = rows[mask[:, j]]
+        selected = diverse_selection(embeddings, pool[j], pool_uncertainty[j], reference, k)
+        queues.append([{'sentence_id': sentence_ids[pool[j][i]], 'probability': float(pool_probability[j][i]), 'uncertainty': float(pool_uncertainty[j][i])} for i in selected])
+    return queues
+
+def next_sentences_to_label(client: Elasticsearch, topic_ids=None, k=20, path=MODEL_PATH, update_index=True):
+    #trains (warm-started) on every label in sentence_label and returns, per topic id, the k sentences to label next, with their texts. The corpus index is first
+    #brought up to date if it lacks sentences of labelled_sentence, unless update_index is False: the app updates it in a background job instead (see main.py)
+    index = load_corpus_index()
+    if update_index and (index is None or sentence_count(client) > len(index)):
+        index = update_corpus_index(client)
+    if index is None or len(index) == 0:
+        return {}
+    embeddings, sentence_ids = index.vectors[:index.size], index.ids
+    topic_ids = list(topic_ids) if topic_ids else sorted({t['id'] for t in search_document(client, 'topic_entity', {})})
+    rows, targets, mask = label_matrix(search_document(client, 'sentence_label', {'topic_id': topic_ids}), sentence_ids, topic_ids)
+    with _model_lock:
+        previous = load_model(path)
+        weights, bias = warm_start(previous, topic_ids, embeddings.shape[1])
+        weights, bias = train(embeddings[rows], targets, mask, weights, bias)
+        #the saved model keeps the topics of the earlier one that were not trained this time
+        kept = [j for j, id in enumerate(previous['topic_ids']) if id not in set(topic_ids)] if previous is not None and previous['weights'].shape[0] == embeddings.shape[1] else []
+        if kept:
+            save_model({'topic_ids': topic_ids + [previous['topic_ids'][j] for j in kept], 'weights': np.concatenate((weights, previous['weights'][:, kept]), axis=1), 'bias': np.concatenate((bias, previous['bias'][kept]))}, path)
+        else:
+            save_model({'topic_ids': topic_ids, 'weights': weights, 'bias': bias}, path)
+    with span('rank sentences', n_topics=len(topic_ids)):
+        queues = rank_sentences(embeddings, sentence_ids, rows, mask, weights, bias, k)
+    ids = sorted({row['sentence_id'] for queue in queues for row in queue})
+    texts = {id: d[0]['_source']['sentence_text'] for id, d in search_documents_by(client, 'labelled_sentence', '_id', ids, all=True, source_excludes=('sentence_embedding',)).items() if d}
+    return {topic_id: [{**row, 'sentence_text': texts[row['sentence_id']]} for row in queue if row['sentence_id'] in texts] for topic_id, queue in zip(topic_ids, queues)}
+
+if __name__ == "__main__":
+    load_dotenv('credentials.env')
+    ELASTIC_HOST=os.getenv('ELASTIC_HOST')
+    ELASTIC_USER=os.getenv('ELASTIC_USER')
+    ELASTIC_PASS=os.getenv('ELASTIC_PASS')
+    client = create_es_client(ELASTIC_HOST, ELASTIC_USER, ELASTIC_PASS)
+    for topic_id, queue in next_sentences_to_label(client, k=5).items():
+        print(topic_id)
+        for row in queue:
+            print(f"    {row['probability']:.2f} {row['sentence_text']}")
@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import contextvars
+import hashlib
+import json
+import os
+import re
+from dotenv import load_dotenv
+from src.cluster_sentences import encode
+from src.user_input_maximisation import generate_augmentations, texts_to_embed, suggest_sentences
+from src.vector_index import CORPUS_INDEX_PATH, load_corpus_index
+from src.gpt_scheduler import gpt_context
+
+def read_topic_specs(path):
+    #one topic per line in a .jsonl file, or a list of topics in a .yaml/.yml file; each topic has 'name', 'definition', and optionally 'keywords', 'name_variations', 'difficult_cases' and 'sentences' (dictionaries with 'sentence_text', 'label', 'explanation')
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            specs = yaml.safe_load(f)
+        else:
+            specs = [json.loads(line) for line in f if line.strip()]
+    return [{'keywords': [], 'name_variations': [], 'difficult_cases': [], 'sentences': [], **spec} for spec in specs]
+
+def topic_key(spec):
+    #file name of a topic's output: readable, and unique for the exact spec so that an edited spec is processed again
+    slug = re.sub(r'[^a-z0-9]+', '_', spec['name'].lower()).strip('_')
+    digest = hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    return f'{slug}_{digest}'
+
+def read_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_json(path, data):
+    #write to a temporary file first, so that an interrupted run never leaves a half-written output that would be taken as done
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(f'{path}.tmp', path)
+
+def augment_topics(gpt_key, specs, output_directory, n_kw_nv_dc=3, n_new_sentences=10, n_gpt_suggestions=5, max_concurrency=4, corpus_index_path=CORPUS_INDEX_PATH):
+    os.makedirs(output_directory, exist_ok=True)
+    todo = [spec for spec in specs if not os.path.exists(os.path.join(output_directory, f'{topic_key(spec)}.json'))]
+    print(f'{len(specs) - len(todo)} of {len(specs)} topics already done')
+
+    def augmentations_of(spec):
+        #GPT generation is the slow, paid step, so its output is kept separately and reused when a run is resumed
+        path = os.path.join(output_directory, f'{topic_key(spec)}.augmentations.json')
+        if os.path.exists(path):
+            return read_json(path)
+        augmentations = generate_augmentations(gpt_key, n_kw_nv_dc, n_new_sentences, spec['name'], spec['definition'], spec['keywords'], spec['name_variations'], spec['difficult_cases'], spec['sentences'])
+        write_json(path, augmentations)
+        return augmentations
+
+    def suggestions_of(spec, augmentations):
+        result = suggest_sentences(gpt_key, n_gpt_suggestions, spec['name'], spec['definition'], spec['keywords'], spec['name_variations'], spec['difficult_cases'], spec['sentences'], augmentations, corpus_index)
+        write_json(os.path.join(output_directory, f'{topic_key(spec)}.json'), {'spec': spec, **result})
+
+    #1: generation, with at most max_concurrency GPT calls in flight
+    augmentations = {}
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {executor.submit(contextvars.copy_context().run, augmentations_of, spec): topic_key(spec) for spec in todo}
+        for future in as_completed(futures):
+            try:
+                augmentations[futures[future]] = future.result()
+            except Exception as e:
+                print(f'{futures[future]}: generation failed: {e}')
+
+    #2: embed the texts of all topics in one batch, so that the per-topic processing below only hits the embedding cache
+    todo = [spec for spec in todo if topic_key(spec) in augmentations]
+    encode([text for spec in todo for text in texts_to_embed(augmentations[topic_key(spec)], spec['keywords'], spec['name_variations'], spec['difficult_cases'], spec['sentences'])])
+    corpus_index = load_corpus_index(corpus_index_path)
+
+    #3: deduplication, local suggestions and the GPT suggestion
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {executor.submit(contextvars.copy_context().run, suggestions_of, spec, augmentations[topic_key(spec)]): topic_key(spec) for spec in todo}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                print(f'{futures[future]}: done')
+            except Exception as e:
+                print(f'{futures[future]}: suggestion failed: {e}')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate keywords, name variations, difficult cases, sentences and sentence suggestions for many topics offline. Rerunning with the same output directory resumes: finished topics are skipped, and generated sentences are reused.')
+    parser.add_argument('topics', help='A .jsonl file with one topic per line, or a .yaml/.yml file with a list of topics.')
+    parser.add_argument('output_directory', help='Directory for one .json result per topic.')
+    parser.add_argument('--n-kw-nv-dc', type=int, default=3, help='Number of keyword/name variation/difficult case generations per topic.')
+    parser.add_argument('--n-new-sentences', type=int, default=10, help='Number of sentences to generate per topic.')
+    parser.add_argument('--n-gpt-suggestions', type=int, default=5, help='Number of sentences in each suggestion.')
+    parser.add_argument('--max-concurrency', type=int, default=4, help='Maximum number of topics processed, and so GPT calls made, at the same time.')
+    args = parser.parse_args()
+
+    load_dotenv('credentials.env')
+    GPT_TOPICS_KEY=os.getenv('GPT_TOPICS_KEY')
+
+    with gpt_context(session='batch_augmentation', priority='batch'):
+        augment_topics(GPT_TOPICS_KEY, read_topic_specs(args.topics), args.output_directory, args.n_kw_nv_dc, args.n_new_sentences, args.n_gpt_suggestions, args.max_concurrency)
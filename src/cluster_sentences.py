@@ -1,24 +1,77 @@
 from sentence_transformers import SentenceTransformer
-from sklearn.cluster import AgglomerativeClustering
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import pdist, squareform
 from sklearn.metrics import silhouette_score
 from sklearn.preprocessing import OneHotEncoder
 import numpy as np
+from functools import lru_cache
+from collections import OrderedDict
+import json
+import os
+import sys
+import threading
+from src.instrumentation import span, count, timed
 
+#the embedding cache is bounded by memory rather than by entries: an all-mpnet-base-v2 embedding takes 3KB, so the default holds about 20,000 sentences
+EMBEDDING_CACHE_BYTES = int(os.getenv('EMBEDDING_CACHE_MB', 64)) * 2**20
+CLUSTER_INDEX_CACHE_SIZE = 256
+#limits on the drift of a cluster index since its last full clustering, past which the next assignment clusters from scratch again
+MAX_ADDED_FRACTION = 0.5
+MAX_NEW_CLUSTER_FRACTION = 0.3
+MAX_DISTANCE_RATIO = 1.5
+#every cluster accepts new sentences at least within this percentile of the member-to-centroid distances of the full run
+RADIUS_PERCENTILE = 95
+THRESHOLDS = np.linspace(0, 2, 200)
+
+_embedding_cache = OrderedDict()
+_embedding_cache_bytes = 0
+_embedding_cache_lock = threading.Lock()
+_cluster_indices = OrderedDict()
+_cluster_indices_lock = threading.Lock()
+
+@lru_cache(maxsize=1)
 def load_embedder():
-    embedder = SentenceTransformer('all-mpnet-base-v2')
+    with span('load embedder'):
+        embedder = SentenceTransformer('all-mpnet-base-v2')
     return embedder
 
+def entry_bytes(text, embedding):
+    return sys.getsizeof(text) + embedding.nbytes
+
+def encode(texts):
+    #embeds texts through a process-wide least-recently-used cache: only texts not seen before are passed to the model, in one batch
+    global _embedding_cache_bytes
+    with _embedding_cache_lock:
+        embeddings = {text: _embedding_cache[text] for text in texts if text in _embedding_cache}
+        for text in embeddings:
+            _embedding_cache.move_to_end(text)
+    missing = list(dict.fromkeys(text for text in texts if text not in embeddings))
+    count('embedding cache hits', len(texts) - len(missing))
+    if missing:
+        embedder = load_embedder()
+        with span('encode', n_texts=len(missing)):
+            embeddings.update(zip(missing, embedder.encode(missing)))
+        with _embedding_cache_lock:
+            for text in missing:
+                if text in _embedding_cache:
+                    _embedding_cache_bytes -= entry_bytes(text, _embedding_cache[text])
+                _embedding_cache[text] = embeddings[text]
+                _embedding_cache_bytes += entry_bytes(text, embeddings[text])
+            while _embedding_cache_bytes > EMBEDDING_CACHE_BYTES:
+                text, embedding = _embedding_cache.popitem(last=False)
+                _embedding_cache_bytes -= entry_bytes(text, embedding)
+    return np.array([embeddings[text] for text in texts])
+
 def create_embeddings(data, only_text):
-    embedder = load_embedder()
     if only_text:
-        corpus_embeddings = embedder.encode(data)
+        corpus_embeddings = encode(data)
         corpus_embeddings = corpus_embeddings / np.linalg.norm(corpus_embeddings, axis=1, keepdims=True)
     else:
         sentences = [item['sentence_text'] for item in data]
         explanations = [item['explanation'] for item in data]
         
-        sentence_embeddings = embedder.encode(sentences)
-        explanation_embeddings = embedder.encode(explanations)
+        sentence_embeddings = encode(sentences)
+        explanation_embeddings = encode(explanations)
         sentence_embeddings = sentence_embeddings / np.linalg.norm(sentence_embeddings, axis=1, keepdims=True)
         explanation_embeddings = explanation_embeddings / np.linalg.norm(explanation_embeddings, axis=1, keepdims=True)
 
@@ -29,21 +82,43 @@ def create_embeddings(data, only_text):
         corpus_embeddings = np.concatenate((sentence_embeddings, label_embeddings, explanation_embeddings), axis=1)
     return corpus_embeddings
 
+def cluster_linkage(corpus_embeddings):
+    #the whole average-linkage hierarchy under cosine distance (the merges agglomerative clustering makes), with the distance matrix; built once,
+    #after which the clusters at any threshold are a cut of it
+    distances = np.maximum(pdist(corpus_embeddings, metric='cosine'), 0)
+    return linkage(distances, method='average'), squareform(distances)
+
+def cut_linkage(linkage_matrix, distance_threshold):
+    #the flat clusters at a threshold, numbered from 0
+    return fcluster(linkage_matrix, t=distance_threshold, criterion='distance') - 1
+
 def cluster_assigning(distance_threshold, corpus_embeddings):
-    clustering_model = AgglomerativeClustering(n_clusters=None, distance_threshold=distance_threshold, metric='cosine', linkage='average')
-    clustering_model.fit(corpus_embeddings)
-    return clustering_model.labels_
+    return cut_linkage(cluster_linkage(corpus_embeddings)[0], distance_threshold)
 
+def silhouette_curve(linkage_matrix, distance_matrix, thresholds=THRESHOLDS):
+    #threshold, number of clusters and silhouette score for every threshold giving more than one but fewer than n clusters; cuts of one hierarchy are
+    #nested, so cuts with the same number of clusters are the same clustering, and are scored once
+    curve, scores = [], {}
+    for dt in thresholds:
+        cluster_assignment = cut_linkage(linkage_matrix, dt)
+        n_clusters = int(cluster_assignment.max()) + 1
+        if n_clusters in [1, len(distance_matrix)]:
+            continue
+        if n_clusters not in scores:
+            scores[n_clusters] = float(silhouette_score(distance_matrix, cluster_assignment, metric='precomputed'))
+        curve.append({'threshold': float(dt), 'n_clusters': n_clusters, 'silhouette': scores[n_clusters]})
+    return curve
+
+def best_threshold(curve):
+    #the median of the thresholds with the highest silhouette score; 0 (every sentence its own cluster) if no threshold gives a proper clustering
+    if not curve:
+        return 0.0
+    best = max(point['silhouette'] for point in curve)
+    return float(np.median([point['threshold'] for point in curve if point['silhouette'] == best]))
+
+@timed('threshold sweep')
 def optimise_distance_threshold(corpus_embeddings):
-    dts, cs, ss = [], [], []
-    for dt in np.linspace(0,2,200):
-        cluster_assignment = cluster_assigning(dt, corpus_embeddings)
-        if len(list(set(cluster_assignment))) not in [1,len(corpus_embeddings)]:
-            dts.append(dt)
-            cs.append(len(list(set(cluster_assignment))))
-            ss.append(silhouette_score(corpus_embeddings, cluster_assignment, metric='cosine'))
-    l = [dts[i] for i in range(len(dts)) if ss[i] == np.max(ss)]
-    return np.median(l)
+    return best_threshold(silhouette_curve(*cluster_linkage(corpus_embeddings)))
 
 def sentences_clustered(cluster_assignment, sentences):
     clustered_sentences = {cluster_id:[] for cluster_id in cluster_assignment}
@@ -51,26 +126,184 @@ def sentences_clustered(cluster_assignment, sentences):
         clustered_sentences[cluster_id].append(sentences[sentence_id])
     return clustered_sentences
 
-def cluster_sentences(sentences, only_text=True):
-    corpus_embeddings = create_embeddings(sentences, only_text)
+def cluster_medoids(corpus_embeddings, cluster_assignment):
+    #for unit vectors, the member with the largest dot product with its cluster's mean is also the one with the smallest summed cosine distance to the other members, i.e. the medoid
+    embeddings = corpus_embeddings / np.linalg.norm(corpus_embeddings, axis=1, keepdims=True)
+    membership = np.zeros((cluster_assignment.max() + 1, len(embeddings)))
+    membership[cluster_assignment, np.arange(len(embeddings))] = 1
+    centroids = membership @ embeddings
+    similarity = np.einsum('ij,ij->i', embeddings, centroids[cluster_assignment])
+    order = np.lexsort((-similarity, cluster_assignment))
+    first_in_cluster = np.r_[True, cluster_assignment[order][1:] != cluster_assignment[order][:-1]]
+    return order[first_in_cluster]
+
+class ClusterIndex:
+    #the clusters of one full clustering run (threshold sweep and agglomerative clustering), kept so that sentences added later are assigned without
+    #clustering again: a new sentence joins the cluster with the nearest centroid if it is within that cluster's radius, and opens a cluster of its own
+    #otherwise. The radius is calibrated on the full run rather than taken from the linkage threshold, which bounds average distances between sentences, not
+    #distances to a centroid: it is the largest distance of a member to the centroid of the rest of its cluster (a new sentence is not part of the centroid
+    #either), but no less than a percentile of those distances over all clusters, which is also all that singletons and clusters opened later get. Centroids are kept as sums of unit vectors, so that they move with the sentences they gain. The drift since the full run (how many
+    #sentences were added, how many of them opened clusters, how far they were from their centroids) decides when to cluster from scratch again
+    def __init__(self, embeddings, members, cluster_assignment, threshold):
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.threshold = threshold
+        self.sums = np.zeros((cluster_assignment.max() + 1, embeddings.shape[1]))
+        np.add.at(self.sums, cluster_assignment, embeddings)
+        self.sizes = np.bincount(cluster_assignment, minlength=len(self.sums))
+        self.medoids = [members[i] for i in cluster_medoids(embeddings, cluster_assignment)]
+        self.assignment = dict(zip(members, cluster_assignment.tolist()))
+        self.n_fitted = len(members)
+        #distances of the members of clusters with more than one member to the centroid of the other members
+        shared = self.sizes[cluster_assignment] > 1
+        rest = self.sums[cluster_assignment[shared]] - embeddings[shared]
+        fitted_distances = 1 - np.sum(embeddings[shared] * rest, axis=1) / np.linalg.norm(rest, axis=1)
+        self.fitted_distance = float(np.mean(fitted_distances)) if shared.any() else 0.0
+        self.default_radius = float(np.percentile(fitted_distances, RADIUS_PERCENTILE)) if shared.any() else threshold
+        self.radii = np.full(len(self.sums), self.default_radius)
+        np.maximum.at(self.radii, cluster_assignment[shared], fitted_distances)
+        self.n_added, self.n_new_clusters, self.added_distance = 0, 0, 0.0
+
+    @classmethod
+    def fit(cls, embeddings, members):
+        linkage_matrix, distance_matrix = cluster_linkage(embeddings)
+        threshold = best_threshold(silhouette_curve(linkage_matrix, distance_matrix))
+        return cls(embeddings, members, cut_linkage(linkage_matrix, threshold), threshold)
+
+    def distances(self, embeddings, start=0):
+        #cosine distances of unit vectors to every centroid (from the start-th), in one matrix product
+        centroids = self.sums[start:] / np.linalg.norm(self.sums[start:], axis=1, keepdims=True)
+        return 1 - embeddings @ centroids.T
 
-    dt = optimise_distance_threshold(corpus_embeddings)
-    cluster_assignment = cluster_assigning(dt, corpus_embeddings)
+    def add(self, embeddings, members):
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        distances = self.distances(embeddings)
+        for embedding, member, row in zip(embeddings, members, distances):
+            #clusters opened by earlier sentences of this batch are not in the precomputed distances
+            if len(self.sums) > len(row):
+                row = np.concatenate((row, self.distances(embedding[None, :], start=len(row))[0]))
+            nearest = int(np.argmin(row))
+            if row[nearest] <= self.radii[nearest]:
+                self.added_distance += float(row[nearest])
+            else:
+                nearest = len(self.sums)
+                self.sums = np.vstack((self.sums, np.zeros(self.sums.shape[1])))
+                self.sizes = np.append(self.sizes, 0)
+                self.radii = np.append(self.radii, self.default_radius)
+                self.n_new_clusters += 1
+            self.sums[nearest] += embedding
+            self.sizes[nearest] += 1
+            self.assignment[member] = nearest
+            self.n_added += 1
 
-    return sentences_clustered(cluster_assignment, sentences)
+    def drift(self):
+        n_joined = self.n_added - self.n_new_clusters
+        return {
+            'added_fraction': self.n_added / self.n_fitted,
+            'new_cluster_fraction': self.n_new_clusters / self.n_added if self.n_added else 0.0,
+            'distance_ratio': (self.added_distance / n_joined) / self.fitted_distance if n_joined and self.fitted_distance > 0 else 1.0
+        }
+
+    def needs_reclustering(self):
+        drift = self.drift()
+        return drift['added_fraction'] > MAX_ADDED_FRACTION or drift['new_cluster_fraction'] > MAX_NEW_CLUSTER_FRACTION or drift['distance_ratio'] > MAX_DISTANCE_RATIO
+
+def sentence_key(sentence):
+    return sentence if isinstance(sentence, str) else json.dumps(sentence, sort_keys=True)
+
+def incremental_cluster_assignment(key, sentences, corpus_embeddings):
+    #the clusters of the sentences under the cluster index kept for key (e.g. a hash of a topic's seed input): sentences seen before keep their cluster, new ones are assigned
+    #to the nearest cluster; the sentences are clustered from scratch the first time, and again when the index has drifted too far
+    members = [sentence_key(sentence) for sentence in sentences]
+    #the new sentences are found, added and the drift checked under one acquisition of the lock, so that two sessions cannot both add the same sentences
+    with _cluster_indices_lock:
+        index = _cluster_indices.get(key)
+        if index is not None:
+            _cluster_indices.move_to_end(key)
+            new = [i for i, member in enumerate(members) if member not in index.assignment]
+            if new:
+                with span('assign to clusters', n_sentences=len(new)):
+                    index.add(corpus_embeddings[new], [members[i] for i in new])
+            if index.needs_reclustering():
+                index = None
+            else:
+                count('incremental cluster assignments', len(new))
+    if index is None:
+        index = ClusterIndex.fit(corpus_embeddings, members)
+        count('full clusterings')
+        with _cluster_indices_lock:
+            _cluster_indices[key] = index
+            while len(_cluster_indices) > CLUSTER_INDEX_CACHE_SIZE:
+                _cluster_indices.popitem(last=False)
+    #sentences of the index that are not among these sentences leave gaps in the cluster numbers, which are closed up here
+    return np.unique([index.assignment[member] for member in members], return_inverse=True)[1]
+
+def cluster_sentences(sentences, only_text=True, corpus_embeddings=None, key=None):
+    #with a key, the clusters are kept in a cluster index and sentences added under the same key later are assigned incrementally
+    if corpus_embeddings is None:
+        corpus_embeddings = create_embeddings(sentences, only_text)
+
+    if len(sentences) < 3:
+        #too few sentences for any threshold to give more than one but fewer than n clusters
+        cluster_assignment = np.arange(len(sentences))
+    elif key is not None:
+        cluster_assignment = incremental_cluster_assignment(key, sentences, corpus_embeddings)
+    else:
+        linkage_matrix, distance_matrix = cluster_linkage(corpus_embeddings)
+        cluster_assignment = cut_linkage(linkage_matrix, best_threshold(silhouette_curve(linkage_matrix, distance_matrix)))
+
+    return sentences_clustered(cluster_assignment, sentences), corpus_embeddings, cluster_assignment
+
+def yes_no_clusters(sentences, corpus_embeddings=None, key=None):
+    #cluster the Yes and No sentences separately; precomputed embeddings of all sentences can be passed in and are sliced per label
+    results = []
+    for is_yes in [True, False]:
+        indices = [i for i, sentence in enumerate(sentences) if (sentence['label'] == 'Yes') == is_yes]
+        if not indices:
+            continue
+        subset = [sentences[i] for i in indices]
+        embeddings = corpus_embeddings[indices] if corpus_embeddings is not None else None
+        clustered_sentences, embeddings, cluster_assignment = cluster_sentences(subset, only_text=False, corpus_embeddings=embeddings, key=(key, is_yes) if key is not None else None)
+        results.append((subset, clustered_sentences, embeddings, cluster_assignment))
+    return results
+
+def yes_no_cluster_hierarchy(sentences, corpus_embeddings=None):
+    #for the Yes and the No sentences, what is needed to cluster them again at any threshold without embedding or clustering again: the sentences,
+    #their embeddings, the linkage matrix, the silhouette curve and the best threshold on it
+    if corpus_embeddings is None:
+        corpus_embeddings = create_embeddings(sentences, only_text=False)
+    hierarchy = []
+    for is_yes in [True, False]:
+        indices = [i for i, sentence in enumerate(sentences) if (sentence['label'] == 'Yes') == is_yes]
+        if not indices:
+            continue
+        group = {'label': 'Yes' if is_yes else 'No', 'sentences': [sentences[i] for i in indices], 'embeddings': corpus_embeddings[indices], 'linkage': None, 'curve': [], 'threshold': 0.0}
+        if len(indices) >= 3:
+            with span('cluster hierarchy', n_sentences=len(indices)):
+                linkage_matrix, distance_matrix = cluster_linkage(group['embeddings'])
+                group['linkage'], group['curve'] = linkage_matrix, silhouette_curve(linkage_matrix, distance_matrix)
+                group['threshold'] = best_threshold(group['curve'])
+        hierarchy.append(group)
+    return hierarchy
+
+def hierarchy_representatives(group, distance_threshold):
+    #the medoids of a group of yes_no_cluster_hierarchy cut at a threshold: an O(n) cut of the linkage and one pass over the embeddings
+    if group['linkage'] is None:
+        cluster_assignment = np.arange(len(group['sentences']))
+    else:
+        cluster_assignment = cut_linkage(group['linkage'], distance_threshold)
+    return [group['sentences'][i] for i in cluster_medoids(group['embeddings'], cluster_assignment)]
 
-def yes_no_cluster_sentences(sentences):
-    yes = []
-    no = []
-    for sentence in sentences:
-        if sentence['label'] == 'Yes':
-            yes.append(sentence)
-        else:
-            no.append(sentence)
+def yes_no_cluster_sentences(sentences, corpus_embeddings=None, key=None):
+    clusters = []
+    for _, clustered_sentences, _, _ in yes_no_clusters(sentences, corpus_embeddings, key):
+        clusters.extend(clustered_sentences[k] for k in clustered_sentences.keys())
+    return clusters
 
-    yes_cluster = cluster_sentences(yes, only_text=False)
-    no_cluster = cluster_sentences(no, only_text=False)
-    return [yes_cluster[k] for k in yes_cluster.keys()] + [no_cluster[k] for k in no_cluster.keys()]
+def yes_no_cluster_representatives(sentences, corpus_embeddings=None, key=None):
+    representatives = []
+    for subset, _, embeddings, cluster_assignment in yes_no_clusters(sentences, corpus_embeddings, key):
+        representatives.extend(subset[i] for i in cluster_medoids(embeddings, cluster_assignment))
+    return representatives
 
 if __name__ == "__main__":
     only_text = False
@@ -88,7 +321,7 @@ if __name__ == "__main__":
             "A cheetah is running behind its prey.",
             "A cheetah chases prey on across a field.",
         ]
-        d = cluster_sentences(corpus)
+        d, _, _ = cluster_sentences(corpus)
         for k in d.keys():
             print(d[k])
     else:
@@ -0,0 +1,182 @@
+from elasticsearch import Elasticsearch
+import argparse
+import os
+import time
+from dotenv import load_dotenv
+
+#Explicit mappings for the labelling indices. Ids are keywords (exact term lookups, no analysis), free text that is only ever displayed
+#(explanations, definitions, difficult cases) is kept in _source but not indexed, and doc_values are switched off on fields we never sort or aggregate on.
+INDEX_SCHEMAS = {
+    'labelled_sentence': {
+        'settings': {'number_of_shards': 1, 'number_of_replicas': 1, 'refresh_interval': '1s'},
+        'mappings': {
+            'properties': {
+                'sentence_text': {'type': 'text'},
+                'sentence_hash': {'type': 'keyword'},
+                'sentence_embedding': {'type': 'dense_vector', 'dims': 768, 'index': True, 'similarity': 'cosine'},
+                'translated': {'type': 'boolean', 'doc_values': False},
+                'generated': {'type': 'boolean', 'doc_values': False},
+                'parent_sentence_id': {'type': 'keyword', 'doc_values': False}
+            }
+        }
+    },
+    'sentence_label': {
+        'settings': {'number_of_shards': 1, 'number_of_replicas': 1, 'refresh_interval': '1s'},
+        'mappings': {
+            'properties': {
+                'labeller_id': {'type': 'keyword'},
+                'sentence_id': {'type': 'keyword'},
+                'topic_id': {'type': 'keyword'},
+                'position_in_text': {'type': 'integer', 'index': False, 'doc_values': False},
+                'confidence': {'type': 'float'},
+                'explanation': {'type': 'text', 'index': False}
+            }
+        }
+    },
+    'topic_entity': {
+        'settings': {'number_of_shards': 1, 'number_of_replicas': 1, 'refresh_interval': '1s'},
+        'mappings': {
+            'properties': {
+                'id': {'type': 'keyword'},
+                'name': {'type': 'keyword'},
+                'type': {'type': 'keyword'},
+                'parent_topic_id': {'type': 'keyword'},
+                'labeller_id': {'type': 'keyword', 'doc_values': False}
+            }
+        }
+    },
+    'topic_entity_definition': {
+        'settings': {'number_of_shards': 1, 'number_of_replicas': 1, 'refresh_interval': '1s'},
+        'mappings': {
+            'properties': {
+                'topic_id': {'type': 'keyword'},
+                'name': {'type': 'keyword'},
+                'definition': {'type': 'text', 'index': False},
+                'language': {'type': 'keyword'},
+                'status': {'type': 'keyword'},
+                'keyword': {'type': 'keyword', 'doc_values': False},
+                'name_variation': {'type': 'keyword', 'doc_values': False},
+                'difficult_case': {'type': 'text', 'index': False}
+            }
+        }
+    },
+    'labeller': {
+        'settings': {'number_of_shards': 1, 'number_of_replicas': 1, 'refresh_interval': '1s'},
+        'mappings': {
+            'properties': {
+                'type': {'type': 'keyword'}
+            }
+        }
+    },
+    'topic_count_visualisation': {
+        'settings': {'number_of_shards': 1, 'number_of_replicas': 1, 'refresh_interval': '1s'},
+        'mappings': {
+            'properties': {
+                'sentence_id': {'type': 'keyword'},
+                'topic_name': {'type': 'keyword'}
+            }
+        }
+    },
+    'id_counter': {
+        'settings': {'number_of_shards': 1, 'number_of_replicas': 1},
+        'mappings': {
+            'dynamic': 'strict',
+            'properties': {
+                'next': {'type': 'long', 'index': False}
+            }
+        }
+    }
+}
+
+
+def index_schema(index: str) -> dict:
+    """Returns the settings and mappings of an index, as keyword arguments for client.indices.create. Unknown indices get an empty schema, i.e. dynamic mapping.
+
+    Args:
+        index (str): Name of the index.
+
+    Returns:
+        dict: Dictionary with keys 'settings' and 'mappings', or empty.
+    """
+    return INDEX_SCHEMAS.get(index, {})
+
+
+def put_index_templates(client: Elasticsearch) -> None:
+    """Puts an index template for every index in INDEX_SCHEMAS, matching both the plain name and its migrated versions (f'{index}_v*').
+    Any index that Elasticsearch creates implicitly on first write then gets the explicit mapping rather than a dynamic one.
+
+    Args:
+        client (Elasticsearch): Client connection to Elasticsearch.
+    """
+    for index, schema in INDEX_SCHEMAS.items():
+        client.indices.put_index_template(name=index, index_patterns=[index, f'{index}_v*'], template=schema, priority=100)
+
+
+def migrate_index(client: Elasticsearch, index: str, batch_size=1000, poll_seconds=5) -> str:
+    """Reindexes an index into a new versioned index (f'{index}_v{n}') with the explicit mapping, and points the old name at it as an alias.
+    Callers keep using the plain index name. Writes made while the reindex is running are not copied, so run this while the app is stopped.
+    The reindex runs as a task on the cluster and is polled, so that it is not cut short by the client's request timeout. If an earlier run was interrupted
+    before the alias was moved, the new index already exists: running again resumes, copying only the documents it lacks.
+
+    Args:
+        client (Elasticsearch): Client connection to Elasticsearch.
+        index (str): Name (or alias) of the index to migrate, must be in INDEX_SCHEMAS.
+        batch_size (int, optional): Defaults to 1000. Batch size of the reindex scroll.
+        poll_seconds (int, optional): Defaults to 5. Seconds between polls of the reindex task.
+
+    Raises:
+        RuntimeError: If the reindex task reports failures; the alias is then left as it was.
+
+    Returns:
+        str: The name of the new concrete index.
+    """
+    if client.indices.exists_alias(name=index):
+        current = list(client.indices.get_alias(name=index).keys())[0]
+        version = int(current.rsplit('_v', 1)[1])
+    else:
+        current = index
+        version = 0
+    new = f'{index}_v{version + 1}'
+    if not client.indices.exists(index=new):
+        client.indices.create(index=new, **index_schema(index))
+    #op_type create with conflicts proceed skips the documents a previous, interrupted run already copied
+    task = client.reindex(source={'index': current, 'size': batch_size}, dest={'index': new, 'op_type': 'create'}, conflicts='proceed', wait_for_completion=False)['task']
+    while True:
+        status = client.tasks.get(task_id=task)
+        if status['completed']:
+            break
+        time.sleep(poll_seconds)
+    failures = status.get('response', {}).get('failures', []) or ([status['error']] if 'error' in status else [])
+    if failures:
+        raise RuntimeError(f'Reindexing {current} into {new} failed: {failures[:3]}')
+    client.indices.refresh(index=new)
+    if current == index:
+        client.indices.update_aliases(actions=[{'remove_index': {'index': current}}, {'add': {'index': new, 'alias': index}}])
+    else:
+        client.indices.update_aliases(actions=[{'remove': {'index': current, 'alias': index}}, {'add': {'index': new, 'alias': index}}])
+        client.indices.delete(index=current)
+    #imported here, as src.utils imports this module; the cached mapping is that of the old index
+    from src.utils import clear_exact_fields
+    clear_exact_fields(index)
+    return new
+
+
+if __name__ == "__main__":
+    from src.utils import create_es_client
+
+    parser = argparse.ArgumentParser(description='Manage the explicit Elasticsearch mappings of the labelling indices.')
+    parser.add_argument('command', choices=['templates', 'migrate'], help='"templates" puts the index templates, "migrate" reindexes the given indices into the explicit mapping.')
+    parser.add_argument('indices', nargs='*', default=list(INDEX_SCHEMAS.keys()), help='Indices to migrate. Defaults to all.')
+    args = parser.parse_args()
+
+    load_dotenv('credentials.env')
+    ELASTIC_HOST=os.getenv('ELASTIC_HOST')
+    ELASTIC_USER=os.getenv('ELASTIC_USER')
+    ELASTIC_PASS=os.getenv('ELASTIC_PASS')
+    client = create_es_client(ELASTIC_HOST, ELASTIC_USER, ELASTIC_PASS)
+
+    put_index_templates(client)
+    if args.command == 'migrate':
+        for index in args.indices:
+            if client.indices.exists(index=index):
+                print(f'{index} -> {migrate_index(client, index)}')
@@ -1,53 +1,70 @@
-from openai import OpenAI
+from openai import OpenAI, RateLimitError
+from functools import lru_cache
 import os
 import json
+import random
+import time
 from dotenv import load_dotenv
-
-
-def call_gpt(gpt_key, system_content, assistant_content, user_content, custom_output_function, max_n_tries):
-    for i in range(max_n_tries):
-        try:
-            client = OpenAI(
-            api_key=gpt_key,
-            )
-            model = 'gpt-4'
-
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_content},
-                    {"role": "assistant", "content": assistant_content},
-                    {"role": "user", "content": user_content},
-                ],
-                tools = custom_output_function,
-                tool_choice = 'auto'
-            )
-            response = json.loads(response.model_dump()["choices"][0]["message"]["tool_calls"][0]["function"]["arguments"])
-            return response
-        except Exception as e:
-            if i == max_n_tries - 1:
-                print(e)
-                quit()
+from src.prompt_builder import build_topic_information, format_sentence, count_tokens
+from src.gpt_scheduler import scheduler, ESTIMATED_COMPLETION_TOKENS
+from src.instrumentation import span, count
+
+#backoff of calls that failed for another reason than a rate limit (server errors, timeouts, answers without a tool call): doubled per failed try, with jitter
+BACKOFF_SECONDS = 1
+MAX_BACKOFF_SECONDS = 30
+
+@lru_cache(maxsize=None)
+def openai_client(gpt_key):
+    #retries are left to call_gpt and the scheduler, rather than the client's own backoff
+    return OpenAI(api_key=gpt_key, max_retries=0)
+
+def call_gpt(gpt_key, system_content, assistant_content, user_content, custom_output_function, max_n_tries, max_n_rate_limits=20):
+    #every call waits for its turn in the process-wide scheduler; a rate limit (429) holds back all queued calls and is retried without counting as a failed try
+    #the span of the whole call includes the time queued in the scheduler and any retries; 'gpt request' is the time spent on the API itself
+    name = custom_output_function[0]['function']['name']
+    estimated_tokens = count_tokens(system_content + assistant_content + user_content + json.dumps(custom_output_function)) + ESTIMATED_COMPLETION_TOKENS
+    n_tries, n_rate_limits = 0, 0
+    with span(f'gpt {name}'):
+        while True:
+            try:
+                with scheduler.slot(estimated_tokens) as usage:
+                    model = 'gpt-4'
+
+                    with span('gpt request', function=name):
+                        response = openai_client(gpt_key).chat.completions.create(
+                            model=model,
+                            messages=[
+                                {"role": "system", "content": system_content},
+                                {"role": "assistant", "content": assistant_content},
+                                {"role": "user", "content": user_content},
+                            ],
+                            tools = custom_output_function,
+                            tool_choice = 'auto'
+                        )
+                    usage['tokens'] = response.usage.total_tokens
+                count('gpt requests')
+                count('gpt prompt tokens', response.usage.prompt_tokens)
+                count('gpt completion tokens', response.usage.completion_tokens)
+                response = json.loads(response.model_dump()["choices"][0]["message"]["tool_calls"][0]["function"]["arguments"])
+                return response
+            except RateLimitError as e:
+                count('gpt rate limited')
+                n_rate_limits += 1
+                if n_rate_limits > max_n_rate_limits:
+                    raise
+                scheduler.rate_limited(float(e.response.headers.get('retry-after', 10)))
+            except Exception:
+                count('gpt failed')
+                n_tries += 1
+                if n_tries == max_n_tries:
+                    raise
+                #full jitter, so that calls failing together do not retry together; the wait is outside the scheduler slot, so other calls go ahead meanwhile
+                time.sleep(random.uniform(0, min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (n_tries - 1))))
 
 def write_topic_information(topic_name, topic_definition, keywords, name_variations, difficult_cases, labelled_sentences):
-    topic_information = f'You are tasked with labelling the following topic:\n\n{topic_name}\n{topic_definition}'
-
-    topic_information += '\n\nHere are some keywords that are often associated with the topic. Note, the mere presence of a keyword in a sentence does not guarantee the presence of the topic.'
-    for keyword in keywords:
-        topic_information += f'\n{keyword}'
-
-    topic_information += '\n\nHere are some name variations for the topic: other ways in which it is commonly referred to.'
-    for name_variation in name_variations:
-        topic_information += f'\n{name_variation}'
-
-    topic_information += '\n\nHere are some descriptions of difficult cases for the topic. These are cases which, for whatever reason, might confuse the labeller and lead them to place an incorrect or inaccurate label.'
-    for difficult_case in difficult_cases:
-        topic_information += f'\n{difficult_case}'
-
-    topic_information += '\n\nHere are some sample sentences, with labels attached and an explanation for the "Yes", "Maybe", or "No" label.'
-    for labelled_sentence in labelled_sentences:
-        topic_information += f'\n{labelled_sentence}'
-    return topic_information
+    sentence_header = 'Here are some sample sentences, with labels attached and an explanation for the "Yes", "Maybe", or "No" label.'
+    sentence_lines = [format_sentence(i, s) for i, s in enumerate(labelled_sentences, start=1)]
+    return build_topic_information(topic_name, topic_definition, keywords, name_variations, difficult_cases, sentence_header, sentence_lines)
 
 def generate_sentences_prompt(n, topic_name, topic_definition, keywords, name_variations, difficult_cases, labelled_sentences):
     introduction_content = f'Imagine that you are a Named Entity Recognition service that predicts whether a topic is present in a given sentence. You are an expert within financial news, and you identify these topics in sentences taken from financial sources.' 
@@ -0,0 +1,263 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict
+from elasticsearch import ConflictError
+from elasticsearch.helpers import scan
+import argparse
+import contextvars
+import json
+import os
+import threading
+from dotenv import load_dotenv
+from src.gpt_augmentation import call_gpt, write_topic_information
+from src.gpt_scheduler import gpt_context
+from src.prompt_builder import count_tokens, format_sentence
+from src.instrumentation import span, count
+from src.keyword_prefilter import prefilter
+from src.utils import create_es_client, search_document, search_documents_by, insert_in_bulk, count_round_trips, request_scope
+
+#Labels saved topics on new sentences with GPT. Many sentences are packed into one request: the topic information (definition, keywords, name variations,
+#difficult cases and the topic's own labelled sentences as examples) is sent once per batch instead of once per sentence, and it is the same for every batch
+#of a topic, so it is also cached by the API. Batches run concurrently at batch priority in the GPT scheduler, every label is appended to a JSONL checkpoint
+#as soon as it arrives, and labels are written to sentence_label in bulk under the GPT labeller.
+LABEL_CONFIDENCE = {'Yes': 1, 'No': 0}
+GPT_LABELLER_ID = 'gpt'
+BATCH_SIZE = 25
+MAX_BATCH_TOKENS = 2000
+WRITE_BATCH_SIZE = 500
+
+def gpt_labeller_id(client):
+    #the labeller document of type 'GPT', created the first time GPT labels anything; it is created under a fixed '_id', so that two runs starting at once cannot both create one
+    labellers = search_document(client, 'labeller', {'type': 'GPT'}, all=True)
+    if labellers:
+        return labellers[0]['_id']
+    try:
+        client.index(index='labeller', id=GPT_LABELLER_ID, document={'type': 'GPT'}, op_type='create', refresh=True)
+    except ConflictError:
+        #created by another run since the search above
+        pass
+    count_round_trips('index labeller')
+    return GPT_LABELLER_ID
+
+def missing_definitions(client, topic_ids):
+    #the topic ids without a saved definition, which cannot be labelled for
+    definitions = search_documents_by(client, 'topic_entity_definition', 'topic_id', topic_ids)
+    return [topic_id for topic_id in topic_ids if not definitions[topic_id]]
+
+def load_topics(client, topic_ids, gpt_id):
+    #the saved definition of each topic, with its human-labelled sentences as examples; one query per index for all topics, rather than three per topic
+    definitions = search_documents_by(client, 'topic_entity_definition', 'topic_id', topic_ids)
+    missing = [topic_id for topic_id in topic_ids if not definitions[topic_id]]
+    if missing:
+        raise ValueError(f"No saved definition for topic id(s) {', '.join(missing)}; a topic can only be labelled once its definition has been saved.")
+    labels = {topic_id: [l for l in topic_labels if l['labeller_id'] != gpt_id] for topic_id, topic_labels in search_documents_by(client, 'sentence_label', 'topic_id', topic_ids).items()}
+    sentences = search_documents_by(client, 'labelled_sentence', '_id', [l['sentence_id'] for topic_labels in labels.values() for l in topic_labels], all=True, source_excludes=('sentence_embedding',))
+    texts = {id: s[0]['_source']['sentence_text'] for id, s in sentences.items() if s}
+    as_list = lambda value: value if isinstance(value, list) else [value] if value else []
+    topics = {}
+    for topic_id in topic_ids:
+        definition = definitions[topic_id][0]
+        topics[topic_id] = {
+            'topic_id': topic_id,
+            'topic_name': definition['name'],
+            'topic_definition': definition['definition'],
+            'keywords': as_list(definition.get('keyword')),
+            'name_variations': as_list(definition.get('name_variation')),
+            'difficult_cases': as_list(definition.get('difficult_case')),
+            'labelled_sentences': [{'sentence_text': texts[l['sentence_id']], 'label': 'Yes' if l['confidence'] >= 0.5 else 'No', 'explanation': l.get('explanation', '')} for l in labels[topic_id] if l['sentence_id'] in texts]
+        }
+    return topics
+
+def candidate_sentences(client, topic_ids, sentence_ids=None, batch_size=1000, use_prefilter=True):
+    #per topic, the sentences (all of labelled_sentence, or the given ones) that have no label for the topic yet, from any labeller,
+    #and, with use_prefilter, that mention one of the topic's keywords or name variations (see keyword_prefilter.py)
+    query = {"query": {"match_all": {}} if not sentence_ids else {"ids": {"values": list(sentence_ids)}}, "_source": ["sentence_text"]}
+    sentences = [{'sentence_id': hit['_id'], 'sentence_text': hit['_source']['sentence_text']} for hit in scan(client, index='labelled_sentence', query=query, size=batch_size)]
+    count_round_trips('scan labelled_sentence', 1 + len(sentences) // batch_size)
+    labelled = defaultdict(set)
+    for label in search_document(client, 'sentence_label', {'topic_id': list(topic_ids)}):
+        labelled[label['topic_id']].add(label['sentence_id'])
+    candidates = prefilter(client, sentences, topic_ids) if use_prefilter else {topic_id: sentences for topic_id in topic_ids}
+    return {topic_id: [s for s in candidates[topic_id] if s['sentence_id'] not in labelled[topic_id]] for topic_id in topic_ids}
+
+def pack_batches(sentences, batch_size=BATCH_SIZE, max_batch_tokens=MAX_BATCH_TOKENS):
+    #consecutive sentences, at most batch_size per batch and at most max_batch_tokens of sentence text per batch (a longer sentence goes alone)
+    batches, batch, tokens = [], [], 0
+    for sentence in sentences:
+        n_tokens = count_tokens(sentence['sentence_text']) + 3  #the number and line break
+        if batch and (len(batch) == batch_size or tokens + n_tokens > max_batch_tokens):
+            batches.append(batch)
+            batch, tokens = [], 0
+        batch.append(sentence)
+        tokens += n_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def generate_labelling_prompt(topic, batch):
+    introduction_content = 'Imagine that you are a Named Entity Recognition service that predicts whether a topic is present in a given sentence. You are an expert within financial news, and you identify these topics in sentences taken from financial sources.'
+    topic_information = write_topic_information(topic['topic_name'], topic['topic_definition'], topic['keywords'], topic['name_variations'], topic['difficult_cases'], topic['labelled_sentences'])
+    instruction_content = f'Below is a numbered list of {len(batch)} new sentences. For each of them, decide whether the topic is present: label it "Yes" or "No", and explain your label in one or two sentences, referring to the relevant context above (keywords, name variations, difficult cases, labelled sentences) where it helps. Label every sentence on its own, and return exactly one label for each number in the list.'
+    sentence_lines = '\n'.join(format_sentence(i, s, include_label=False, include_explanation=False) for i, s in enumerate(batch, start=1))
+    system_content = 'You are a Named Entity Recognition expert, labelling sentences from financial news for the presence of a topic. You are careful and consistent, and you follow the topic description closely.'
+    assistant_content = ''
+    user_content = introduction_content + topic_information + '\n\n' + instruction_content + '\n\n' + sentence_lines
+    return system_content, assistant_content, user_content
+
+def generate_labelling_custom_function(n):
+    custom_output_function = [
+        {
+            'type': 'function',
+            'function': {
+                'name': 'sentence_labelling',
+                'description': 'Label each sentence of the numbered list for the presence of the topic.',
+                'parameters': {
+                    'type': 'object',
+                    'properties': {
+                        'labels': {
+                            'type': 'array',
+                            'items': {
+                                'type': 'object',
+                                'properties': {
+                                    'number': {
+                                        'type': 'integer',
+                                        'description': 'The number of the sentence in the numbered list.'
+                                    },
+                                    'label': {
+                                        'type': 'string',
+                                        'description': '"Yes" or "No", depending on whether the topic is present in the sentence.',
+                                        'enum': ['Yes', 'No']
+                                    },
+                                    'explanation': {
+                                        'type': 'string',
+                                        'description': 'A short text (one or two sentences) explaining the label.'
+                                    }
+                                },
+                                'required': ['number', 'label', 'explanation']
+                            },
+                            'minItems': n,
+                            'maxItems': n,
+                            'description': f'One label for each of the {n} sentences.'
+                        }
+                    },
+                    'required': ['labels']
+                }
+            }
+        }
+    ]
+    return custom_output_function
+
+def label_batch(gpt_key, topic, batch, max_n_tries=5):
+    #labels for the sentences of the batch that GPT answered for properly; numbers out of range, repeated, or with an unknown label are left out, to be retried
+    system_content, assistant_content, user_content = generate_labelling_prompt(topic, batch)
+    custom_output_function = generate_labelling_custom_function(len(batch))
+    response = call_gpt(gpt_key, system_content, assistant_content, user_content, custom_output_function, max_n_tries)
+    labels = {}
+    for item in response.get('labels', []):
+        k = item.get('number')
+        if isinstance(k, int) and 1 <= k <= len(batch) and k not in labels and item.get('label') in LABEL_CONFIDENCE:
+            labels[k] = {'topic_id': topic['topic_id'], 'sentence_id': batch[k - 1]['sentence_id'], 'label': item['label'], 'explanation': item.get('explanation', '')}
+    return list(labels.values())
+
+def read_checkpoint(path):
+    #(topic_id, sentence_id) -> label, for every label already received by an earlier (interrupted) run
+    labels = {}
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    label = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  #a line cut short by an interruption
+                labels[(label['topic_id'], label['sentence_id'])] = label
+    return labels
+
+def label_topics(client, gpt_key, topic_ids, sentence_ids=None, checkpoint_path=None, candidates=None, use_prefilter=True, batch_size=BATCH_SIZE, max_batch_tokens=MAX_BATCH_TOKENS, max_concurrency=4, max_rounds=3):
+    #labels the candidate sentences of each topic (by default, every sentence not yet labelled for it) and writes the labels to sentence_label; rerunning with the same checkpoint resumes
+    #in one request scope, so that candidate_sentences reuses the labels read by load_topics
+    with request_scope():
+        gpt_id = gpt_labeller_id(client)
+        topics = load_topics(client, topic_ids, gpt_id)
+        candidates = candidates if candidates is not None else candidate_sentences(client, topic_ids, sentence_ids, use_prefilter=use_prefilter)
+    done = read_checkpoint(checkpoint_path)
+    checkpoint = open(checkpoint_path, 'a', encoding='utf-8') if checkpoint_path else None
+    lock = threading.Lock()
+    pending = []
+    statistics = {'candidates': sum(len(c) for c in candidates.values()), 'resumed': 0, 'labelled': 0, 'written': 0, 'unlabelled': 0, 'batches': 0}
+
+    def write(labels, flush=False):
+        #buffers labels and writes them to sentence_label in bulk
+        with lock:
+            pending.extend(labels)
+            if not pending or (len(pending) < WRITE_BATCH_SIZE and not flush):
+                return
+            documents = [{'labeller_id': gpt_id, 'sentence_id': l['sentence_id'], 'topic_id': l['topic_id'], 'position_in_text': -1, 'confidence': LABEL_CONFIDENCE[l['label']], 'explanation': l['explanation']} for l in pending]
+            pending.clear()
+        with span('write labels', n_labels=len(documents)):
+            insert_in_bulk(client, 'sentence_label', documents)
+        with lock:
+            statistics['written'] += len(documents)
+
+    def run_batch(topic, batch):
+        labels = label_batch(gpt_key, topic, batch)
+        with lock:
+            if checkpoint is not None:
+                checkpoint.write(''.join(json.dumps(l) + '\n' for l in labels))
+                checkpoint.flush()
+            statistics['labelled'] += len(labels)
+        count('gpt labelled sentences', len(labels))
+        write(labels)
+        return labels
+
+    try:
+        #labels from the checkpoint that never reached Elasticsearch (candidates exclude sentences already labelled for the topic) are written first
+        todo = {}
+        for topic_id, sentences in candidates.items():
+            resumed = [done[(topic_id, s['sentence_id'])] for s in sentences if (topic_id, s['sentence_id']) in done]
+            statistics['resumed'] += len(resumed)
+            write(resumed)
+            todo[topic_id] = [s for s in sentences if (topic_id, s['sentence_id']) not in done]
+
+        #sentences GPT skipped or mislabelled in a round are packed again in the next
+        for _ in range(max_rounds):
+            batches = [(topics[topic_id], batch) for topic_id, sentences in todo.items() for batch in pack_batches(sentences, batch_size, max_batch_tokens)]
+            if not batches:
+                break
+            statistics['batches'] += len(batches)
+            answered = set()
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, run_batch, topic, batch) for topic, batch in batches]
+                for future in as_completed(futures):
+                    try:
+                        answered.update((l['topic_id'], l['sentence_id']) for l in future.result())
+                    except Exception as e:
+                        print(f'Labelling batch failed: {e}')
+            todo = {topic_id: [s for s in sentences if (topic_id, s['sentence_id']) not in answered] for topic_id, sentences in todo.items()}
+        statistics['unlabelled'] = sum(len(sentences) for sentences in todo.values())
+    finally:
+        write([], flush=True)
+        if checkpoint is not None:
+            checkpoint.close()
+    return statistics
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Label sentences for saved topics with GPT, writing the labels to sentence_label under the GPT labeller. Rerunning with the same checkpoint resumes.')
+    parser.add_argument('topic_ids', nargs='+', help='Ids of the topics to label for, e.g. c40.')
+    parser.add_argument('--sentence-ids', nargs='*', default=None, help='Sentences to label. Defaults to every sentence not yet labelled for the topic.')
+    parser.add_argument('--checkpoint', default='gpt_labelling.jsonl', help='JSONL file receiving every label as it arrives.')
+    parser.add_argument('--no-prefilter', action='store_true', help='Label every sentence, not only those mentioning a keyword or name variation of the topic.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Maximum number of sentences per GPT request.')
+    parser.add_argument('--max-concurrency', type=int, default=4, help='Maximum number of GPT requests in flight.')
+    args = parser.parse_args()
+
+    load_dotenv('credentials.env')
+    ELASTIC_HOST=os.getenv('ELASTIC_HOST')
+    ELASTIC_USER=os.getenv('ELASTIC_USER')
+    ELASTIC_PASS=os.getenv('ELASTIC_PASS')
+    GPT_TOPICS_KEY=os.getenv('GPT_TOPICS_KEY')
+    client = create_es_client(ELASTIC_HOST, ELASTIC_USER, ELASTIC_PASS)
+    missing = missing_definitions(client, args.topic_ids)
+    if missing:
+        parser.error(f"no saved definition for topic id(s) {', '.join(missing)}; save the topic's definition before labelling for it")
+
+    with gpt_context(session='gpt_labelling', priority='batch'):
+        print(label_topics(client, GPT_TOPICS_KEY, args.topic_ids, args.sentence_ids, args.checkpoint, use_prefilter=not args.no_prefilter, batch_size=args.batch_size, max_concurrency=args.max_concurrency))
@@ -0,0 +1,127 @@
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+import threading
+import time
+
+#Budget of the OpenAI organisation. All GPT calls of the process share it, whichever session or batch job makes them.
+TOKENS_PER_MINUTE = int(os.getenv('OPENAI_TOKENS_PER_MINUTE', 40000))
+REQUESTS_PER_MINUTE = int(os.getenv('OPENAI_REQUESTS_PER_MINUTE', 500))
+ESTIMATED_COMPLETION_TOKENS = 1000
+#Lower is served first: interactive requests of users waiting in the app go ahead of offline batch work.
+PRIORITIES = {'interactive': 0, 'batch': 1}
+
+_gpt_context = ContextVar('gpt_context', default={'session': 'default', 'priority': 'interactive'})
+
+@contextmanager
+def gpt_context(session=None, priority=None):
+    #GPT calls made within this context (also from jobs submitted within it) are queued under this session and priority
+    current = _gpt_context.get()
+    token = _gpt_context.set({'session': session or current['session'], 'priority': priority or current['priority']})
+    try:
+        yield
+    finally:
+        _gpt_context.reset(token)
+
+class TokenBucket:
+    #refills continuously at capacity per minute; the level may go negative when a request turns out larger than estimated, or after a rate limit
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount):
+        #requests larger than the whole bucket wait for a full bucket rather than forever
+        self.refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60 / self.capacity)
+
+    def drain(self, seconds):
+        #empty the bucket so that the next request waits the given number of seconds
+        self.refill()
+        self.level = min(self.level, -seconds * self.capacity / 60)
+
+class GPTScheduler:
+    def __init__(self, tokens_per_minute=TOKENS_PER_MINUTE, requests_per_minute=REQUESTS_PER_MINUTE):
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.requests = TokenBucket(requests_per_minute)
+        self.condition = threading.Condition()
+        #per priority, a round-robin of sessions, each with its own first-in first-out queue of waiting requests
+        self.lanes = {priority: OrderedDict() for priority in PRIORITIES}
+        self.statistics = {'requests': 0, 'rate_limited': 0, 'tokens': 0, 'total_wait': 0.0, 'max_wait': 0.0}
+
+    def _next_ticket(self):
+        for priority in sorted(self.lanes, key=PRIORITIES.get):
+            for session, queue in self.lanes[priority].items():
+                return priority, session, queue[0]
+        return None
+
+    def acquire(self, estimated_tokens, session, priority):
+        ticket = object()
+        enqueued = time.monotonic()
+        with self.condition:
+            self.lanes[priority].setdefault(session, deque()).append(ticket)
+            while True:
+                next_priority, next_session, next_ticket = self._next_ticket()
+                wait = max(self.tokens.wait_time(estimated_tokens), self.requests.wait_time(1))
+                if next_ticket is ticket and wait == 0:
+                    break
+                self.condition.wait(timeout=wait if next_ticket is ticket else None)
+            queue = self.lanes[priority][session]
+            queue.popleft()
+            #the session goes to the back of the round-robin, or leaves it when it has nothing more waiting
+            del self.lanes[priority][session]
+            if queue:
+                self.lanes[priority][session] = queue
+            self.tokens.level -= estimated_tokens
+            self.requests.level -= 1
+            waited = time.monotonic() - enqueued
+            self.statistics['requests'] += 1
+            self.statistics['total_wait'] += waited
+            self.statistics['max_wait'] = max(self.statistics['max_wait'], waited)
+            self.condition.notify_all()
+
+    def release(self, estimated_tokens, used_tokens):
+        #correct the estimate with what the request actually used
+        with self.condition:
+            self.tokens.level -= used_tokens - estimated_tokens
+            self.statistics['tokens'] += used_tokens
+            self.condition.notify_all()
+
+    def rate_limited(self, retry_after):
+        #a 429 means the real budget is spent: hold every queued request back for retry_after seconds rather than letting each retry on its own
+        with self.condition:
+            self.statistics['rate_limited'] += 1
+            self.tokens.drain(retry_after)
+            self.requests.drain(retry_after)
+            self.condition.notify_all()
+
+    def metrics(self):
+        with self.condition:
+            return {
+                'queue_depth': {priority: sum(len(queue) for queue in sessions.values()) for priority, sessions in self.lanes.items()},
+                'requests': self.statistics['requests'],
+                'rate_limited': self.statistics['rate_limited'],
+                'tokens': self.statistics['tokens'],
+                'mean_wait': self.statistics['total_wait'] / max(1, self.statistics['requests']),
+                'max_wait': self.statistics['max_wait']
+            }
+
+    @contextmanager
+    def slot(self, estimated_tokens):
+        #waits for a turn under the current session and priority; the caller reports the tokens actually used through the yielded dictionary
+        context = _gpt_context.get()
+        self.acquire(estimated_tokens, context['session'], context['priority'])
+        usage = {'tokens': estimated_tokens}
+        try:
+            yield usage
+        finally:
+            self.release(estimated_tokens, usage['tokens'])
+
+scheduler = GPTScheduler()
@@ -1,84 +1,42 @@
-from openai import OpenAI
-import os
-import json
-from dotenv import load_dotenv
-
-def call_gpt(gpt_key, system_content, assistant_content, user_content, custom_output_function, max_n_tries):
-    for i in range(max_n_tries):
-        try:
-            client = OpenAI(
-            api_key=gpt_key,
-            )
-            model = 'gpt-4'
-
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_content},
-                    {"role": "assistant", "content": assistant_content},
-                    {"role": "user", "content": user_content},
-                ],
-                tools = custom_output_function,
-                tool_choice = 'auto'
-            )
-            response = json.loads(response.model_dump()["choices"][0]["message"]["tool_calls"][0]["function"]["arguments"])
-            return response
-        except Exception as e:
-            if i == max_n_tries - 1:
-                print(e)
-                quit()
+from src.prompt_builder import build_topic_information, format_sentence
+from src.gpt_augmentation import call_gpt
 
 def write_topic_information(n, sentences, topic_name, topic_definition, keywords, name_variations, difficult_cases):
-    topic_information = f'You are tasked with labelling the following topic:\n\n{topic_name}\n{topic_definition}'
-
-    topic_information += '\n\nHere are some keywords that are often associated with the topic. Note, the mere presence of a keyword in a sentence does not guarantee the presence of the topic.'
-    for keyword in keywords:
-        topic_information += f'\n{keyword}'
-
-    topic_information += '\n\nHere are some name variations for the topic: other ways in which it is commonly referred to.'
-    for name_variation in name_variations:
-        topic_information += f'\n{name_variation}'
-
-    topic_information += '\n\nHere are some descriptions of difficult cases for the topic. These are cases which, for whatever reason, might confuse the labeller and lead them to place an incorrect or inaccurate label.'
-    for difficult_case in difficult_cases:
-        topic_information += f'\n{difficult_case}'
-
-    topic_information += f'\n\nHere is the dictionary with sentences. Your task is to choose {n} sentences from this dictionary, returning their text.'
-    for sentence in sentences:
-        topic_information += f'\n{sentence}'
-    return topic_information
+    sentence_header = f'Here is the numbered list of sentences. Your task is to choose {n} sentences from this list, returning their numbers.'
+    sentence_lines = [format_sentence(i, s) for i, s in enumerate(sentences, start=1)]
+    return build_topic_information(topic_name, topic_definition, keywords, name_variations, difficult_cases, sentence_header, sentence_lines)
 
 def generate_sentence_selection_prompt(n, sentences, topic_name, topic_definition, keywords, name_variations, difficult_cases):
     introduction_content = f'You are an assistant in a Natural Language Processing, Named Entity Recogniition model-training environment. In particular, you are adept at selecting the most suitable training sentences, which will, using the smallest possible number of sentences, provide the largest possible variation in the data, the largest possible context. You will be selecting sentences for the following topic:' 
     topic_information = write_topic_information(n, sentences, topic_name, topic_definition, keywords, name_variations, difficult_cases)
-    instruction_content = f'Consider the sentences in the input dictionary, and return a list with {n} of these sentences according to the utility they provide. The output should be a dictionary with only the sentence_text of the chosen {n} sentences. When preparing this dictionary, make sure that you select the most important sentences. Make sure that you consider the interplay between the sentences: if two sentences say the same thing, then including both at in the list makes little sense; if one sentence is rather unique, maybe this provides a lot of variation to the data, which might make it more important. Make sure to consider the topic context provided above: a sentence is only relevant with respect to how it contributes to the unerstanding of the context of the topic. Notice that the input sentences are labelled with both "No" and "Yes", it is likely a good idea to include a balanced mixture of these labels in the sentences you select. Please take your time, and respect these instructions.'
+    instruction_content = f'Consider the sentences in the input list, and return a list with {n} of these sentences according to the utility they provide. The output should be a list with only the numbers of the chosen {n} sentences, as given in the numbered list. When preparing this list, make sure that you select the most important sentences. Make sure that you consider the interplay between the sentences: if two sentences say the same thing, then including both at in the list makes little sense; if one sentence is rather unique, maybe this provides a lot of variation to the data, which might make it more important. Make sure to consider the topic context provided above: a sentence is only relevant with respect to how it contributes to the unerstanding of the context of the topic. Notice that the input sentences are labelled with both "No" and "Yes", it is likely a good idea to include a balanced mixture of these labels in the sentences you select. Please take your time, and respect these instructions.'
     system_content = 'You are a training-sample optimisiation expert, proficient at selecting the most efficient training set for a Named Entity Recognition model.'
     assistant_content = ''
     user_content = introduction_content + topic_information + '\n\n' + instruction_content
     return system_content, assistant_content, user_content
 
 def generate_sentence_selection_custom_function(n):
-    properties = {}
-    for i in range(1, n + 1):
-        properties[f'sentence_text_{i}'] = {
-            'type': 'string',
-            'description': 'A sentence that you would have a difficult time labelling with respect to the given topic.'
-        }
-
-    required = []
-    for i in range(1,n+1):
-        required.append(f'sentence_text_{i}')
-
     custom_output_function = [
         {
             'type': 'function',
             'function': {
-                'name': 'sentence_generation',
-                'description': 'Generate sentences for a given topic that would be difficult to label for.',
+                'name': 'sentence_selection',
+                'description': 'Select sentences from the numbered list by their numbers.',
                 'parameters': {
                     'type': 'object',
-                    'properties': properties,
-                    'required': required
+                    'properties': {
+                        'sentence_numbers': {
+                            'type': 'array',
+                            'items': {
+                                'type': 'integer',
+                                'description': 'The number of a selected sentence in the numbered list.'
+                            },
+                            'minItems': n,
+                            'maxItems': n,
+                            'description': f'The numbers of the {n} selected sentences.'
+                        }
+                    },
+                    'required': ['sentence_numbers']
                 }
             }
         }
@@ -90,12 +48,9 @@ def select_n_sentences(gpt_key, n, sentences, topic_name, topic_definition, keyw
     system_content, assistant_content, user_content = generate_sentence_selection_prompt(n, sentences, topic_name, topic_definition, keywords, name_variations, difficult_cases)
     custom_output_function = generate_sentence_selection_custom_function(n)
     response = call_gpt(gpt_key, system_content, assistant_content, user_content, custom_output_function, max_n_tries)
-    selected_sentences = [i[1] for i in response.items()]
-    l = []
-    for s in sentences:
-        if s['sentence_text'] in selected_sentences:
-            l.append(s)
-    return l
+    #numbers in the prompt are 1-based positions in sentences; ignore any that are out of range or repeated
+    selected_numbers = list(dict.fromkeys(k for k in response['sentence_numbers'] if isinstance(k, int) and 1 <= k <= len(sentences)))
+    return [sentences[k - 1] for k in selected_numbers[:n]]
 
 if __name__ == "__main__":
     topic_name = 'Corporate Bonds'
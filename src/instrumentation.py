@@ -0,0 +1,180 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+#Lightweight tracing of the topic insertion flow: span timers around each stage, and counters (GPT requests and tokens, Elasticsearch round-trips).
+#Within trace(), spans and counters are collected per run; they are always added to process-wide totals, exported as Prometheus text.
+#Every finished span is logged as one JSON line on the 'topic_modelling.trace' logger; set TRACE_LOG to a file path, or to 'stderr', to write these.
+#If OpenTelemetry is installed, every span is also an OpenTelemetry span, exported by whatever tracer provider the process configures.
+PROMETHEUS_TEXTFILE = os.getenv('PROMETHEUS_TEXTFILE')
+
+logger = logging.getLogger('topic_modelling.trace')
+if os.getenv('TRACE_LOG'):
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler() if os.getenv('TRACE_LOG') == 'stderr' else logging.FileHandler(os.getenv('TRACE_LOG')))
+
+try:
+    from opentelemetry import trace as opentelemetry_trace
+    _tracer = opentelemetry_trace.get_tracer('topic_modelling')
+except ImportError:
+    _tracer = None
+
+_trace = ContextVar('trace', default=None)
+_current_span = ContextVar('current_span', default=None)
+
+_totals_lock = threading.Lock()
+_span_totals = defaultdict(lambda: {'count': 0, 'seconds': 0.0})
+_counter_totals = Counter()
+
+
+@contextmanager
+def trace(name=None):
+    """Collects the spans and counters of everything run within this context, also in threads and jobs started with a copy of the context.
+
+    Args:
+        name (str, optional): Defaults to None. If given, the whole trace is also a span of this name.
+
+    Yields:
+        dict: The trace, with keys 'spans' (list of finished spans, each a dictionary with 'name', 'parent', 'start' (seconds since the trace started), 'seconds' and attributes)
+        and 'counters' (Counter, e.g. 'gpt tokens'). Filled in while the context runs; see export_trace for a JSON-serialisable copy.
+    """
+    current = {'spans': [], 'counters': Counter(), 'started': time.monotonic(), 'lock': threading.Lock()}
+    token = _trace.set(current)
+    try:
+        if name is None:
+            yield current
+        else:
+            with span(name):
+                yield current
+    finally:
+        _trace.reset(token)
+        if PROMETHEUS_TEXTFILE:
+            write_prometheus_textfile(PROMETHEUS_TEXTFILE)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times the code within this context as a span, nested under the enclosing span.
+
+    Args:
+        name (str): Name of the stage, e.g. 'gpt generate_sentences' or 'encode'.
+        **attributes: Any JSON-serialisable details to keep with the span, e.g. the number of texts encoded.
+    """
+    parent = _current_span.get()
+    token = _current_span.set(name)
+    current = _trace.get()
+    start = time.monotonic()
+    opentelemetry_span = _tracer.start_as_current_span(name, attributes=attributes) if _tracer is not None else None
+    if opentelemetry_span is not None:
+        opentelemetry_span.__enter__()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - start
+        if opentelemetry_span is not None:
+            opentelemetry_span.__exit__(None, None, None)
+        _current_span.reset(token)
+        record = {'name': name, 'parent': parent, 'seconds': seconds, **attributes}
+        if current is not None:
+            with current['lock']:
+                current['spans'].append({**record, 'start': start - current['started']})
+        with _totals_lock:
+            _span_totals[name]['count'] += 1
+            _span_totals[name]['seconds'] += seconds
+        logger.info(json.dumps({'event': 'span', **record}, default=str))
+
+
+def timed(name=None):
+    """Decorator that runs every call of a function as a span, named after the function unless a name is given."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1) -> None:
+    """Adds n to a counter of the active trace, if any, and of the process-wide totals.
+
+    Args:
+        name (str): Name of the counter, e.g. 'gpt tokens' or 'es scan sentence_label'.
+        n (int, optional): Defaults to 1.
+    """
+    current = _trace.get()
+    if current is not None:
+        with current['lock']:
+            current['counters'][name] += n
+    with _totals_lock:
+        _counter_totals[name] += n
+
+
+def export_trace(current: dict) -> dict:
+    """Copies a trace into a JSON-serialisable dictionary, e.g. to store it with a job result.
+
+    Args:
+        current (dict): A trace yielded by trace().
+
+    Returns:
+        dict: Keys 'spans' and 'counters'.
+    """
+    with current['lock']:
+        return {'spans': list(current['spans']), 'counters': dict(current['counters'])}
+
+
+def summarise(finished_trace: dict) -> list:
+    """Totals the spans of a trace per name, for display.
+
+    Args:
+        finished_trace (dict): A trace yielded by trace(), or exported by export_trace.
+
+    Returns:
+        list: One dictionary per span name, with keys 'span', 'parent', 'count' and 'seconds', in order of first start.
+    """
+    rows = {}
+    for s in sorted(finished_trace['spans'], key=lambda s: s['start']):
+        row = rows.setdefault(s['name'], {'span': s['name'], 'parent': s['parent'], 'count': 0, 'seconds': 0.0})
+        row['count'] += 1
+        row['seconds'] += s['seconds']
+    return list(rows.values())
+
+
+def _metric_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def prometheus_text() -> str:
+    """Renders the process-wide span totals and counters in the Prometheus text exposition format.
+
+    Returns:
+        str: The metrics, one sample per line.
+    """
+    with _totals_lock:
+        span_totals = {name: dict(total) for name, total in _span_totals.items()}
+        counter_totals = dict(_counter_totals)
+    lines = ['# HELP topic_modelling_span_seconds Time spent in each stage.', '# TYPE topic_modelling_span_seconds summary']
+    for name, total in sorted(span_totals.items()):
+        lines.append(f'topic_modelling_span_seconds_sum{{span="{_metric_label(name)}"}} {total["seconds"]}')
+        lines.append(f'topic_modelling_span_seconds_count{{span="{_metric_label(name)}"}} {total["count"]}')
+    lines += ['# HELP topic_modelling_events_total GPT requests and tokens, Elasticsearch round-trips and other counts.', '# TYPE topic_modelling_events_total counter']
+    for name, n in sorted(counter_totals.items()):
+        lines.append(f'topic_modelling_events_total{{event="{_metric_label(name)}"}} {n}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus_textfile(path: str) -> None:
+    """Writes prometheus_text() to a file for the node exporter's textfile collector, replacing the file atomically.
+
+    Args:
+        path (str): Path of the .prom file.
+    """
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+        f.write(prometheus_text())
+    os.replace(f'{path}.tmp', path)
@@ -0,0 +1,168 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import hashlib
+import importlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from src.instrumentation import trace, export_trace
+
+JOB_DIRECTORY = os.path.realpath('.jobs')
+DATABASE_PATH = os.path.join(JOB_DIRECTORY, 'jobs.sqlite')
+MAX_WORKERS = int(os.getenv('JOB_MAX_WORKERS', 4))
+#finished and failed jobs are deleted once they have not been updated for this many days; the sweep runs when the queue is first used and then at most once an hour
+JOB_RETENTION_DAYS = float(os.getenv('JOB_RETENTION_DAYS', 30))
+SWEEP_INTERVAL_SECONDS = 3600
+
+_executor = None
+_futures = {}
+_lock = threading.Lock()
+_last_sweep = 0.0
+
+
+def _connect() -> sqlite3.Connection:
+    os.makedirs(JOB_DIRECTORY, exist_ok=True)
+    connection = sqlite3.connect(DATABASE_PATH, timeout=30)
+    connection.execute('CREATE TABLE IF NOT EXISTS job (id TEXT PRIMARY KEY, function TEXT, arguments TEXT, metadata TEXT, status TEXT, result TEXT, error TEXT, created REAL, updated REAL, trace TEXT)')
+    #queues created before jobs were traced lack the trace column
+    if 'trace' not in [column[1] for column in connection.execute('PRAGMA table_info(job)')]:
+        connection.execute('ALTER TABLE job ADD COLUMN trace TEXT')
+    return connection
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='job')
+    return _executor
+
+
+def delete_old_jobs(max_age_days=JOB_RETENTION_DAYS) -> int:
+    """Deletes the finished and failed jobs that have not been updated for max_age_days, so that the queue does not grow without bound.
+    Queued and running jobs are kept whatever their age, as they may still be resumed. Sessions that still refer to a deleted job find no job, as for an unknown id.
+
+    Args:
+        max_age_days (float, optional): Defaults to JOB_RETENTION_DAYS (env, 30).
+
+    Returns:
+        int: The number of jobs deleted.
+    """
+    with _connect() as connection:
+        return connection.execute("DELETE FROM job WHERE status IN ('done', 'failed') AND updated < ?", (time.time() - max_age_days * 86400,)).rowcount
+
+
+def job_key(function: str, arguments: dict, metadata=None) -> str:
+    """Hashes a function, its arguments and the metadata kept with the job, so that submitting the same input twice refers to the same job.
+    The metadata is part of the key because it is returned with the result (see src/result_store.py): the same arguments with other metadata are another job.
+
+    Args:
+        function (str): The job function, as 'module:name'.
+        arguments (dict): Keyword arguments of the function. Must be JSON-serialisable.
+        metadata (dict, optional): Defaults to None. The metadata kept with the job.
+
+    Returns:
+        str: Hexadecimal sha256 digest.
+    """
+    return hashlib.sha256(json.dumps({'function': function, 'arguments': arguments, 'metadata': metadata}, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _update_job(id, **fields) -> None:
+    fields['updated'] = time.time()
+    with _connect() as connection:
+        connection.execute(f"UPDATE job SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?", (*fields.values(), id))
+
+
+def _run_job(id, function, arguments) -> None:
+    _update_job(id, status='running')
+    with trace(function) as job_trace:
+        try:
+            module_name, function_name = function.split(':')
+            result = getattr(importlib.import_module(module_name), function_name)(**arguments)
+            status = {'status': 'done', 'result': json.dumps(result)}
+        except Exception:
+            status = {'status': 'failed', 'error': traceback.format_exc()}
+    try:
+        _update_job(id, **status, trace=json.dumps(export_trace(job_trace), default=str))
+    finally:
+        with _lock:
+            _futures.pop(id, None)
+
+
+def job_status(id: str) -> dict:
+    """Reads a job from the queue.
+
+    Args:
+        id (str): The job id returned by submit_job.
+
+    Returns:
+        dict: Keys 'id', 'status' ('queued', 'running', 'done' or 'failed'), 'result', 'error', 'metadata', 'created', 'updated', and 'trace' (the spans and counters of the run, see src/instrumentation.py); None if there is no such job.
+    """
+    with _connect() as connection:
+        row = connection.execute('SELECT id, status, result, error, metadata, created, updated, trace FROM job WHERE id = ?', (id,)).fetchone()
+    if row is None:
+        return None
+    return {
+        'id': row[0],
+        'status': row[1],
+        'result': json.loads(row[2]) if row[2] is not None else None,
+        'error': row[3],
+        'metadata': json.loads(row[4]) if row[4] is not None else None,
+        'created': row[5],
+        'updated': row[6],
+        'trace': json.loads(row[7]) if row[7] is not None else None
+    }
+
+
+def submit_job(function: str, arguments: dict, metadata=None, regenerate=False) -> str:
+    """Runs a function in the background and persists its status and result in a SQLite queue on disk, keyed by a hash of the input.
+    If the same input has already been submitted, the existing job is returned: a finished job is not rerun, and neither is one still in progress in this process.
+    Jobs that failed, or that were interrupted by a server restart, are run again. With regenerate, the function is run again as a new job whatever was submitted before.
+    Jobs run on a thread pool rather than a process pool, so that they share the loaded embedding model and the process-wide state of the caller (e.g. context variables) with the Streamlit server.
+
+    Args:
+        function (str): The job function, as 'module:name', e.g. 'src.user_input_maximisation:input_maximised'.
+        arguments (dict): Keyword arguments of the function. Must be JSON-serialisable, as must the result.
+        metadata (dict, optional): Defaults to None. Any JSON-serialisable context to keep with the job, e.g. the form input it was submitted from.
+        regenerate (bool, optional): Defaults to False. Whether to bypass an earlier job with the same input, e.g. to get new GPT output. The earlier job is kept, as other sessions may use its result.
+
+    Returns:
+        str: The job id.
+    """
+    global _last_sweep
+    id = job_key(function, arguments, metadata) if not regenerate else uuid.uuid4().hex
+    with _lock:
+        if time.time() - _last_sweep > SWEEP_INTERVAL_SECONDS:
+            delete_old_jobs()
+            _last_sweep = time.time()
+        job = job_status(id)
+        if job is not None and (job['status'] == 'done' or id in _futures):
+            return id
+        now = time.time()
+        with _connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO job VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (id, function, json.dumps(arguments), json.dumps(metadata), 'queued', None, None, now, now, None))
+        context = contextvars.copy_context()
+        _futures[id] = _get_executor().submit(context.run, _run_job, id, function, arguments)
+    return id
+
+
+def resume_job(id: str) -> None:
+    """Reruns a queued or running job that has no worker in this process, i.e. one that was interrupted by a server restart. Does nothing otherwise.
+
+    Args:
+        id (str): The job id returned by submit_job.
+    """
+    with _lock:
+        if id in _futures:
+            return
+        with _connect() as connection:
+            row = connection.execute("SELECT function, arguments FROM job WHERE id = ? AND status IN ('queued', 'running')", (id,)).fetchone()
+        if row is None:
+            return
+        function, arguments = row[0], json.loads(row[1])
+        _update_job(id, status='queued')
+        context = contextvars.copy_context()
+        _futures[id] = _get_executor().submit(context.run, _run_job, id, function, arguments)
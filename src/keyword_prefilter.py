@@ -0,0 +1,129 @@
+from collections import deque, defaultdict
+import hashlib
+import json
+import re
+import threading
+from src.instrumentation import span, count
+from src.utils import search_document
+
+#Candidate (sentence, topic) pairs from the keywords and name variations of the saved topics: a sentence is a candidate for a topic if it contains one of
+#the topic's keywords or name variations (or its name). All patterns of all topics are compiled into one Aho-Corasick automaton over normalised words,
+#so a sentence is scanned once whatever the number of topics, and patterns only match whole words ('rate' is not found in 'separate').
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:['’][a-z]+)?")
+
+_matcher_lock = threading.Lock()
+_loaded_matcher = {}
+
+def stem(word):
+    #plural and possessive forms to a common stem ('bonds', 'currencies', 'taxes', "bank's"), which is where most keyword misses come from. The stem need not
+    #be a word, only the same for the singular and the plural: -es is stripped after s, x, z, ch and sh, and so is the final e of the singular ('houses' and
+    #'house' to 'hous'), and -is like its plural -es ('analysis' and 'analyses' to 'analys'). Verb forms are left alone, as stripping them without a
+    #dictionary merges unrelated words ('rated' and 'rat')
+    word = word.replace('’', "'").removesuffix("'s")
+    if len(word) <= 3:
+        return word
+    if word.endswith('ies'):
+        return word[:-3] + 'y'
+    if word.endswith(('ses', 'xes', 'zes', 'ches', 'shes')):
+        return word[:-2]
+    if word.endswith('is'):
+        return word[:-2]
+    if word.endswith('s') and not word.endswith(('ss', 'us')):
+        return word[:-1]
+    if word.endswith(('se', 'xe', 'ze', 'che', 'she')):
+        return word[:-1]
+    return word
+
+def normalise(text):
+    return [stem(word) for word in TOKEN_PATTERN.findall(text.lower())]
+
+class KeywordMatcher:
+    #Aho-Corasick automaton whose alphabet is normalised words: goto holds the trie, fail the longest proper suffix of each state that is also a state,
+    #and output the topics of every pattern ending at a state (its own and, through fail, those of its suffixes)
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+        self.n_patterns = 0
+        for topic_id, pattern in patterns:
+            words = normalise(pattern)
+            if not words:
+                continue
+            state = 0
+            for word in words:
+                if word not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                    self.goto[state][word] = len(self.goto) - 1
+                state = self.goto[state][word]
+            self.output[state].add(topic_id)
+            self.n_patterns += 1
+        #breadth-first, so that the fail state of a state's parent is complete before the state itself; states one word deep fail to the root
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and word not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(word, 0)
+                self.output[next_state] |= self.output[self.fail[next_state]]
+
+    def __len__(self):
+        return self.n_patterns
+
+    def match(self, text):
+        #the topics with at least one pattern in the text
+        topics, state = set(), 0
+        for word in normalise(text):
+            while state and word not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(word, 0)
+            topics |= self.output[state]
+        return topics
+
+def topic_patterns(definitions):
+    #(topic_id, pattern) for the name, keywords and name variations of every definition; a topic may have several definitions (e.g. drafts), all are used
+    as_list = lambda value: value if isinstance(value, list) else [value] if value else []
+    patterns = set()
+    for definition in definitions:
+        for pattern in [definition.get('name')] + as_list(definition.get('keyword')) + as_list(definition.get('name_variation')):
+            if pattern:
+                patterns.add((definition['topic_id'], pattern))
+    return sorted(patterns)
+
+def load_matcher(client, topic_ids=None):
+    #the automaton for the current definitions, rebuilt only when a fingerprint of their patterns changes; returns the matcher and the topics it covers
+    identifier = {'topic_id': list(topic_ids)} if topic_ids else {}
+    patterns = topic_patterns(search_document(client, 'topic_entity_definition', identifier))
+    fingerprint = hashlib.sha256(json.dumps(patterns).encode('utf-8')).hexdigest()
+    with _matcher_lock:
+        if fingerprint not in _loaded_matcher:
+            with span('build keyword matcher', n_patterns=len(patterns)):
+                _loaded_matcher.clear()
+                _loaded_matcher[fingerprint] = KeywordMatcher(patterns)
+        matcher = _loaded_matcher[fingerprint]
+    return matcher, {topic_id for topic_id, _ in patterns}
+
+def candidate_pairs(matcher, sentences, topic_ids=None):
+    #one pass over an iterable of {'sentence_id', 'sentence_text'}, yielding (sentence, topic_id) for every topic (of topic_ids, if given) the sentence matches
+    topic_ids = set(topic_ids) if topic_ids is not None else None
+    n_sentences, n_pairs = 0, 0
+    for sentence in sentences:
+        n_sentences += 1
+        for topic_id in sorted(matcher.match(sentence['sentence_text'])):
+            if topic_ids is None or topic_id in topic_ids:
+                n_pairs += 1
+                yield sentence, topic_id
+    count('prefilter sentences', n_sentences)
+    count('prefilter candidates', n_pairs)
+
+def prefilter(client, sentences, topic_ids):
+    #per topic, the sentences that mention it; topics without any pattern cannot be prefiltered, so they keep every sentence
+    matcher, covered = load_matcher(client, topic_ids)
+    candidates = defaultdict(list)
+    for sentence, topic_id in candidate_pairs(matcher, sentences, topic_ids):
+        candidates[topic_id].append(sentence)
+    return {topic_id: candidates[topic_id] if topic_id in covered else list(sentences) for topic_id in topic_ids}
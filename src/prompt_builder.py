@@ -0,0 +1,55 @@
+from functools import lru_cache
+import random
+import tiktoken
+
+#Token budget of each section of the topic information in a prompt. The sentence section dominates, the lists are usually far below their budget.
+DEFAULT_SECTION_BUDGETS = {
+    'keywords': 300,
+    'name_variations': 300,
+    'difficult_cases': 1000,
+    'sentences': 3000
+}
+
+@lru_cache(maxsize=1)
+def load_encoding():
+    return tiktoken.encoding_for_model('gpt-4')
+
+def count_tokens(text):
+    return len(load_encoding().encode(text))
+
+def format_sentence(i, sentence, include_label=True, include_explanation=True):
+    line = f"{i}. {sentence['sentence_text']}"
+    if include_label and 'label' in sentence:
+        line += f" | Label: {sentence['label']}"
+    if include_explanation and 'explanation' in sentence:
+        line += f" | Explanation: {sentence['explanation']}"
+    return line
+
+def fit_to_budget(lines, budget, seed=0):
+    costs = [count_tokens(line) + 1 for line in lines]
+    if sum(costs) <= budget:
+        return lines
+    #not everything fits: sample lines in a seeded order until the budget is spent, and keep the sampled lines in their original order
+    order = list(range(len(lines)))
+    random.Random(seed).shuffle(order)
+    kept, total = [], 0
+    for i in order:
+        if total + costs[i] <= budget:
+            kept.append(i)
+            total += costs[i]
+    return [lines[i] for i in sorted(kept)]
+
+def build_section(header, lines, budget, seed=0):
+    lines = fit_to_budget(lines, budget, seed)
+    return '\n\n' + header + ''.join(f'\n{line}' for line in lines)
+
+def build_topic_information(topic_name, topic_definition, keywords, name_variations, difficult_cases, sentence_header, sentence_lines, budgets=None, seed=0):
+    budgets = {**DEFAULT_SECTION_BUDGETS, **(budgets or {})}
+    sections = [
+        f'You are tasked with labelling the following topic:\n\n{topic_name}\n{topic_definition}',
+        build_section('Here are some keywords that are often associated with the topic. Note, the mere presence of a keyword in a sentence does not guarantee the presence of the topic.', keywords, budgets['keywords'], seed),
+        build_section('Here are some name variations for the topic: other ways in which it is commonly referred to.', name_variations, budgets['name_variations'], seed),
+        build_section('Here are some descriptions of difficult cases for the topic. These are cases which, for whatever reason, might confuse the labeller and lead them to place an incorrect or inaccurate label.', difficult_cases, budgets['difficult_cases'], seed),
+        build_section(sentence_header, sentence_lines, budgets['sentences'], seed)
+    ]
+    return ''.join(sections)
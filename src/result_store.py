@@ -0,0 +1,71 @@
+from collections import OrderedDict
+import threading
+from src.job_queue import job_status
+
+#Results of finished jobs (generated sentences, suggestions, keyword lists), kept once per process rather than copied into each session's st.session_state.
+#A result is read from the job queue on disk the first time a session asks for it, and dropped from memory once no active session uses it;
+#it stays on disk, so a session that comes back (e.g. with the job id in its url) simply reads it again.
+MAX_RESULTS_IN_MEMORY = 32
+
+_results = OrderedDict()
+_sessions = {}
+_lock = threading.Lock()
+
+
+def _is_active_session(session_id) -> bool:
+    from streamlit.runtime import Runtime
+    if not Runtime.exists():
+        return True
+    return Runtime.instance().is_active_session(session_id)
+
+
+def _evict() -> None:
+    for job_id in list(_results):
+        _sessions[job_id] = {session_id for session_id in _sessions.get(job_id, set()) if _is_active_session(session_id)}
+        if not _sessions[job_id]:
+            del _results[job_id], _sessions[job_id]
+    #a backstop for results still held by many open sessions: the least recently used are dropped, and read again from disk when needed
+    while len(_results) > MAX_RESULTS_IN_MEMORY:
+        job_id, _ = _results.popitem(last=False)
+        _sessions.pop(job_id, None)
+
+
+def get_result(job_id: str, session_id: str) -> dict:
+    """Returns the result of a finished job, merged into the metadata it was submitted with, and records that the session uses it.
+    The dictionary is shared between all sessions with the same job, so treat it as read-only.
+
+    Args:
+        job_id (str): The job id returned by submit_job.
+        session_id (str): The Streamlit session id.
+
+    Returns:
+        dict: The metadata and result of the job; None if the job is not done.
+    """
+    with _lock:
+        if job_id in _results:
+            _results.move_to_end(job_id)
+            _sessions[job_id].add(session_id)
+            result = _results[job_id]
+            _evict()
+            return result
+    job = job_status(job_id)
+    if job is None or job['status'] != 'done':
+        return None
+    result = {**(job['metadata'] or {}), **job['result']}
+    with _lock:
+        _results[job_id] = result
+        _sessions.setdefault(job_id, set()).add(session_id)
+        _evict()
+    return result
+
+
+def release_session(session_id: str) -> None:
+    """Records that a session no longer uses any result, e.g. after it has saved its topic, and drops results that no active session uses.
+
+    Args:
+        session_id (str): The Streamlit session id.
+    """
+    with _lock:
+        for sessions in _sessions.values():
+            sessions.discard(session_id)
+        _evict()
@@ -0,0 +1,34 @@
+import numpy as np
+
+def balanced_quotas(label_counts, n):
+    #split n as evenly as possible over the labels, never giving a label more sentences than it has
+    quotas = np.zeros(len(label_counts), dtype=int)
+    while quotas.sum() < min(n, label_counts.sum()):
+        available = np.where(quotas < label_counts, quotas, np.iinfo(int).max)
+        quotas[np.argmin(available)] += 1
+    return quotas
+
+def k_center_greedy(corpus_embeddings, n, labels=None):
+    embeddings = corpus_embeddings / np.linalg.norm(corpus_embeddings, axis=1, keepdims=True)
+    labels = labels if labels is not None else [0] * len(embeddings)
+    _, label_codes, label_counts = np.unique(labels, return_inverse=True, return_counts=True)
+    quotas = balanced_quotas(label_counts, n)
+
+    selected = []
+    allowed = np.ones(len(embeddings), dtype=bool)
+    #start from the sentence closest to the centroid, then repeatedly add the sentence farthest (in cosine distance) from everything selected so far
+    distance = embeddings @ embeddings.mean(axis=0)
+    while quotas.sum() > 0:
+        i = int(np.argmax(np.where(allowed & (quotas[label_codes] > 0), distance, -np.inf)))
+        selected.append(i)
+        allowed[i] = False
+        quotas[label_codes[i]] -= 1
+        if len(selected) == 1:
+            distance = 1 - embeddings @ embeddings[i]
+        else:
+            distance = np.minimum(distance, 1 - embeddings @ embeddings[i])
+    return selected
+
+def diversity_suggestion(sentences, n, corpus_embeddings):
+    labels = [sentence['label'] for sentence in sentences]
+    return [sentences[i] for i in k_center_greedy(corpus_embeddings, n, labels)]
@@ -1,11 +1,38 @@
 from src.gpt_augmentation import generate_kw_nv_dc, generate_n_sentences
 from src.gpt_sentence_suggestions import select_n_sentences
-from src.cluster_sentences import yes_no_cluster_sentences
+from src.cluster_sentences import yes_no_cluster_representatives, create_embeddings
+from src.sentence_selection import diversity_suggestion
+from src.vector_index import FlatIndex, filter_near_duplicates, load_corpus_index
 import streamlit as st
+import hashlib
+import json
 import random
+from src.instrumentation import span, timed
 
-def input_maximised(n_kw_nv_dc, n_new_sentences, n_gpt_suggestions, topic_name, topic_definition, keywords, name_variations, difficult_cases, labelled_sentences):
-    gpt_key = st.secrets["GPT_TOPICS_KEY"]
+@timed('remove near duplicates')
+def remove_near_duplicates(groups):
+    #each group is (existing_texts, new_items, new_texts, extra_reference_indices); new items that paraphrase an existing text, an item in the extra indices, or an earlier new item are dropped
+    #all texts of all groups are embedded in one call
+    texts = [text for existing_texts, _, new_texts, _ in groups for text in existing_texts + new_texts]
+    if not texts:
+        return [[] for _ in groups]
+    embeddings = create_embeddings(texts, only_text=True)
+    kept_items, start = [], 0
+    for existing_texts, new_items, new_texts, extra_reference_indices in groups:
+        existing_embeddings = embeddings[start:start + len(existing_texts)]
+        new_embeddings = embeddings[start + len(existing_texts):start + len(existing_texts) + len(new_texts)]
+        start += len(existing_texts) + len(new_texts)
+        reference_indices = [index for index in extra_reference_indices if index is not None]
+        if len(existing_texts) > 0:
+            existing_index = FlatIndex(embeddings.shape[1], capacity=len(existing_texts))
+            existing_index.add(existing_embeddings)
+            reference_indices.append(existing_index)
+        kept = filter_near_duplicates(new_embeddings, reference_indices) if len(new_texts) > 0 else []
+        kept_items.append([new_items[i] for i in kept])
+    return kept_items
+
+@timed('generate augmentations')
+def generate_augmentations(gpt_key, n_kw_nv_dc, n_new_sentences, topic_name, topic_definition, keywords, name_variations, difficult_cases, labelled_sentences):
     new_keywords, new_name_variations, new_difficult_cases = [], [], []
     for i in range(n_kw_nv_dc):
         new = generate_kw_nv_dc(gpt_key, topic_name, topic_definition, keywords, name_variations, difficult_cases, labelled_sentences)
@@ -14,25 +41,46 @@ def input_maximised(n_kw_nv_dc, n_new_sentences, n_gpt_suggestions, topic_name,
         new_difficult_cases.extend(new['difficult_cases'])
     
     new_sentences = generate_n_sentences(gpt_key, n_new_sentences, topic_name, topic_definition, keywords, name_variations, difficult_cases, labelled_sentences)
+    return {'gpt_sentences': new_sentences, 'new_keywords':new_keywords, 'new_name_variations':new_name_variations, 'new_difficult_cases':new_difficult_cases}
+
+def texts_to_embed(augmentations, keywords, name_variations, difficult_cases, labelled_sentences):
+    #every text that suggest_sentences embeds, so that the texts of many topics can be embedded together in one batch beforehand
+    sentences = labelled_sentences + augmentations['gpt_sentences']
+    return [s['sentence_text'] for s in sentences] + [s['explanation'] for s in sentences] + keywords + augmentations['new_keywords'] + name_variations + augmentations['new_name_variations'] + difficult_cases + augmentations['new_difficult_cases']
+
+def seed_key(topic_name, topic_definition, labelled_sentences):
+    #identifies the input a user seeded a topic with, for the cluster index: the same seed processed again (e.g. regenerated) shares its clusters, while
+    #another user's topic of the same name does not
+    seed = {'topic_name': topic_name, 'topic_definition': topic_definition, 'labelled_sentences': labelled_sentences}
+    return hashlib.sha256(json.dumps(seed, sort_keys=True).encode('utf-8')).hexdigest()
+
+def suggest_sentences(gpt_key, n_gpt_suggestions, topic_name, topic_definition, keywords, name_variations, difficult_cases, labelled_sentences, augmentations, corpus_index=None):
+    new_sentences, new_keywords, new_name_variations, new_difficult_cases = remove_near_duplicates([
+        ([s['sentence_text'] for s in labelled_sentences], augmentations['gpt_sentences'], [s['sentence_text'] for s in augmentations['gpt_sentences']], [corpus_index]),
+        (keywords, augmentations['new_keywords'], augmentations['new_keywords'], []),
+        (name_variations, augmentations['new_name_variations'], augmentations['new_name_variations'], []),
+        (difficult_cases, augmentations['new_difficult_cases'], augmentations['new_difficult_cases'], [])
+    ])
+
     sentences = labelled_sentences + new_sentences
+    with span('embed sentences', n_sentences=len(sentences)):
+        corpus_embeddings = create_embeddings(sentences, only_text=False)
+    with span('cluster suggestion'):
+        #clusters are kept per seed, so processing the same seed again with a few more sentences assigns those to the existing clusters
+        cluster_suggestion = yes_no_cluster_representatives(sentences, corpus_embeddings, key=seed_key(topic_name, topic_definition, labelled_sentences))
+    with span('embedding suggestion'):
+        embedding_suggestion = diversity_suggestion(sentences, n_gpt_suggestions, corpus_embeddings)
 
-    random.shuffle(sentences)
-    clusters = yes_no_cluster_sentences(sentences)
-    cluster_suggestion = []
-    for cluster in clusters:
-        for s in cluster:
-            b = False
-            if topic_name not in s['sentence_text']:
-                cluster_suggestion.append(s)
-                b = True
-                break
-        if b:
-            continue
-        else:
-            cluster_suggestion.append(s)
+    #GPT sees the sentences in random order, so that it does not favour the input sentences listed first
+    shuffled_sentences = random.sample(sentences, len(sentences))
+    gpt_suggestion = select_n_sentences(gpt_key, n_gpt_suggestions, shuffled_sentences, topic_name, topic_definition, keywords, name_variations, difficult_cases)
+    return {'labelled_sentences': labelled_sentences, 'gpt_sentences': new_sentences, 'gpt_suggestion':gpt_suggestion, 'cluster_suggestion':cluster_suggestion, 'embedding_suggestion':embedding_suggestion, 'new_keywords':new_keywords, 'new_name_variations':new_name_variations, 'new_difficult_cases':new_difficult_cases}
 
-    gpt_suggestion = select_n_sentences(gpt_key, n_gpt_suggestions, sentences, topic_name, topic_definition, keywords, name_variations, difficult_cases)
-    return {'labelled_sentences': labelled_sentences, 'gpt_sentences': new_sentences, 'gpt_suggestion':gpt_suggestion, 'cluster_suggestion':cluster_suggestion, 'new_keywords':new_keywords, 'new_name_variations':new_name_variations, 'new_difficult_cases':new_difficult_cases}
+def input_maximised(n_kw_nv_dc, n_new_sentences, n_gpt_suggestions, topic_name, topic_definition, keywords, name_variations, difficult_cases, labelled_sentences, corpus_index_path=None):
+    gpt_key = st.secrets["GPT_TOPICS_KEY"]
+    augmentations = generate_augmentations(gpt_key, n_kw_nv_dc, n_new_sentences, topic_name, topic_definition, keywords, name_variations, difficult_cases, labelled_sentences)
+    corpus_index = load_corpus_index(corpus_index_path) if corpus_index_path else None
+    return suggest_sentences(gpt_key, n_gpt_suggestions, topic_name, topic_definition, keywords, name_variations, difficult_cases, labelled_sentences, augmentations, corpus_index)
 
 if __name__ == "__main__":
     topic_name = 'Corporate Bonds'
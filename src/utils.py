@@ -1,14 +1,21 @@
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, ConflictError, NotFoundError
 from elasticsearch.helpers import scan, bulk
 from typing import Callable
 import numpy as np
 import os
 import json
-from iterstrat.ml_stratifiers import MultilabelStratifiedShuffleSplit
 from dotenv import load_dotenv
-import pandas as pd
+from src.es_schema import index_schema
+from src.instrumentation import count
 from itertools import product
 import random
+import hashlib
+import unicodedata
+import math
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
 
 def create_es_client(ELASTIC_HOST, ELASTIC_USER, ELASTIC_PASS) -> Elasticsearch:
     """Connect to ElasticSearch, using our API/client-pass. Run as, for instance, client = create_es_client(). client is used in any call to the database.
@@ -65,30 +72,205 @@ def insert_document(client: Elasticsearch, index: str, document: dict) -> None:
         document (dict): A dictionary with keys corresponding to the index fields.
     """    
     client.index(index=index, document=document)
+    count_round_trips(f'index {index}')
 
 
-def match_query(identifier: dict) -> dict:
+def sentence_hash(sentence_text: str) -> str:
+    """Hashes a sentence text after normalising it (unicode NFKC, case folding, collapsed whitespace), so that trivially different spellings of the same sentence share a hash.
+    The hash is stored in the keyword field 'sentence_hash' of labelled_sentence, and is what we use to look up and deduplicate sentences.
+
+    Args:
+        sentence_text (str): The sentence text.
+
+    Returns:
+        str: Hexadecimal sha256 digest of the normalised text.
+    """    
+    normalised = ' '.join(unicodedata.normalize('NFKC', sentence_text).casefold().split())
+    return hashlib.sha256(normalised.encode('utf-8')).hexdigest()
+
+
+#sentence_hash -> '_id' of the labelled_sentence document, shared by all sessions in the process. Only ever holds documents that have been seen in the index.
+#Bounded: the least recently used hashes are dropped past SENTENCE_HASH_CACHE_SIZE entries, and looked up in the index again when needed.
+SENTENCE_HASH_CACHE_SIZE = int(os.getenv('SENTENCE_HASH_CACHE_SIZE', 100000))
+sentence_hash_to_id = OrderedDict()
+_sentence_hash_lock = threading.Lock()
+
+
+def _cached_sentence_id(h: str) -> str:
+    with _sentence_hash_lock:
+        if h not in sentence_hash_to_id:
+            return None
+        sentence_hash_to_id.move_to_end(h)
+        return sentence_hash_to_id[h]
+
+
+def _cache_sentence_id(h: str, sentence_id: str) -> None:
+    with _sentence_hash_lock:
+        sentence_hash_to_id[h] = sentence_id
+        sentence_hash_to_id.move_to_end(h)
+        while len(sentence_hash_to_id) > SENTENCE_HASH_CACHE_SIZE:
+            sentence_hash_to_id.popitem(last=False)
+
+
+def resolve_sentence_id(client: Elasticsearch, sentence_text: str) -> str:
+    """Finds the '_id' of the labelled_sentence document with the same normalised text, first in the in-memory cache, otherwise by a term lookup on 'sentence_hash'.
+
+    Args:
+        client (Elasticsearch): Client connection to Elasticsearch.
+        sentence_text (str): The sentence text.
+
+    Returns:
+        str: The '_id' of the existing document, or None if the sentence is not in the index.
+    """    
+    h = sentence_hash(sentence_text)
+    sentence_id = _cached_sentence_id(h)
+    if sentence_id is not None:
+        return sentence_id
+    response = client.search(index='labelled_sentence', query={'term': {'sentence_hash': h}}, size=1, source=False)
+    count_round_trips('search labelled_sentence')
+    hits = response['hits']['hits']
+    if not hits:
+        return None
+    _cache_sentence_id(h, hits[0]['_id'])
+    return hits[0]['_id']
+
+
+def insert_sentence(client: Elasticsearch, document: dict) -> str:
+    """Idempotent insert into labelled_sentence: if a sentence with the same normalised text already exists, its '_id' is returned and nothing is written.
+    Otherwise the document is created with its 'sentence_hash' as '_id', so that two sessions saving the same sentence at once cannot both insert it:
+    the second create conflicts, and the sentence the first one wrote is used. There is no need to refresh the index and search for it afterwards.
+
+    Args:
+        client (Elasticsearch): Client connection to Elasticsearch.
+        document (dict): A labelled_sentence document, must contain 'sentence_text'.
+
+    Returns:
+        str: The '_id' of the labelled_sentence document holding this sentence.
+    """    
+    sentence_id = resolve_sentence_id(client, document['sentence_text'])
+    if sentence_id is not None:
+        return sentence_id
+    h = sentence_hash(document['sentence_text'])
+    try:
+        client.index(index='labelled_sentence', id=h, document={**document, 'sentence_hash': h}, op_type='create')
+    except ConflictError:
+        #created by another session since the lookup above
+        pass
+    count_round_trips('index labelled_sentence')
+    _cache_sentence_id(h, h)
+    return h
+
+
+def load_sentence_hashes(client: Elasticsearch, batch_size=1000) -> None:
+    """Fills the in-memory sentence_hash -> '_id' cache from labelled_sentence, so that later lookups of known sentences need no request at all.
+    Stops once the cache is full (SENTENCE_HASH_CACHE_SIZE), rather than scanning the rest of the index only to evict what it read first.
+
+    Args:
+        client (Elasticsearch): Client connection to Elasticsearch.
+        batch_size (int, optional): Defaults to 1000. Batch size for accessing data. Max 10000, typically 1000 is a reasonable value.
+    """    
+    query = {"query": {"exists": {"field": "sentence_hash"}}, "_source": ["sentence_hash"]}
+    for i, hit in enumerate(scan(client, index='labelled_sentence', query=query, size=batch_size)):
+        if i >= SENTENCE_HASH_CACHE_SIZE:
+            break
+        _cache_sentence_id(hit['_source']['sentence_hash'], hit['_id'])
+
+
+def backfill_sentence_hashes(client: Elasticsearch, batch_size=1000) -> None:
+    """Migration: maps 'sentence_hash' as a keyword field and computes it for every labelled_sentence document that lacks it.
+    Documents are streamed from a scroll straight into bulk updates, so the index is never held in memory.
+
+    Args:
+        client (Elasticsearch): Client connection to Elasticsearch.
+        batch_size (int, optional): Defaults to 1000. Batch size for accessing data. Max 10000, typically 1000 is a reasonable value.
+    """    
+    client.indices.put_mapping(index='labelled_sentence', properties={'sentence_hash': {'type': 'keyword'}})
+    query = {"query": {"bool": {"must_not": {"exists": {"field": "sentence_hash"}}}}, "_source": ["sentence_text"]}
+    updates = (
+        {
+            '_op_type': 'update',
+            '_index': 'labelled_sentence',
+            '_id': hit['_id'],
+            'doc': {'sentence_hash': sentence_hash(hit['_source']['sentence_text'])}
+        }
+        for hit in scan(client, index='labelled_sentence', query=query, size=batch_size)
+    )
+    bulk(client, updates, chunk_size=batch_size)
+
+
+#index -> {field: the field to match exactly}, read from the live mapping once per process (see exact_fields below)
+_exact_fields = {}
+
+
+def exact_fields(client: Elasticsearch, index: str) -> dict:
+    """The field to use for exact matches of each field of an index. Until an index has been migrated to the explicit mapping of src/es_schema.py
+    (python -m src.es_schema migrate), its strings are dynamically mapped as analysed text with a 'keyword' subfield: a term query on the text field
+    compares against lowercased tokens, so mixed-case ids and values such as 'GPT' would never match, and the subfield has to be used instead.
+    The mapping is read once per process and cached, until clear_exact_fields is called (migrate_index does so), so restart the app after migrating from another process.
+
+    Args:
+        client (Elasticsearch): Client connection to Elasticsearch.
+        index (str): Name (or alias) of the index.
+
+    Returns:
+        dict: Field name -> f'{field}.keyword' for text fields with a keyword subfield. Fields that are not listed are matched as they are.
+    """    
+    if index not in _exact_fields:
+        try:
+            mappings = list(client.indices.get_mapping(index=index).body.values())
+        except NotFoundError:
+            return {}
+        count_round_trips(f'mapping {index}')
+        properties = mappings[0]['mappings'].get('properties', {}) if mappings else {}
+        _exact_fields[index] = {field: f'{field}.keyword' for field, mapping in properties.items() if mapping.get('type') == 'text' and 'keyword' in mapping.get('fields', {})}
+    return _exact_fields[index]
+
+
+def clear_exact_fields(index=None) -> None:
+    """Forgets the cached mappings of exact_fields, e.g. after an index has been migrated to a new mapping.
+
+    Args:
+        index (str, optional): Defaults to None. Name (or alias) of the index to forget; all indices if None.
+    """    
+    if index is None:
+        _exact_fields.clear()
+    else:
+        _exact_fields.pop(index, None)
+
+
+def match_query(identifier: dict, text_fields=(), field_names=None) -> dict:
     """A function used elsewhere to search for documents with particular values in given fields.
     It is easy to either access an entire index or one parituclar document, less straight-forward collecting all documents which match a specific set of criteria.
+    Fields are matched exactly with term (or terms, if the value is a list) clauses in filter context, which are neither analysed nor scored, and are cached by Elasticsearch. Only the fields in text_fields get an analysed full-text match.
     
     Args:
-        identifier (dict): A dictionary which can have one or more keys, where each key corresponds to a field, where the values must match exactly.
+        identifier (dict): A dictionary which can have one or more keys, where each key corresponds to a field, where the values must match exactly. A value can be a list, in which case a document matches if the field has any of the listed values.
+        text_fields (tuple, optional): Defaults to (). Fields that should be matched as full text rather than exactly.
+        field_names (dict, optional): Defaults to None. The field to match exactly in place of a field of identifier, e.g. from exact_fields above for indices that are still dynamically mapped.
 
     Returns:
         dict: A nested dictionary which is inputted as a query in functions calling the database.
     """    
+    field_names = field_names or {}
+    must, filters = [], []
+    for key, value in identifier.items():
+        if key in text_fields:
+            must.append({'match': {key: value}})
+        elif isinstance(value, (list, tuple, set)):
+            filters.append({'terms': {field_names.get(key, key): list(value)}})
+        else:
+            filters.append({'term': {field_names.get(key, key): value}})
     return {
         'query': {
             'bool': {
-                'must': [
-                    {'match': {key: value}} for key, value in identifier.items()
-                ]
+                'must': must,
+                'filter': filters
             }
         }
     }
 
 
-def delete_document(client: Elasticsearch, index: str, identifier: dict, delete_all=False) -> None:
+def delete_document(client: Elasticsearch, index: str, identifier: dict, delete_all=False, text_fields=()) -> None:
     """Deletes one or more documents from a given index.
 
     Args:
@@ -96,18 +278,58 @@ def delete_document(client: Elasticsearch, index: str, identifier: dict, delete_
         index (str): The index from which the document or documents will be deleted.
         identifier (dict): Identifier (see match_query above) is a dictionary, with as many keys as is necessary to select the desired documents. If identifier is empty, this will delete the entire index.
         delete_all (bool, optional): Defaults to False. If want to delete entire index, set to True, with identifier={}.
+        text_fields (tuple, optional): Defaults to (). Fields of identifier that are matched as full text (see match_query above).
 
     Raises:
         ValueError: If identifier is empty, indicating a desire to delete the index, but delete_all is False, will raise a warning.
     """       
     if (not identifier and delete_all) or identifier:
-        query = match_query(identifier)
+        query = match_query(identifier, text_fields, exact_fields(client, index))
         client.delete_by_query(index=index, body=query)
     else:
         raise ValueError("Refusing to delete all documents without explicit `delete_all` flag set to True.")
 
 
-def search_document(client: Elasticsearch, index: str, identifier: dict, all=False, batch_size=1000) -> list:
+#The active request scope, if any: a cache of search_document results and a count of round-trips to Elasticsearch per operation.
+_request_scope = ContextVar('request_scope', default=None)
+
+
+@contextmanager
+def request_scope():
+    """Within this context, search_document returns cached results for repeated reads of the same index and identifier instead of opening a new scroll,
+    and every read is counted in round-trips per operation. The scope is per thread/context, so concurrent Streamlit sessions do not share it.
+    The cached results are shared by every caller within the scope, so treat them as read-only. The app enters a scope per page render and per save.
+    Run as, for instance:
+        with request_scope() as scope:
+            joined = join_sl_and_los(client)
+            train, test = train_test_split_stratified(client, joined, 0.8, False)
+        print(scope['round_trips'])
+
+    Yields:
+        dict: The scope, with keys 'documents' (the cache) and 'round_trips' (a Counter keyed by operation, e.g. 'scan topic_entity').
+    """    
+    scope = {'documents': {}, 'round_trips': Counter()}
+    token = _request_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _request_scope.reset(token)
+
+
+def count_round_trips(operation: str, n=1) -> None:
+    """Adds n round-trips to Elasticsearch for the given operation to the active request scope, and to the 'es {operation}' counter of the active trace (see src/instrumentation.py).
+
+    Args:
+        operation (str): Name of the operation, e.g. 'scan sentence_label'.
+        n (int, optional): Defaults to 1. Number of round-trips.
+    """    
+    count(f'es {operation}', n)
+    scope = _request_scope.get()
+    if scope is not None:
+        scope['round_trips'][operation] += n
+
+
+def search_document(client: Elasticsearch, index: str, identifier: dict, all=False, batch_size=1000, text_fields=(), source_excludes=()) -> list:
     """Retrieves one or more documents from a given index. 
 
     Args:
@@ -116,20 +338,97 @@ def search_document(client: Elasticsearch, index: str, identifier: dict, all=Fal
         identifier (dict): Identifier (see match_query above) is a dictionary, with as many keys as is necessary to select the desired documents. If identifier is empty, the function will retireve the entire index. Otherwise it will select all documents which match identifier, which could be one ore more doocuments.
         all (bool, optional): Defaults to False. Whether to return only the document, or also the '_id' and extra more general information.
         batch_size (int, optional): Defaults to 1000. Batch size for accessing data. Max 10000, typically 1000 is a reasonable value.
+        text_fields (tuple, optional): Defaults to (). Fields of identifier that are matched as full text (see match_query above).
+        source_excludes (tuple, optional): Defaults to (). Fields left out of the returned documents, e.g. ('sentence_embedding',) when reading labelled_sentence.
 
     Returns:
-        list: A list of dictionaries, each dictionary corresponding to a document in the index.
+        list: A list of dictionaries, each dictionary corresponding to a document in the index. Inside request_scope, repeated reads are served from the scope's cache,
+            and the same list is returned to every caller: do not modify it.
     """    
+    scope = _request_scope.get()
+    key = (index, json.dumps(identifier, sort_keys=True, default=list), all, tuple(text_fields), tuple(source_excludes))
+    if scope is not None and key in scope['documents']:
+        return scope['documents'][key]
     documents = []
-    query = {"query": {"match_all": {}}} if not identifier else {"query": match_query(identifier)['query']}
+    query = {"query": {"match_all": {}}} if not identifier else {"query": match_query(identifier, text_fields, exact_fields(client, index))['query']}
+    if source_excludes:
+        query['_source'] = {'excludes': list(source_excludes)}
     for hit in scan(client, index=index, query=query, size=batch_size):
         if not all:
             documents.append(hit['_source'])
         else:
             documents.append(hit)
+    #the initial search plus one scroll per non-empty page
+    count_round_trips(f'scan {index}', 1 + math.ceil(len(documents) / batch_size))
+    if scope is not None:
+        scope['documents'][key] = documents
     return documents
 
 
+def search_documents_by(client: Elasticsearch, index: str, field: str, values: list, all=False, batch_size=1000, source_excludes=()) -> dict:
+    """Retrieves the documents of an index for many values of one field with a single terms query, instead of one search_document per value.
+    Inside request_scope, the documents of each value are also stored in the scope, so that a later search_document(client, index, {field: value}) is served without a round-trip.
+
+    Args:
+        client (Elasticsearch): Client connection to Elasticsearch.
+        index (str): The index from which the documents will be retrieved.
+        field (str): The field to match, e.g. 'topic_id', or '_id'.
+        values (list): The values of field to retrieve documents for.
+        all (bool, optional): Defaults to False. As in search_document.
+        batch_size (int, optional): Defaults to 1000. As in search_document.
+        source_excludes (tuple, optional): Defaults to (). As in search_document.
+
+    Returns:
+        dict: For every value, the list of documents (as returned by search_document) with that value, empty if none.
+    """
+    values = list(dict.fromkeys(values))
+    grouped = {value: [] for value in values}
+    for document in search_document(client, index, {field: values}, all, batch_size, source_excludes=source_excludes) if values else []:
+        value = document['_id'] if field == '_id' else (document['_source'] if all else document).get(field)
+        for v in value if isinstance(value, list) else [value]:
+            if v in grouped:
+                grouped[v].append(document)
+    scope = _request_scope.get()
+    if scope is not None:
+        for value, documents in grouped.items():
+            scope['documents'][(index, json.dumps({field: value}, sort_keys=True, default=list), all, (), tuple(source_excludes))] = documents
+    return grouped
+
+
+def knn_search(client: Elasticsearch, index: str, field: str, query_vectors: list, k=10, num_candidates=100, identifier=None) -> list:
+    """Approximate nearest-neighbour search on a dense_vector field, for one or more query vectors in a single _msearch round-trip.
+
+    Args:
+        client (Elasticsearch): Client connection to Elasticsearch.
+        index (str): The index to search.
+        field (str): The dense_vector field, e.g. 'sentence_embedding'.
+        query_vectors (list): List of query vectors, each a list (or array) of floats with the dimension of the field.
+        k (int, optional): Defaults to 10. Number of neighbours returned per query vector.
+        num_candidates (int, optional): Defaults to 100. Number of candidates considered per shard; higher is more accurate and slower.
+        identifier (dict, optional): Defaults to None. Restricts the search to documents matching identifier (see match_query above).
+
+    Raises:
+        ValueError: If Elasticsearch rejects the search, e.g. because the field is not mapped as an indexed dense_vector.
+
+    Returns:
+        list: For each query vector, a list of hits (with '_id', '_score' and '_source', without the vector itself), most similar first.
+    """    
+    searches = []
+    for query_vector in query_vectors:
+        knn = {'field': field, 'query_vector': [float(x) for x in query_vector], 'k': k, 'num_candidates': max(k, num_candidates)}
+        if identifier:
+            knn['filter'] = match_query(identifier, field_names=exact_fields(client, index))['query']
+        searches.extend([{'index': index}, {'knn': knn, 'size': k, '_source': {'excludes': [field]}}])
+    if not searches:
+        return []
+    responses = client.msearch(searches=searches)['responses']
+    count_round_trips(f'knn {index}')
+    for response in responses:
+        if 'error' in response:
+            raise ValueError(f"kNN search on {index}.{field} failed: {response['error']}")
+    return [response['hits']['hits'] for response in responses]
+
+
 def insert_in_bulk(client: Elasticsearch, index: str, table: dict) -> None:
     """Inserts a large number of rows into an index.
 
@@ -140,10 +439,12 @@ def insert_in_bulk(client: Elasticsearch, index: str, table: dict) -> None:
     """    
     actions = [{"_index": index,"_source": document} for document in table]
     bulk(client, actions)
+    #the bulk helper sends chunks of 500 actions
+    count_round_trips(f'bulk {index}', max(1, math.ceil(len(actions) / 500)))
 
 
 def create_index(client: Elasticsearch, index: str, table: dict) -> None:
-    """Creates a new index, with a given name, with inserted documents.
+    """Creates a new index, with a given name, with inserted documents. Indices listed in src/es_schema.py are created with their explicit mapping and settings.
 
     Args:
         client (Elasticsearch): Client connection to Elasticsearch.
@@ -151,32 +452,92 @@ def create_index(client: Elasticsearch, index: str, table: dict) -> None:
         table (dict): List of dictionaries, where each dictionary represents a row in the table: keys correspond to columns.
     """    
     if not client.indices.exists(index=index):
-        client.indices.create(index=index)
+        client.indices.create(index=index, **index_schema(index))
         insert_in_bulk(client, index, table)
 
 
-def join_sl_and_los(client: Elasticsearch, include_parent_topic_label = True) -> list:
+def allocate_topic_id(client: Elasticsearch, prefix='c', start=40, max_n_tries=10) -> str:
+    """Allocates a new topic id of the form f'{prefix}{n}' from a counter document in the index 'id_counter'.
+    The counter is incremented with optimistic concurrency (if_seq_no/if_primary_term), so concurrent sessions never receive the same id; a session that loses the race simply retries.
+    The first time it is used the counter is seeded from the largest existing id in topic_entity.
+
+    Args:
+        client (Elasticsearch): Client connection to Elasticsearch.
+        prefix (str, optional): Defaults to 'c'. Prefix of the topic ids.
+        start (int, optional): Defaults to 40. Smallest number that will be allocated.
+        max_n_tries (int, optional): Defaults to 10. Number of attempts before giving up under contention.
+
+    Raises:
+        RuntimeError: If no id could be allocated in max_n_tries attempts.
+
+    Returns:
+        str: The new topic id.
+    """    
+    counter_id = f'topic_id_{prefix}'
+    for i in range(max_n_tries):
+        try:
+            count_round_trips('get id_counter')
+            counter = client.get(index='id_counter', id=counter_id)
+        except NotFoundError:
+            numbers = [int(t['id'][len(prefix):]) for t in search_document(client, 'topic_entity', {}) if t['id'].startswith(prefix) and t['id'][len(prefix):].isdigit()]
+            try:
+                client.create(index='id_counter', id=counter_id, document={'next': max(numbers + [start - 1]) + 1}, refresh=True)
+            except ConflictError:
+                pass
+            continue
+        n = counter['_source']['next']
+        try:
+            count_round_trips('index id_counter')
+            client.index(index='id_counter', id=counter_id, document={'next': n + 1}, if_seq_no=counter['_seq_no'], if_primary_term=counter['_primary_term'])
+        except ConflictError:
+            continue
+        return f'{prefix}{n}'
+    raise RuntimeError(f'Could not allocate a topic id after {max_n_tries} attempts.')
+
+
+def human_labeller_ids(client: Elasticsearch) -> set:
+    """Returns the '_id's of the labellers of type 'Human', i.e. everyone except GPT.
+
+    Args:
+        client (Elasticsearch): Client connection to Elasticsearch.
+
+    Returns:
+        set: The '_id's of the human labellers.
+    """    
+    return {i['_id'] for i in search_document(client, 'labeller',{},all=True) if i['_source']['type'] == 'Human'}
+
+
+def join_sl_and_los(client: Elasticsearch, include_parent_topic_label = True, include_gpt = False) -> list:
     """Returns a list of dictionaries which are joins on the sentence_labels and labelled_sentences indices.
     If one particular sentence has multiple entries in the sentence_labels index (due to having multiple labels) certain fields (such as 'topics') will have lists of labels. For the fields with lists, each index position corresponds to one document in sentence_labels.
+    By default only human labels are joined, so sentences labelled by GPT alone are left out.
 
     Args:
         client (Elasticsearch): Client connection to Elasticsearch.
         include_parent_topic_label (bool, optional): Defaults to True. Whether or not to include parent topics as labels for each sentence.
+        include_gpt (bool, optional): Defaults to False. Whether or not to also join the labels written by GPT.
 
     Returns:
         list: A list of dictionaries, each dictionary corresponding to a sentence from labelled_sentences and its labels in sentence_labels
     """    
     joined = []
     d = {}
-    ls = search_document(client, 'labelled_sentence',{},all=True)
+    #the embeddings are by far the largest part of labelled_sentence, and are not needed here
+    ls = search_document(client, 'labelled_sentence',{},all=True,source_excludes=('sentence_embedding',))
     for i in ls:
-        d[i['_id']] = [i['_source']]
+        #copied, as the joined sentence is built in place and the read may be shared (see request_scope)
+        d[i['_id']] = [dict(i['_source'])]
     if include_parent_topic_label:
         ts = search_document(client, 'topic_entity',{})
         topic_to_parent = {}
         for t in ts:
             topic_to_parent[t['id']] = t['parent_topic_id']
     sentence_labels = search_document(client, 'sentence_label',{})
+    if not include_gpt:
+        human = human_labeller_ids(client)
+        sentence_labels = [sentence_label for sentence_label in sentence_labels if sentence_label['labeller_id'] in human]
+    if not sentence_labels:
+        return joined
     for sentence_label in sentence_labels:
         d[sentence_label['sentence_id']].append(sentence_label)
         if include_parent_topic_label:
@@ -199,8 +560,9 @@ def join_sl_and_los(client: Elasticsearch, include_parent_topic_label = True) ->
     return joined
 
 
-def train_test_split_stratified(client: Elasticsearch, list_dictionary_documents: list, train_proportion: float, run_diagnostics: bool, batch_size=1000, random_state=42) -> list:
+def train_test_split_stratified(client: Elasticsearch, list_dictionary_documents: list, train_proportion: float, run_diagnostics: bool, batch_size=1000, random_state=42, include_gpt=False) -> list:
     """Splits data into train and test samples. Stratisfies: also ensuring that for each topic there is a proportional split between train and test as well.
+    By default the labels written by GPT are removed from the sentences first (they are already left out by join_sl_and_los, unless it was asked to include them), and sentences left without labels are dropped.
 
     Args:
         client (Elasticsearch): Client connection to Elasticsearch.
@@ -209,14 +571,25 @@ def train_test_split_stratified(client: Elasticsearch, list_dictionary_documents
         run_diagnostics (bool): If True, prints train/test split proportion of output data, as well as split for each topic.
         batch_size (int, optional): Defaults to 1000. Batch size for accessing data. Max 10000, typically 1000 is a reasonable value.
         random_state (int, optional): Defaults to 42. Random_state for split process, reproducibility.
+        include_gpt (bool, optional): Defaults to False. Whether or not to keep the labels written by GPT.
 
     Returns:
         list: A list with two lists, first list is train sentences, second is test sentences.
     """        
-    topics = search_document(client, 'topic_entity',{'type':'Topic'},batch_size=batch_size)
-    topics.extend(search_document(client, 'topic_entity',{'type':'Subtopic'},batch_size=batch_size))
+    if not include_gpt:
+        human = human_labeller_ids(client)
+        label_fields = [k for k in index_schema('sentence_label')['mappings']['properties'] if k != 'sentence_id']
+        documents = []
+        for sentence in list_dictionary_documents:
+            keep = [j for j, labeller_id in enumerate(sentence['labeller_id']) if labeller_id in human]
+            if len(keep) == len(sentence['labeller_id']):
+                documents.append(sentence)
+            elif keep:
+                documents.append({**sentence, **{k: [sentence[k][j] for j in keep] for k in label_fields if k in sentence}})
+        list_dictionary_documents = documents
+    topics = [t for t in search_document(client, 'topic_entity',{},batch_size=batch_size) if t['type'].capitalize() in ('Topic','Subtopic')]
     topic_ids = [t['id'] for t in topics]
-    parent_ids = [next((t for t in topics if t['id'] == k), None)['parent_topic_id'] for k in topic_ids]
+    parent_ids = [t['parent_topic_id'] for t in topics]
 
     topics_binary = np.zeros((len(list_dictionary_documents),len(topic_ids)))
     for i, sentence in enumerate(list_dictionary_documents):
@@ -226,6 +599,8 @@ def train_test_split_stratified(client: Elasticsearch, list_dictionary_documents
                 if parent_ids[topic_ids.index(t)] != 'none0' and parent_ids[topic_ids.index(t)] not in sentence['topic_id']:
                     topics_binary[i][topic_ids.index(parent_ids[topic_ids.index(t)])] += 1
     
+    #imported here rather than at the top, as it pulls in scikit-learn, which the app does not otherwise need at startup
+    from iterstrat.ml_stratifiers import MultilabelStratifiedShuffleSplit
     msss = MultilabelStratifiedShuffleSplit(n_splits=1, test_size=1-train_proportion, random_state=random_state)
     for train_index, test_index in msss.split(list_dictionary_documents, topics_binary):
         train_sentences = [list_dictionary_documents[i] for i in train_index]
@@ -294,6 +669,7 @@ def co_labelling_grid(client: Elasticsearch):
         for i in p:
             ar[topics.index(i[0])][topics.index(i[1])] += 1
     np.fill_diagonal(ar,0)
+    import pandas as pd
     df = pd.DataFrame(ar,index=topics,columns=topics)
     df.to_csv('grid.csv',sep=',',index=True,encoding='utf-8')
 
@@ -304,13 +680,7 @@ def push_visualisation_data(client: Elasticsearch):
     Args: 
         client (Elasticsearch): Client connection to Elasticsearch.
     """        
-    labeller_type = {}
-    l = []
-    query = {"query": {"match_all": {}}}
-    for hit in scan(client, index='labeller', query=query, size=1000):
-        l.append(hit)
-    for i in l:
-        labeller_type[i['_id']] = i['_source']['type']
+    human = human_labeller_ids(client)
     l = search_document(client, 'topic_entity',{})
     id_name = {}
     parent = {}
@@ -321,7 +691,7 @@ def push_visualisation_data(client: Elasticsearch):
     tcv = search_document(client, 'topic_count_visualisation',{})
     sentence_id_topic_id = []
     for i in sl:
-        if labeller_type[i['labeller_id']] == 'Human':
+        if i['labeller_id'] in human:
             sentence_id_topic_id.append((i['sentence_id'],i['topic_id']))
     for i in sentence_id_topic_id:
         if parent[i[1]] != 'none0' and (i[0],parent[i[1]]) not in sentence_id_topic_id:
@@ -333,6 +703,9 @@ def push_visualisation_data(client: Elasticsearch):
             l.append({'sentence_id':i[0],'topic_name':id_name[i[1]]})
     if len(l) >0:
         insert_in_bulk(client, 'topic_count_visualisation',l)
+        #so that the next push (which skips the pairs already in the index) and the grid read right after see these pairs
+        client.indices.refresh(index='topic_count_visualisation')
+        count_round_trips('refresh topic_count_visualisation')
     
 
 if __name__ == "__main__":
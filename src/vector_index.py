@@ -0,0 +1,221 @@
+from elasticsearch import Elasticsearch, ApiError
+from elasticsearch.helpers import scan, bulk
+import numpy as np
+import math
+import os
+import threading
+from dotenv import load_dotenv
+from src.utils import create_es_client, knn_search, count_round_trips, search_documents_by
+from src.es_schema import INDEX_SCHEMAS
+
+CORPUS_INDEX_PATH = os.path.realpath('corpus_index.npz')
+SIMILARITY_THRESHOLD = 0.9
+
+_corpus_index_lock = threading.Lock()
+_loaded_corpus_indices = {}
+
+class FlatIndex:
+    #exact (brute-force) cosine similarity search over unit vectors, kept in a float32 buffer that doubles when full, so that adding vectors one batch at a time stays cheap
+    def __init__(self, dimension, capacity=1024):
+        self.vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        self.ids = []
+        self.id_set = set()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, id):
+        return id in self.id_set
+
+    def add(self, vectors, ids=None):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.vectors.shape[1])
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        while self.size + len(vectors) > len(self.vectors):
+            self.vectors = np.concatenate((self.vectors, np.zeros_like(self.vectors)))
+        self.vectors[self.size:self.size + len(vectors)] = vectors
+        ids = list(ids) if ids is not None else list(range(self.size, self.size + len(vectors)))
+        self.ids.extend(ids)
+        self.id_set.update(ids)
+        self.size += len(vectors)
+
+    def search(self, queries, k=1):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.vectors.shape[1])
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        similarity = queries @ self.vectors[:self.size].T
+        k = min(k, self.size)
+        top = np.argsort(-similarity, axis=1)[:, :k]
+        return np.take_along_axis(similarity, top, axis=1), [[self.ids[j] for j in row] for row in top]
+
+    def max_similarity(self, queries):
+        if self.size == 0:
+            return np.full(len(queries), -1.0)
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.vectors.shape[1])
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        return (queries @ self.vectors[:self.size].T).max(axis=1)
+
+    def save(self, path):
+        #write to a temporary file first, so that a reader never sees a half-written index
+        temporary_path = f'{path}.tmp.npz'
+        np.savez(temporary_path, vectors=self.vectors[:self.size], ids=np.array(self.ids, dtype=str))
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(data['vectors'].shape[1], capacity=max(1024, len(data['vectors'])))
+        index.add(data['vectors'], data['ids'].tolist())
+        return index
+
+def filter_near_duplicates(embeddings, reference_indices=(), threshold=SIMILARITY_THRESHOLD):
+    #returns the positions of the items to keep: an item is dropped if it is too similar to anything in one of the reference indices, or to an item kept before it
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    kept_index = FlatIndex(embeddings.shape[1], capacity=max(1, len(embeddings)))
+    reference_similarity = np.full(len(embeddings), -1.0)
+    for reference_index in reference_indices:
+        reference_similarity = np.maximum(reference_similarity, reference_index.max_similarity(embeddings))
+    kept = []
+    for i, embedding in enumerate(embeddings):
+        if reference_similarity[i] > threshold or kept_index.max_similarity(embedding[None, :])[0] > threshold:
+            continue
+        kept.append(i)
+        kept_index.add(embedding)
+    return kept
+
+def load_corpus_index(path=CORPUS_INDEX_PATH):
+    #the loaded index is kept in memory and only read again from disk when the file has changed
+    if not os.path.exists(path):
+        return None
+    modified = os.path.getmtime(path)
+    if path not in _loaded_corpus_indices or _loaded_corpus_indices[path][0] != modified:
+        _loaded_corpus_indices[path] = (modified, FlatIndex.load(path))
+    return _loaded_corpus_indices[path][1]
+
+def save_corpus_index(index, path=CORPUS_INDEX_PATH):
+    index.save(path)
+    _loaded_corpus_indices[path] = (os.path.getmtime(path), index)
+
+def embed_into_index(index, ids, sentence_texts, embeddings=None):
+    #adds the sentences that are not already in the index, embedding them unless their embeddings are given (None for a sentence that still needs embedding); the index is created if it is None
+    from src.cluster_sentences import create_embeddings
+    embeddings = embeddings if embeddings is not None else [None] * len(ids)
+    new = [(id, text, embedding) for id, text, embedding in zip(ids, sentence_texts, embeddings) if index is None or id not in index]
+    if not new:
+        return index
+    missing = [i for i, (_, _, embedding) in enumerate(new) if embedding is None]
+    if missing:
+        computed = create_embeddings([new[i][1] for i in missing], only_text=True)
+        for i, embedding in zip(missing, computed):
+            new[i] = (new[i][0], new[i][1], embedding)
+    vectors = np.array([embedding for _, _, embedding in new], dtype=np.float32)
+    if index is None:
+        index = FlatIndex(vectors.shape[1])
+    index.add(vectors, [id for id, _, _ in new])
+    return index
+
+def add_to_corpus_index(ids, sentence_texts, path=CORPUS_INDEX_PATH, embeddings=None):
+    #incrementally adds newly saved labelled_sentence documents to the on-disk corpus index; if there is no index yet, nothing is written, as an index of only
+    #these sentences would look complete to later readers: the full index is built by update_corpus_index, which also picks up these sentences
+    with _corpus_index_lock:
+        index = load_corpus_index(path)
+        if index is None:
+            return None
+        index = embed_into_index(index, ids, sentence_texts, embeddings)
+        save_corpus_index(index, path)
+        return index
+
+def embed_saved_sentences(sentence_ids, sentence_texts, corpus_index_path=CORPUS_INDEX_PATH):
+    #job run after a topic is saved (see main.py), so that saving does not wait for the embedding model: embeds the saved sentences, writes the embeddings to
+    #'sentence_embedding' for kNN search and adds them to the corpus index. Connects with the ELASTIC_* environment variables, which Streamlit sets from its secrets
+    from src.cluster_sentences import create_embeddings
+    client = create_es_client(os.getenv('ELASTIC_HOST'), os.getenv('ELASTIC_USER'), os.getenv('ELASTIC_PASS'))
+    embeddings = create_embeddings(sentence_texts, only_text=True)
+    bulk(client, ({'_op_type': 'update', '_index': 'labelled_sentence', '_id': id, 'doc': {'sentence_embedding': embedding.tolist()}} for id, embedding in zip(sentence_ids, embeddings)))
+    count_round_trips('bulk labelled_sentence', max(1, math.ceil(len(sentence_ids) / 500)))
+    add_to_corpus_index(sentence_ids, sentence_texts, corpus_index_path, embeddings)
+    return {'n_sentences': len(sentence_ids)}
+
+def sentence_count(client: Elasticsearch):
+    #the number of labelled_sentence documents, to tell from one request whether the corpus index lacks any
+    count_round_trips('count labelled_sentence')
+    return client.count(index='labelled_sentence')['count']
+
+def refresh_corpus_index(corpus_index_path=CORPUS_INDEX_PATH, n_sentences=None):
+    #job that brings the corpus index up to date (see update_corpus_index), so that the first build of a large index does not run on a page view. n_sentences,
+    #the sentence count it was submitted at, only makes the job key change as sentences are added (see src/job_queue.py). Connects as embed_saved_sentences
+    client = create_es_client(os.getenv('ELASTIC_HOST'), os.getenv('ELASTIC_USER'), os.getenv('ELASTIC_PASS'))
+    index = update_corpus_index(client, corpus_index_path)
+    return {'n_sentences': len(index) if index is not None else 0}
+
+def update_corpus_index(client: Elasticsearch, path=CORPUS_INDEX_PATH, batch_size=1000, save_every=10):
+    #brings the corpus index up to date with labelled_sentence, streaming the index in batches and reusing the embeddings stored in Elasticsearch where there are any; saves every few batches so that an interrupted run resumes where it stopped
+    query = {"query": {"match_all": {}}, "_source": ["sentence_text", "sentence_embedding"]}
+    with _corpus_index_lock:
+        index = load_corpus_index(path)
+        ids, texts, embeddings, n_batches = [], [], [], 0
+        for hit in scan(client, index='labelled_sentence', query=query, size=batch_size):
+            ids.append(hit['_id'])
+            texts.append(hit['_source']['sentence_text'])
+            embeddings.append(hit['_source'].get('sentence_embedding'))
+            if len(ids) == batch_size:
+                index = embed_into_index(index, ids, texts, embeddings)
+                ids, texts, embeddings, n_batches = [], [], [], n_batches + 1
+                if n_batches % save_every == 0:
+                    save_corpus_index(index, path)
+        index = embed_into_index(index, ids, texts, embeddings)
+        if index is not None:
+            save_corpus_index(index, path)
+        return index
+
+def backfill_sentence_embeddings(client: Elasticsearch, batch_size=256):
+    #maps 'sentence_embedding' and fills it for every labelled_sentence document that lacks it; a scroll is streamed through the embedder into bulk updates, batch by batch
+    from src.cluster_sentences import create_embeddings
+    client.indices.put_mapping(index='labelled_sentence', properties={'sentence_embedding': INDEX_SCHEMAS['labelled_sentence']['mappings']['properties']['sentence_embedding']})
+    query = {"query": {"bool": {"must_not": {"exists": {"field": "sentence_embedding"}}}}, "_source": ["sentence_text"]}
+
+    def updates():
+        batch = []
+        for hit in scan(client, index='labelled_sentence', query=query, size=batch_size):
+            batch.append(hit)
+            if len(batch) == batch_size:
+                yield from embedding_updates(batch)
+                batch = []
+        yield from embedding_updates(batch)
+
+    def embedding_updates(batch):
+        if not batch:
+            return
+        embeddings = create_embeddings([hit['_source']['sentence_text'] for hit in batch], only_text=True)
+        for hit, embedding in zip(batch, embeddings):
+            yield {'_op_type': 'update', '_index': 'labelled_sentence', '_id': hit['_id'], 'doc': {'sentence_embedding': embedding.tolist()}}
+
+    bulk(client, updates(), chunk_size=batch_size)
+
+def similar_sentences(client: Elasticsearch, sentence_texts, k=5, num_candidates=50):
+    #for each sentence text, the k most similar labelled sentences as dictionaries with 'sentence_id', 'sentence_text' and 'similarity' (cosine)
+    #uses kNN on the dense_vector field in Elasticsearch, and falls back to a brute-force search of the local corpus index if the field is not available
+    from src.cluster_sentences import create_embeddings
+    if not sentence_texts:
+        return []
+    embeddings = create_embeddings(sentence_texts, only_text=True)
+    try:
+        hits = knn_search(client, 'labelled_sentence', 'sentence_embedding', embeddings, k, num_candidates)
+        #Elasticsearch scores cosine similarity as (1 + cosine) / 2
+        return [[{'sentence_id': hit['_id'], 'sentence_text': hit['_source']['sentence_text'], 'similarity': 2 * hit['_score'] - 1} for hit in query_hits] for query_hits in hits]
+    except (ValueError, ApiError):
+        index = load_corpus_index()
+        if index is None or len(index) == 0:
+            return [[] for _ in sentence_texts]
+        similarities, ids = index.search(embeddings, k)
+        documents = {id: d[0]['_source'] for id, d in search_documents_by(client, 'labelled_sentence', '_id', sorted({id for row in ids for id in row}), all=True, source_excludes=('sentence_embedding',)).items() if d}
+        return [[{'sentence_id': id, 'sentence_text': documents[id]['sentence_text'], 'similarity': float(similarity)} for similarity, id in zip(row_similarities, row_ids) if id in documents] for row_similarities, row_ids in zip(similarities, ids)]
+
+if __name__ == "__main__":
+    load_dotenv('credentials.env')
+    ELASTIC_HOST=os.getenv('ELASTIC_HOST')
+    ELASTIC_USER=os.getenv('ELASTIC_USER')
+    ELASTIC_PASS=os.getenv('ELASTIC_PASS')
+    client = create_es_client(ELASTIC_HOST, ELASTIC_USER, ELASTIC_PASS)
+    backfill_sentence_embeddings(client)
+    update_corpus_index(client)
+    print(f'{len(load_corpus_index())} sentences in {CORPUS_INDEX_PATH}')